@@ -1,10 +1,13 @@
 import os
+import select
 import sqlite3
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+import tempfile
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, g, has_app_context, make_response, has_request_context
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+from werkzeug.datastructures import CallbackDict
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -12,43 +15,474 @@ import random
 import string
 import secrets
 import hashlib
+import base64
+import binascii
 from functools import wraps
 import json
+import atexit
+import click
+import re
+import threading
+from collections import defaultdict, namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import time
+from types import MappingProxyType
+
+# Диалект SQL (плейсхолдеры '?' для обеих БД) и выбор БД по DATABASE_URL
+from db_dialect import USE_POSTGRESQL, sql, execute, execute_many, fetch_one, fetch_all
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'default-dev-key-change-in-production')
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=30)
 port = int(os.environ.get('PORT', 5000))
 
-# Определяем тип БД: если есть DATABASE_URL – используем PostgreSQL, иначе SQLite
-USE_POSTGRESQL = 'DATABASE_URL' in os.environ
+# Драйвер PostgreSQL нужен только на Render: локально и в процессах с SQLite
+# он не импортируется. sqlite3 импортируется всегда — на нём локальные
+# хранилища сессий и платёжных сессий.
+if USE_POSTGRESQL:
+    import psycopg2
+    from psycopg2.extras import RealDictCursor, execute_values
+
+# Путь к локальной базе SQLite (используется, когда DATABASE_URL не задан)
+SQLITE_PATH = os.environ.get('SQLITE_PATH', 'bank_system.db')
+
+# Настройки пула соединений (отдельный пул в каждом воркере gunicorn)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+DB_POOL_RECYCLE = float(os.environ.get('DB_POOL_RECYCLE', 300))
 
 # ==================== ФУНКЦИИ БАЗЫ ДАННЫХ ====================
 
-def get_db_connection():
-    """Возвращает соединение с БД (PostgreSQL на Render, SQLite локально)."""
+def open_db_connection():
+    """Открывает новое физическое соединение с БД (PostgreSQL на Render, SQLite локально)."""
     if USE_POSTGRESQL:
         conn = psycopg2.connect(os.environ['DATABASE_URL'], cursor_factory=RealDictCursor)
         return conn
     else:
-        # Локально используем SQLite
-        conn = sqlite3.connect('bank_system.db')
+        # Локально используем SQLite; соединение из пула может достаться другому потоку
+        conn = sqlite3.connect(SQLITE_PATH, check_same_thread=False)
         conn.row_factory = sqlite3.Row
         return conn
 
+class PoolTimeout(Exception):
+    """Не удалось получить соединение из пула за DB_POOL_TIMEOUT секунд."""
+
+class ConnectionPool:
+    """Потокобезопасный пул соединений с ограничением размера и статистикой ожиданий."""
+
+    def __init__(self, connect, max_size, timeout, recycle):
+        self._connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.recycle = recycle
+        self._idle = []   # пары (соединение, время возврата в пул)
+        self._size = 0    # всего открытых соединений (свободные + выданные)
+        self._cond = threading.Condition()
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time': 0.0,
+            'timeouts': 0,
+            'created': 0,
+            'discarded': 0,
+        }
+
+    def acquire(self):
+        with self._cond:
+            self._stats['checkouts'] += 1
+            if not self._idle and self._size >= self.max_size:
+                self._stats['waits'] += 1
+                started = time.monotonic()
+                deadline = started + self.timeout
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        self._stats['wait_time'] += time.monotonic() - started
+                        raise PoolTimeout('Пул соединений с БД исчерпан')
+                    self._cond.wait(remaining)
+                self._stats['wait_time'] += time.monotonic() - started
+            while self._idle:
+                conn, released_at = self._idle.pop()
+                if time.monotonic() - released_at < self.recycle:
+                    return conn
+                # Долго простаивавшее соединение могло быть закрыто сервером
+                self._discard(conn)
+            self._size += 1
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._stats['created'] += 1
+        return conn
+
+    def release(self, conn):
+        _after_commit_callbacks.pop(id(conn), None)
+        try:
+            # Сбрасываем незавершённую транзакцию, чтобы не отдать её следующему запросу
+            conn.rollback()
+            healthy = not getattr(conn, 'closed', False)
+        except Exception:
+            healthy = False
+        with self._cond:
+            if healthy:
+                self._idle.append((conn, time.monotonic()))
+            else:
+                self._discard(conn)
+            self._cond.notify()
+
+    def close_idle(self):
+        """Закрывает свободные соединения (мастер gunicorn с preload_app — перед fork воркеров)."""
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._discard(conn)
+
+    def _discard(self, conn):
+        # Вызывается под self._cond
+        self._size -= 1
+        self._stats['discarded'] += 1
+        prepared_statements.forget(conn)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def snapshot(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['wait_time'] = round(stats['wait_time'], 4)
+            stats.update({
+                'max_size': self.max_size,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+            })
+            return stats
+
+_db_pool = None
+_db_pool_pid = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    """Возвращает пул текущего процесса (после fork воркер создаёт свой пул)."""
+    global _db_pool, _db_pool_pid
+    pid = os.getpid()
+    if _db_pool is None or _db_pool_pid != pid:
+        with _db_pool_lock:
+            if _db_pool is None or _db_pool_pid != pid:
+                _db_pool = ConnectionPool(open_db_connection, DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_POOL_RECYCLE)
+                _db_pool_pid = pid
+    return _db_pool
+
+# Действия, которые нужно выполнить после commit транзакции соединения: id(raw) -> [callback]
+_after_commit_callbacks = {}
+
+def after_commit(cur, callback):
+    """Выполнит callback после commit транзакции, в которой работает cur; при rollback — забудет."""
+    _after_commit_callbacks.setdefault(id(cur.connection), []).append(callback)
+
+class DBConnection:
+    """Обёртка над соединением из пула.
+
+    Внутри запроса все функции получают одно и то же соединение (хранится в g),
+    и close() ничего не делает — соединение вернётся в пул в teardown.
+    Вне контекста приложения (фоновые потоки) close() возвращает соединение в пул.
+    """
+
+    def __init__(self, raw, request_scoped):
+        self.raw = raw
+        self._request_scoped = request_scoped
+
+    def cursor(self, *args, **kwargs):
+        return self.raw.cursor(*args, **kwargs)
+
+    def commit(self):
+        self.raw.commit()
+        for callback in _after_commit_callbacks.pop(id(self.raw), ()):
+            callback()
+
+    def rollback(self):
+        _after_commit_callbacks.pop(id(self.raw), None)
+        self.raw.rollback()
+
+    def close(self):
+        if self._request_scoped or self.raw is None:
+            return
+        get_db_pool().release(self.raw)
+        self.raw = None
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+def get_db_connection():
+    """Возвращает соединение с БД из пула (одно на запрос)."""
+    if has_app_context():
+        if 'db_conn' not in g:
+            g.db_conn = get_db_pool().acquire()
+        return DBConnection(g.db_conn, request_scoped=True)
+    return DBConnection(get_db_pool().acquire(), request_scoped=False)
+
+@app.teardown_appcontext
+def release_db_connection(exc):
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        get_db_pool().release(conn)
+
 def row_to_dict(row):
     """Преобразует строку результата (Row или RealDictRow) в словарь."""
     if row is None:
         return None
     return dict(row)
 
+# ==================== ПОДГОТОВЛЕННЫЕ ЗАПРОСЫ ====================
+# Самые частые запросы (вход, перевод, оплата по NFC) в PostgreSQL выполняются
+# как серверные подготовленные: на каждом соединении пула PREPARE делается один
+# раз при первом использовании, дальше — только EXECUTE. Сервер не разбирает и
+# не анализирует текст заново, а после нескольких выполнений переходит на
+# общий план. Соединения пула живут долго, так что PREPARE окупается быстро.
+# Список подготовленных на соединении имён забывается, когда пул его закрывает.
+# В SQLite те же запросы выполняются обычным execute (у sqlite3 свой кэш
+# скомпилированных запросов). DB_PREPARED_STATEMENTS=0 отключает PREPARE —
+# например, за pgbouncer в режиме transaction pooling.
+# Запросы с FOR UPDATE вызываются только в ветках для PostgreSQL.
+# Колонки перечислены явно, а не через *: подготовленный запрос с * перестаёт
+# выполняться ("cached plan must not change result type"), как только миграция
+# добавит колонку в таблицу. Если тип результата всё же изменился (например,
+# ALTER COLUMN TYPE), запрос падает один раз, а при следующем использовании на
+# этом соединении делается DEALLOCATE и PREPARE заново.
+
+DB_PREPARED_STATEMENTS = os.environ.get('DB_PREPARED_STATEMENTS', '1') == '1'
+
+USER_COLUMNS = ('id', 'passport', 'full_name', 'account_number', 'balance', 'is_active', 'role_id',
+                'password_hash', 'email', 'phone', 'created_at', 'balance_buckets')
+
+# Имя -> текст запроса с плейсхолдерами '?'
+HOT_STATEMENTS = {
+    'user_by_passport': f'''
+        SELECT {', '.join('u.' + column for column in USER_COLUMNS)}, r.role_name, r.level, r.permissions
+        FROM users u
+        LEFT JOIN roles r ON u.role_id = r.id
+        WHERE u.passport = ?
+    ''',
+    'user_by_account': f"SELECT {', '.join(USER_COLUMNS)} FROM users WHERE account_number = ?",
+    'lock_transfer_accounts': '''
+        SELECT id, passport, full_name, account_number, balance, is_active, balance_buckets
+        FROM users
+        WHERE account_number IN (?, ?)
+        ORDER BY account_number
+        FOR UPDATE
+    ''',
+    'debit_balance': 'UPDATE users SET balance = balance - ? WHERE id = ? AND balance >= ?',
+    'credit_balance': 'UPDATE users SET balance = balance + ? WHERE id = ?',
+    'insert_transaction': '''
+        INSERT INTO transactions (type, from_account, to_account, amount, status, description, user_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''',
+    'payment_session_by_id': '''
+        SELECT id, session_id, buyer_id, seller_id, amount, status, created_at, expires_at, completed_at
+        FROM payment_sessions WHERE session_id = ?
+    ''',
+    'lock_pin': '''
+        SELECT id, user_id, nfc_tag_id, pin_hash, pin_salt, attempts, last_attempt, is_locked, created_at
+        FROM user_pins
+        WHERE user_id = ? AND nfc_tag_id = ? AND is_locked = FALSE
+        FOR UPDATE
+    ''',
+}
+
+def numbered_placeholders(query):
+    """'?' -> $1, $2, ... — синтаксис параметров PREPARE."""
+    parts = query.split('?')
+    return ''.join(part + (f'${i}' if i < len(parts) else '') for i, part in enumerate(parts, 1))
+
+class PreparedStatementRegistry:
+    """Подготовленные запросы с учётом того, на каких соединениях они уже подготовлены."""
+
+    def __init__(self, statements, enabled):
+        self.statements = statements
+        self.enabled = enabled and USE_POSTGRESQL
+        self._prepared = {}   # id(соединения) -> множество подготовленных имён
+        self._stale = {}      # id(соединения) -> имена, которые нужно подготовить заново
+        self._lock = threading.Lock()
+        self._stats = {'prepares': 0, 'executions': 0, 'reprepares': 0}
+
+    def prepare(self, cur, name):
+        """Подготавливает запрос на соединении cur (если ещё нет). Возвращает текст EXECUTE."""
+        query = self.statements[name]
+        prepared = self._prepared.setdefault(id(cur.connection), set())
+        if name not in prepared:
+            stale = self._stale.get(id(cur.connection))
+            if stale and name in stale:
+                cur.execute(f'DEALLOCATE {name}')
+                stale.discard(name)
+                with self._lock:
+                    self._stats['reprepares'] += 1
+            # Без параметров psycopg2 не подставляет значения, так что '%' в тексте безопасен
+            cur.execute(f'PREPARE {name} AS {numbered_placeholders(query)}')
+            prepared.add(name)
+            with self._lock:
+                self._stats['prepares'] += 1
+        count = query.count('?')
+        return f"EXECUTE {name} ({', '.join(['%s'] * count)})" if count else f'EXECUTE {name}'
+
+    def execute(self, cur, name, params=()):
+        if not self.enabled:
+            return execute(cur, self.statements[name], params)
+        statement = self.prepare(cur, name)
+        try:
+            cur.execute(statement, tuple(params))
+        except psycopg2.Error as e:
+            if e.pgcode == '0A000':
+                # cached plan must not change result type: транзакция уже прервана,
+                # поэтому запрос пересоздаётся при следующем использовании
+                self._prepared[id(cur.connection)].discard(name)
+                self._stale.setdefault(id(cur.connection), set()).add(name)
+            raise
+        with self._lock:
+            self._stats['executions'] += 1
+        return cur
+
+    def forget(self, conn):
+        """Соединение закрыто — подготовленные на нём запросы исчезли вместе с ним."""
+        self._prepared.pop(id(conn), None)
+        self._stale.pop(id(conn), None)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._stats, enabled=self.enabled, statements=len(self.statements),
+                        connections=len(self._prepared))
+
+prepared_statements = PreparedStatementRegistry(HOT_STATEMENTS, DB_PREPARED_STATEMENTS)
+
+def execute_prepared(cur, name, params=()):
+    """Выполняет запрос из HOT_STATEMENTS (в PostgreSQL — через PREPARE/EXECUTE)."""
+    return prepared_statements.execute(cur, name, params)
+
+# ==================== ДЕНЕЖНЫЕ СУММЫ ====================
+# Все суммы хранятся в БД целыми копейками (BIGINT); в рубли переводим только
+# на входе (формы, JSON) и на выходе (шаблоны, JSON).
+
+MINOR_UNITS = 100
+
+# Денежные колонки: таблица -> {колонка: значение по умолчанию или None}
+MONEY_COLUMNS = {
+    'users': {'balance': '0'},
+    'transactions': {'amount': None},
+    'businesses': {'charter_capital': None},
+    'business_accounts': {'balance': '0', 'credit_limit': '0'},
+    'withdrawal_requests': {'amount': None},
+    'payment_sessions': {'amount': None},
+}
+
+# Ключи в ответах API, которые содержат суммы в копейках
+MONEY_FIELDS = ('balance', 'amount', 'charter_capital', 'credit_limit')
+
+def to_minor(value):
+    """Переводит сумму в рублях (строка или число) в целые копейки.
+
+    Бросает ValueError, если сумма не распознана.
+    """
+    try:
+        amount = Decimal(str(value).strip().replace(',', '.'))
+    except (InvalidOperation, ValueError):
+        raise ValueError('Неверная сумма')
+    if not amount.is_finite():
+        raise ValueError('Неверная сумма')
+    return int((amount * MINOR_UNITS).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+def from_minor(value):
+    """Копейки -> рубли (число) для JSON и JavaScript."""
+    if value is None:
+        return None
+    return int(value) / MINOR_UNITS
+
+def format_money(value):
+    """Копейки -> строка вида '1 234.50' для шаблонов и сообщений."""
+    if value is None:
+        value = 0
+    rubles = Decimal(int(value)) / MINOR_UNITS
+    return f'{rubles:,.2f}'.replace(',', ' ')
+
+def money_to_json(row, fields=MONEY_FIELDS):
+    """Копия словаря, в которой денежные поля переведены из копеек в рубли."""
+    result = dict(row)
+    for field in fields:
+        if result.get(field) is not None:
+            result[field] = from_minor(result[field])
+    return result
+
+app.add_template_filter(format_money, 'money')
+app.add_template_filter(from_minor, 'rubles')
+
 # ==================== ИНИЦИАЛИЗАЦИЯ БАЗЫ ДАННЫХ ====================
 
-def init_db():
-    """Создаёт все таблицы и заполняет начальными данными (совместимо с PostgreSQL и SQLite)."""
-    conn = get_db_connection()
-    cur = conn.cursor()
+def add_column_if_missing(cur, table, column, definition):
+    """Добавляет колонку в существующую таблицу (для БД, созданных до её появления)."""
+    if USE_POSTGRESQL:
+        cur.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {definition}')
+        return
+    cur.execute(f'PRAGMA table_info({table})')
+    if column not in [c['name'] for c in cur.fetchall()]:
+        cur.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+def migrate_money_to_minor_units(cur):
+    """Переводит денежные колонки из REAL (рубли) в BIGINT (копейки) в существующей БД.
 
+    Повторный запуск ничего не делает: переводятся только колонки, ещё имеющие тип REAL.
+    """
+    if USE_POSTGRESQL:
+        cur.execute('''
+            SELECT table_name, column_name
+            FROM information_schema.columns
+            WHERE table_schema = current_schema() AND data_type IN ('real', 'double precision')
+        ''')
+        for row in cur.fetchall():
+            table, column = row['table_name'], row['column_name']
+            if column not in MONEY_COLUMNS.get(table, {}):
+                continue
+            default = MONEY_COLUMNS[table][column]
+            cur.execute(f'ALTER TABLE {table} ALTER COLUMN {column} DROP DEFAULT')
+            cur.execute(f'ALTER TABLE {table} ALTER COLUMN {column} TYPE BIGINT '
+                        f'USING ROUND({column}::numeric * {MINOR_UNITS})::BIGINT')
+            if default is not None:
+                cur.execute(f'ALTER TABLE {table} ALTER COLUMN {column} SET DEFAULT {default}')
+            print(f"✅ {table}.{column} переведена в копейки")
+        return
+
+    # SQLite не умеет менять тип колонки: пересоздаём таблицу с колонками BIGINT
+    for table, columns in MONEY_COLUMNS.items():
+        cur.execute(f'PRAGMA table_info({table})')
+        info = cur.fetchall()
+        real_columns = [c['name'] for c in info if c['name'] in columns and c['type'].upper() == 'REAL']
+        if not real_columns:
+            continue
+        cur.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+        create_sql = cur.fetchone()['sql']
+        for column in real_columns:
+            create_sql = re.sub(rf'\b{column}\s+REAL\b', f'{column} BIGINT', create_sql)
+        create_sql = re.sub(rf'^CREATE TABLE\s+"?{table}"?', f'CREATE TABLE {table}__minor', create_sql)
+        names = [c['name'] for c in info]
+        select = ', '.join(
+            f'CAST(ROUND({name} * {MINOR_UNITS}) AS INTEGER)' if name in real_columns else name
+            for name in names
+        )
+        cur.execute(create_sql)
+        cur.execute(f'INSERT INTO {table}__minor ({", ".join(names)}) SELECT {select} FROM {table}')
+        cur.execute(f'DROP TABLE {table}')
+        cur.execute(f'ALTER TABLE {table}__minor RENAME TO {table}')
+        print(f"✅ {table}: {', '.join(real_columns)} переведены в копейки")
+
+def create_schema(cur):
+    """Миграция 1: таблицы, индексы, роли и суперадмин (совместимо с PostgreSQL и SQLite).
+
+    Все шаги идемпотентны, поэтому на БД, созданной до появления schema_version,
+    миграция только доводит схему до текущей.
+    """
     # ----- Таблица пользователей -----
     if USE_POSTGRESQL:
         cur.execute('''
@@ -57,13 +491,14 @@ def init_db():
                 passport TEXT UNIQUE NOT NULL,
                 full_name TEXT NOT NULL,
                 account_number TEXT UNIQUE NOT NULL,
-                balance REAL DEFAULT 0,
+                balance BIGINT DEFAULT 0,
                 is_active BOOLEAN DEFAULT TRUE,
                 role_id INTEGER DEFAULT 6,
                 password_hash TEXT NOT NULL,
                 email TEXT,
                 phone TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                balance_buckets INTEGER NOT NULL DEFAULT 0
             )
         ''')
     else:
@@ -73,13 +508,14 @@ def init_db():
                 passport TEXT UNIQUE NOT NULL,
                 full_name TEXT NOT NULL,
                 account_number TEXT UNIQUE NOT NULL,
-                balance REAL DEFAULT 0,
+                balance BIGINT DEFAULT 0,
                 is_active BOOLEAN DEFAULT 1,
                 role_id INTEGER DEFAULT 6,
                 password_hash TEXT NOT NULL,
                 email TEXT,
                 phone TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                balance_buckets INTEGER NOT NULL DEFAULT 0
             )
         ''')
 
@@ -116,7 +552,7 @@ def init_db():
                 type TEXT NOT NULL,
                 from_account TEXT NOT NULL,
                 to_account TEXT NOT NULL,
-                amount REAL NOT NULL,
+                amount BIGINT NOT NULL,
                 status TEXT NOT NULL,
                 description TEXT,
                 user_id INTEGER REFERENCES users(id) ON DELETE SET NULL
@@ -130,7 +566,7 @@ def init_db():
                 type TEXT NOT NULL,
                 from_account TEXT NOT NULL,
                 to_account TEXT NOT NULL,
-                amount REAL NOT NULL,
+                amount BIGINT NOT NULL,
                 status TEXT NOT NULL,
                 description TEXT,
                 user_id INTEGER,
@@ -139,18 +575,25 @@ def init_db():
         ''')
 
     # ----- Таблица аудита -----
+    # В PostgreSQL секционирована по месяцам, в SQLite прошлые месяцы уходят
+    # в архивные таблицы (см. раздел «ЖУРНАЛ АУДИТА»)
     if USE_POSTGRESQL:
+        legacy_audit_log = rename_legacy_audit_log(cur)
         cur.execute('''
             CREATE TABLE IF NOT EXISTS audit_log (
-                id SERIAL PRIMARY KEY,
+                id BIGSERIAL,
                 admin_passport TEXT NOT NULL,
                 admin_name TEXT NOT NULL,
                 action TEXT NOT NULL,
                 target_user TEXT,
                 details TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
+                timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (id, timestamp)
+            ) PARTITION BY RANGE (timestamp)
         ''')
+        ensure_audit_partitions(cur)
+        if legacy_audit_log:
+            import_legacy_audit_log(cur)
     else:
         cur.execute('''
             CREATE TABLE IF NOT EXISTS audit_log (
@@ -173,7 +616,7 @@ def init_db():
                 business_name TEXT NOT NULL,
                 legal_name TEXT,
                 tax_id TEXT UNIQUE,
-                charter_capital REAL NOT NULL,
+                charter_capital BIGINT NOT NULL,
                 address TEXT,
                 email TEXT,
                 phone TEXT,
@@ -193,7 +636,7 @@ def init_db():
                 business_name TEXT NOT NULL,
                 legal_name TEXT,
                 tax_id TEXT UNIQUE,
-                charter_capital REAL NOT NULL,
+                charter_capital BIGINT NOT NULL,
                 address TEXT,
                 email TEXT,
                 phone TEXT,
@@ -216,10 +659,10 @@ def init_db():
                 business_id INTEGER NOT NULL REFERENCES businesses(id) ON DELETE CASCADE,
                 account_number TEXT UNIQUE NOT NULL,
                 account_type TEXT DEFAULT 'current',
-                balance REAL DEFAULT 0,
+                balance BIGINT DEFAULT 0,
                 currency TEXT DEFAULT 'RUB',
                 is_active BOOLEAN DEFAULT TRUE,
-                credit_limit REAL DEFAULT 0,
+                credit_limit BIGINT DEFAULT 0,
                 overdraft_allowed BOOLEAN DEFAULT FALSE,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
@@ -231,10 +674,10 @@ def init_db():
                 business_id INTEGER NOT NULL,
                 account_number TEXT UNIQUE NOT NULL,
                 account_type TEXT DEFAULT 'current',
-                balance REAL DEFAULT 0,
+                balance BIGINT DEFAULT 0,
                 currency TEXT DEFAULT 'RUB',
                 is_active BOOLEAN DEFAULT 1,
-                credit_limit REAL DEFAULT 0,
+                credit_limit BIGINT DEFAULT 0,
                 overdraft_allowed BOOLEAN DEFAULT 0,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (business_id) REFERENCES businesses (id)
@@ -248,7 +691,7 @@ def init_db():
                 id SERIAL PRIMARY KEY,
                 business_account_id INTEGER NOT NULL REFERENCES business_accounts(id) ON DELETE CASCADE,
                 user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-                amount REAL NOT NULL,
+                amount BIGINT NOT NULL,
                 purpose TEXT NOT NULL,
                 recipient_name TEXT,
                 recipient_account TEXT,
@@ -266,7 +709,7 @@ def init_db():
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 business_account_id INTEGER NOT NULL,
                 user_id INTEGER NOT NULL,
-                amount REAL NOT NULL,
+                amount BIGINT NOT NULL,
                 purpose TEXT NOT NULL,
                 recipient_name TEXT,
                 recipient_account TEXT,
@@ -349,7 +792,7 @@ def init_db():
                 session_id TEXT UNIQUE NOT NULL,
                 buyer_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
                 seller_id INTEGER REFERENCES users(id) ON DELETE SET NULL,
-                amount REAL,
+                amount BIGINT,
                 status TEXT DEFAULT 'pending',
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 expires_at TIMESTAMP,
@@ -363,7 +806,7 @@ def init_db():
                 session_id TEXT UNIQUE NOT NULL,
                 buyer_id INTEGER NOT NULL,
                 seller_id INTEGER,
-                amount REAL,
+                amount BIGINT,
                 status TEXT DEFAULT 'pending',
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 expires_at TIMESTAMP,
@@ -373,20 +816,141 @@ def init_db():
             )
         ''')
 
+    # ----- Таблица ключей идемпотентности (повторы запросов от терминалов) -----
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            idem_key TEXT PRIMARY KEY,
+            request_hash TEXT,
+            status_code INTEGER,
+            response_body TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP NOT NULL
+        )
+    ''')
+
+    # ----- Сводная статистика (поддерживается вместе с операциями) -----
+    # Счётчики дня разбиты на STATS_SLOTS строк, чтобы параллельные переводы
+    # не выстраивались в очередь за блокировкой одной строки
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day DATE NOT NULL,
+            slot INTEGER NOT NULL DEFAULT 0,
+            transactions_count BIGINT NOT NULL DEFAULT 0,
+            turnover BIGINT NOT NULL DEFAULT 0,
+            active_users INTEGER NOT NULL DEFAULT 0,
+            new_users INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, slot)
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS daily_active_users (
+            day DATE NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (day, user_id)
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS stats_totals (
+            id INTEGER PRIMARY KEY,
+            users_count INTEGER NOT NULL DEFAULT 0,
+            active_users_count INTEGER NOT NULL DEFAULT 0,
+            total_balance BIGINT NOT NULL DEFAULT 0,
+            active_balance BIGINT NOT NULL DEFAULT 0
+        )
+    ''')
+
+    # ----- Суммы в копейках (для БД, созданных до перехода) -----
+    migrate_money_to_minor_units(cur)
+
+    # ----- Разделённые балансы «горячих» счетов -----
+    add_column_if_missing(cur, 'users', 'balance_buckets', 'INTEGER NOT NULL DEFAULT 0')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS balance_buckets (
+            user_id INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            amount BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, bucket)
+        )
+    ''')
+
+    # ----- Очередь исходящих писем -----
+    if USE_POSTGRESQL:
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS email_outbox (
+                id SERIAL PRIMARY KEY,
+                to_email TEXT NOT NULL,
+                subject TEXT NOT NULL,
+                body TEXT NOT NULL,
+                html_body TEXT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                last_error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                sent_at TIMESTAMP
+            )
+        ''')
+    else:
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS email_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                to_email TEXT NOT NULL,
+                subject TEXT NOT NULL,
+                body TEXT NOT NULL,
+                html_body TEXT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                last_error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                sent_at TIMESTAMP
+            )
+        ''')
+
+    # ----- Сессии веб-интерфейса (SESSION_STORE=database) -----
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS web_sessions (
+            sid TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            expires_at TIMESTAMP NOT NULL
+        )
+    ''')
+
     # ----- Индексы (для PostgreSQL синтаксис одинаков) -----
     cur.execute('CREATE INDEX IF NOT EXISTS idx_users_passport ON users(passport)')
     cur.execute('CREATE INDEX IF NOT EXISTS idx_users_account ON users(account_number)')
-    cur.execute('CREATE INDEX IF NOT EXISTS idx_transactions_accounts ON transactions(from_account, to_account)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_users_created_at ON users(created_at)')
+    init_user_search(cur)
     cur.execute('CREATE INDEX IF NOT EXISTS idx_transactions_date ON transactions(date)')
+    # История счета: отдельный индекс для каждой стороны операции. Составной
+    # (from_account, to_account) не обслуживал поиск по получателю и заменён ими.
+    cur.execute('DROP INDEX IF EXISTS idx_transactions_accounts')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_transactions_from_date ON transactions(from_account, date, id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_transactions_to_date ON transactions(to_account, date, id)')
     cur.execute('CREATE INDEX IF NOT EXISTS idx_nfc_tags_user ON nfc_tags(user_id)')
     cur.execute('CREATE INDEX IF NOT EXISTS idx_nfc_tags_uid ON nfc_tags(tag_uid)')
     cur.execute('CREATE INDEX IF NOT EXISTS idx_payment_sessions_session ON payment_sessions(session_id)')
+    # Незавершённые сессии — малая часть таблицы: частичный индекс для счётчика и уборщика
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_payment_sessions_open ON payment_sessions(expires_at)
+        WHERE status IN ('pending', 'processing')
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_payment_sessions_expires ON payment_sessions(expires_at)')
     cur.execute('CREATE INDEX IF NOT EXISTS idx_businesses_user ON businesses(user_id)')
     cur.execute('CREATE INDEX IF NOT EXISTS idx_businesses_status ON businesses(status)')
     cur.execute('CREATE INDEX IF NOT EXISTS idx_business_accounts_business ON business_accounts(business_id)')
     cur.execute('CREATE INDEX IF NOT EXISTS idx_withdrawal_requests_status ON withdrawal_requests(status)')
     cur.execute('CREATE INDEX IF NOT EXISTS idx_user_pins_lookup ON user_pins(user_id, nfc_tag_id)')
     cur.execute('CREATE INDEX IF NOT EXISTS idx_audit_log_timestamp ON audit_log(timestamp)')
+    if not USE_POSTGRESQL:
+        rotate_audit_log(cur)
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys(expires_at)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_web_sessions_expires ON web_sessions(expires_at)')
+    # Доставка выбирает только неотправленные письма — малую часть таблицы
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_email_outbox_due ON email_outbox(next_attempt_at)
+        WHERE status IN ('pending', 'sending')
+    ''')
 
     # ----- Заполнение ролей -----
     default_roles = [
@@ -419,36 +983,23 @@ def init_db():
         cur.execute("SELECT * FROM users WHERE passport = ?", ('admin001',))
     admin = cur.fetchone()
     if not admin:
-        if USE_POSTGRESQL:
-            cur.execute('''
-                INSERT INTO users (passport, full_name, account_number, balance, role_id, password_hash, email, phone)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            ''', (
-                'admin001',
-                'Главный Администратор',
-                'SUPER001',
-                1000000,
-                1,
-                generate_password_hash('superadmin123'),
-                'superadmin@bank.ru',
-                '+79998887766'
-            ))
-        else:
-            cur.execute('''
-                INSERT INTO users (passport, full_name, account_number, balance, role_id, password_hash, email, phone)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                'admin001',
-                'Главный Администратор',
-                'SUPER001',
-                1000000,
-                1,
-                generate_password_hash('superadmin123'),
-                'superadmin@bank.ru',
-                '+79998887766'
-            ))
+        execute(cur, '''
+            INSERT INTO users (passport, full_name, account_number, balance, role_id, password_hash, email, phone)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            'admin001',
+            'Главный Администратор',
+            'SUPER001',
+            to_minor(1000000),
+            1,
+            generate_password_hash('superadmin123'),
+            'superadmin@bank.ru',
+            '+79998887766'
+        ))
         print("✅ Создан суперадмин: admin001 / superadmin123")
 
+def seed_test_data(cur):
+    """Миграция 2: тестовые пользователи и тестовый бизнес."""
     # ----- Тестовые пользователи (роль 6) -----
     test_users = [
         ('special001', 'Специальный Админ', 'SPEC001', 50000, 2, 'special123'),
@@ -459,22 +1010,12 @@ def init_db():
         ('912312', 'КИЯМОВ КАРИМ МАРАТОВИЧ', f'ACC{random.randint(100000, 999999)}', 1000, 6, '123456')
     ]
     for passport, full_name, account_number, balance, role_id, password in test_users:
-        if USE_POSTGRESQL:
-            cur.execute("SELECT * FROM users WHERE passport = %s", (passport,))
-        else:
-            cur.execute("SELECT * FROM users WHERE passport = ?", (passport,))
-        existing = cur.fetchone()
+        existing = fetch_one(cur, "SELECT * FROM users WHERE passport = ?", (passport,))
         if not existing:
-            if USE_POSTGRESQL:
-                cur.execute('''
-                    INSERT INTO users (passport, full_name, account_number, balance, role_id, password_hash)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                ''', (passport, full_name, account_number, balance, role_id, generate_password_hash(password)))
-            else:
-                cur.execute('''
-                    INSERT INTO users (passport, full_name, account_number, balance, role_id, password_hash)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                ''', (passport, full_name, account_number, balance, role_id, generate_password_hash(password)))
+            execute(cur, '''
+                INSERT INTO users (passport, full_name, account_number, balance, role_id, password_hash)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (passport, full_name, account_number, to_minor(balance), role_id, generate_password_hash(password)))
             print(f"✅ Создан тестовый пользователь: {passport} / {password}")
 
     # ----- Тестовый бизнес (для пользователя user002) -----
@@ -485,6 +1026,11 @@ def init_db():
     user_row = cur.fetchone()
     if user_row:
         user_id = user_row['id']
+        # У бизнеса нет уникального ключа, поэтому наличие проверяем сами
+        execute(cur, "SELECT id FROM businesses WHERE user_id = ? AND business_name = 'Тестовый Бизнес ООО'",
+                     (user_id,))
+        if cur.fetchone():
+            return
         # Создаём бизнес
         if USE_POSTGRESQL:
             cur.execute('''
@@ -492,7 +1038,7 @@ def init_db():
                 VALUES (%s, %s, %s, %s, %s, %s)
                 ON CONFLICT (tax_id) DO NOTHING
                 RETURNING id
-            ''', (user_id, 'Тестовый Бизнес ООО', 50000, 'approved', 'test_business@example.com', '+79990000001'))
+            ''', (user_id, 'Тестовый Бизнес ООО', to_minor(50000), 'approved', 'test_business@example.com', '+79990000001'))
             business_row = cur.fetchone()
             if business_row:
                 business_id = business_row['id']
@@ -500,13 +1046,13 @@ def init_db():
                     INSERT INTO business_accounts (business_id, account_number, balance)
                     VALUES (%s, %s, %s)
                     ON CONFLICT (account_number) DO NOTHING
-                ''', (business_id, f'BUS{random.randint(100000, 999999)}', 50000))
+                ''', (business_id, f'BUS{random.randint(100000, 999999)}', to_minor(50000)))
         else:
             # SQLite – нужно получить lastrowid отдельно
             cur.execute('''
                 INSERT OR IGNORE INTO businesses (user_id, business_name, charter_capital, status, email, phone)
                 VALUES (?, ?, ?, ?, ?, ?)
-            ''', (user_id, 'Тестовый Бизнес ООО', 50000, 'approved', 'test_business@example.com', '+79990000001'))
+            ''', (user_id, 'Тестовый Бизнес ООО', to_minor(50000), 'approved', 'test_business@example.com', '+79990000001'))
             # Если вставка произошла, получим id
             cur.execute("SELECT id FROM businesses WHERE user_id = ? AND business_name = 'Тестовый Бизнес ООО'", (user_id,))
             business_row = cur.fetchone()
@@ -515,90 +1061,410 @@ def init_db():
                 cur.execute('''
                     INSERT OR IGNORE INTO business_accounts (business_id, account_number, balance)
                     VALUES (?, ?, ?)
-                ''', (business_id, f'BUS{random.randint(100000, 999999)}', 50000))
+                ''', (business_id, f'BUS{random.randint(100000, 999999)}', to_minor(50000)))
         print("✅ Создан тестовый бизнес с балансом 50,000 ₽")
 
+def init_stats(cur):
+    """Миграция 3: первичное заполнение сводной статистики."""
+    cur.execute('SELECT id FROM stats_totals WHERE id = 1')
+    if not cur.fetchone():
+        rebuild_stats(cur)
+        print("✅ Сводная статистика построена по истории операций")
+
+# ==================== СВОДНАЯ СТАТИСТИКА ====================
+# Панели администратора читают готовые счётчики вместо агрегатов по transactions
+# и users. Счётчики меняются в той же транзакции, что и сами операции:
+# запись в журнал, создание пользователя, зачисление, блокировка.
+# Если счётчики разошлись с данными — `flask rebuild-stats` пересчитает их.
+
+STATS_SLOTS = 8
+
+def record_transaction_stats(cur, count, turnover, user_ids):
+    """Учитывает count операций на turnover копеек и активность пользователей за сегодня."""
+    new_active = 0
+    for user_id in set(user_ids):
+        if USE_POSTGRESQL:
+            cur.execute('''
+                INSERT INTO daily_active_users (day, user_id) VALUES (CURRENT_DATE, %s)
+                ON CONFLICT DO NOTHING
+            ''', (user_id,))
+        else:
+            cur.execute('INSERT OR IGNORE INTO daily_active_users (day, user_id) VALUES (CURRENT_DATE, ?)',
+                        (user_id,))
+        new_active += cur.rowcount
+    bump_daily_stats(cur, transactions_count=count, turnover=turnover, active_users=new_active)
+
+def bump_daily_stats(cur, transactions_count=0, turnover=0, active_users=0, new_users=0):
+    slot = random.randrange(STATS_SLOTS)
+    if USE_POSTGRESQL:
+        cur.execute('''
+            INSERT INTO daily_stats (day, slot, transactions_count, turnover, active_users, new_users)
+            VALUES (CURRENT_DATE, %s, %s, %s, %s, %s)
+            ON CONFLICT (day, slot) DO UPDATE SET
+                transactions_count = daily_stats.transactions_count + EXCLUDED.transactions_count,
+                turnover = daily_stats.turnover + EXCLUDED.turnover,
+                active_users = daily_stats.active_users + EXCLUDED.active_users,
+                new_users = daily_stats.new_users + EXCLUDED.new_users
+        ''', (slot, transactions_count, turnover, active_users, new_users))
+    else:
+        cur.execute('''
+            INSERT INTO daily_stats (day, slot, transactions_count, turnover, active_users, new_users)
+            VALUES (CURRENT_DATE, ?, ?, ?, ?, ?)
+            ON CONFLICT (day, slot) DO UPDATE SET
+                transactions_count = transactions_count + excluded.transactions_count,
+                turnover = turnover + excluded.turnover,
+                active_users = active_users + excluded.active_users,
+                new_users = new_users + excluded.new_users
+        ''', (slot, transactions_count, turnover, active_users, new_users))
+
+def record_new_user(cur, balance, is_active=True):
+    """Учитывает созданного пользователя с начальным балансом balance копеек."""
+    bump_daily_stats(cur, new_users=1)
+    active = 1 if is_active else 0
+    execute(cur, '''
+        UPDATE stats_totals SET users_count = users_count + 1,
+            active_users_count = active_users_count + ?,
+            total_balance = total_balance + ?,
+            active_balance = active_balance + ?
+        WHERE id = 1
+    ''', (active, balance, balance * active))
+
+def record_balance_change(cur, delta, active_delta):
+    """
+    Учитывает изменение суммы балансов: delta — всех пользователей, active_delta — активных.
+    Переводы между активными счетами сумму не меняют, и вызывать это для них не нужно.
+    """
+    if not delta and not active_delta:
+        return
+    execute(cur, '''
+        UPDATE stats_totals SET total_balance = total_balance + ?, active_balance = active_balance + ?
+        WHERE id = 1
+    ''', (delta, active_delta))
+
+def record_activity_change(cur, passports, activate):
+    """
+    Переносит пользователей между активными и заблокированными в stats_totals.
+    Вызывается до UPDATE users SET is_active, учитываются только те, чей статус действительно меняется.
+    """
+    sign = 1 if activate else -1
+    placeholders = ','.join(['?'] * len(passports))
+    current = 'FALSE' if activate else 'TRUE'
+    # Строки блокируются до подсчёта: иначе перевод, закоммиченный между подсчётом
+    # и UPDATE users SET is_active, учтёт свою сумму по старому статусу
+    if USE_POSTGRESQL:
+        execute(cur, f'SELECT id FROM users WHERE passport IN ({placeholders}) ORDER BY account_number FOR UPDATE',
+                passports)
+    else:
+        begin_write_transaction(cur.connection)
+    execute(cur, f'''
+        UPDATE stats_totals SET
+            active_users_count = active_users_count + ? * (
+                SELECT COUNT(*) FROM users WHERE passport IN ({placeholders}) AND is_active = {current}),
+            active_balance = active_balance + ? * (
+                SELECT COALESCE(SUM({BALANCE_WITH_BUCKETS}), 0) FROM users
+                WHERE passport IN ({placeholders}) AND is_active = {current})
+        WHERE id = 1
+    ''', [sign] + list(passports) + [sign] + list(passports))
+
+def rebuild_stats(cur):
+    """Пересчитывает сводные таблицы по transactions и users (без commit)."""
+    cur.execute('DELETE FROM daily_stats')
+    cur.execute('DELETE FROM daily_active_users')
+    cur.execute('DELETE FROM stats_totals')
+    if USE_POSTGRESQL:
+        cur.execute('''
+            INSERT INTO daily_active_users (day, user_id)
+            SELECT DISTINCT DATE(date), user_id FROM transactions WHERE user_id IS NOT NULL
+        ''')
+        cur.execute('''
+            INSERT INTO daily_stats (day, slot, transactions_count, turnover)
+            SELECT DATE(date), 0, COUNT(*), COALESCE(SUM(CASE WHEN status = %s THEN amount ELSE 0 END), 0)
+            FROM transactions GROUP BY DATE(date)
+        ''', ('Успешно',))
+        cur.execute('''
+            INSERT INTO daily_stats (day, slot, new_users)
+            SELECT DATE(created_at), 0, COUNT(*) FROM users GROUP BY DATE(created_at)
+            ON CONFLICT (day, slot) DO UPDATE SET new_users = EXCLUDED.new_users
+        ''')
+        cur.execute('''
+            UPDATE daily_stats SET active_users = a.cnt
+            FROM (SELECT day, COUNT(*) AS cnt FROM daily_active_users GROUP BY day) a
+            WHERE daily_stats.day = a.day AND daily_stats.slot = 0
+        ''')
+        cur.execute(f'''
+            INSERT INTO stats_totals (id, users_count, active_users_count, total_balance, active_balance)
+            SELECT 1, COUNT(*),
+                   COUNT(*) FILTER (WHERE is_active),
+                   COALESCE(SUM({BALANCE_WITH_BUCKETS}), 0),
+                   COALESCE(SUM({BALANCE_WITH_BUCKETS}) FILTER (WHERE is_active), 0)
+            FROM users
+        ''')
+    else:
+        cur.execute('''
+            INSERT INTO daily_active_users (day, user_id)
+            SELECT DISTINCT DATE(date), user_id FROM transactions WHERE user_id IS NOT NULL
+        ''')
+        cur.execute('''
+            INSERT INTO daily_stats (day, slot, transactions_count, turnover)
+            SELECT DATE(date), 0, COUNT(*), COALESCE(SUM(CASE WHEN status = ? THEN amount ELSE 0 END), 0)
+            FROM transactions GROUP BY DATE(date)
+        ''', ('Успешно',))
+        # WHERE обязателен: без него SQLite путает ON CONFLICT с условием JOIN
+        cur.execute('''
+            INSERT INTO daily_stats (day, slot, new_users)
+            SELECT DATE(created_at), 0, COUNT(*) FROM users WHERE TRUE GROUP BY DATE(created_at)
+            ON CONFLICT (day, slot) DO UPDATE SET new_users = excluded.new_users
+        ''')
+        cur.execute('''
+            UPDATE daily_stats SET active_users = (
+                SELECT COUNT(*) FROM daily_active_users a WHERE a.day = daily_stats.day
+            ) WHERE slot = 0
+        ''')
+        cur.execute(f'''
+            INSERT INTO stats_totals (id, users_count, active_users_count, total_balance, active_balance)
+            SELECT 1, COUNT(*),
+                   COALESCE(SUM(CASE WHEN is_active THEN 1 ELSE 0 END), 0),
+                   COALESCE(SUM({BALANCE_WITH_BUCKETS}), 0),
+                   COALESCE(SUM(CASE WHEN is_active THEN {BALANCE_WITH_BUCKETS} ELSE 0 END), 0)
+            FROM users
+        ''')
+
+def get_today_stats(cur):
+    cur.execute('''
+        SELECT COALESCE(SUM(transactions_count), 0) AS transactions_count,
+               COALESCE(SUM(turnover), 0) AS turnover,
+               COALESCE(SUM(active_users), 0) AS active_users,
+               COALESCE(SUM(new_users), 0) AS new_users
+        FROM daily_stats WHERE day = CURRENT_DATE
+    ''')
+    return {k: int(v) for k, v in dict(cur.fetchone()).items()}
+
+def get_stats_totals(cur):
+    cur.execute('SELECT * FROM stats_totals WHERE id = 1')
+    row = cur.fetchone()
+    return dict(row) if row else {'users_count': 0, 'active_users_count': 0, 'total_balance': 0, 'active_balance': 0}
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """Пересчитать сводную статистику по всей истории операций."""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    begin_write_transaction(conn)
+    rebuild_stats(cur)
     conn.commit()
     cur.close()
     conn.close()
-    print("✅ База данных инициализирована")
+    print("✅ Сводная статистика пересчитана")
+
+# ==================== ПОИСК ПОЛЬЗОВАТЕЛЕЙ ====================
+# Автодополнение в админке ищет подстроку в ФИО, паспорте и номере счета.
+# LIKE '%...%' не использует B-tree индексы, поэтому:
+# - PostgreSQL: GIN-индекс pg_trgm по склейке трёх полей (ILIKE по каждому слову
+#   запроса), результаты с совпадением в начале поля — выше, дальше по
+#   word_similarity. Запрос короче 3 символов триграммы не покрывают — для него
+#   ищется начало ФИО по индексу lower(full_name) text_pattern_ops, а также
+#   начало паспорта и номера счета;
+# - SQLite: теневая FTS5-таблица users_search, которую синхронизируют триггеры
+#   на users; каждое слово запроса ищется как префикс, порядок — по bm25.
+# «ё» и «е» при поиске не различаются: в индексе и в запросе «ё» заменяется на «е».
+# Окончательно ранжируются только USER_SEARCH_CANDIDATES лучших совпадений: в
+# SQLite — по bm25 (ORDER BY rank внутри FTS5), в PostgreSQL — по расстоянию
+# word_similarity (<<->). Лучшие совпадения в кандидаты попадают всегда.
+# Без pg_trgm или FTS5 поиск работает прежним LIKE, только без индекса.
+
+USER_SEARCH_LIMIT = 20
+USER_SEARCH_CANDIDATES = 500
+USER_SEARCH_TEXT = "translate(full_name || ' ' || passport || ' ' || account_number, 'ёЁ', 'еЕ')"
+USER_SEARCH_PREFIX = "lower(translate(full_name, 'ёЁ', 'еЕ'))"
+USER_SEARCH_COLUMNS = '''
+    u.id, u.passport, u.full_name, u.account_number, u.balance, u.is_active,
+    CASE WHEN u.role_id <= 3 THEN 1 ELSE 0 END as is_admin
+'''
+_user_search_index = None
+
+def init_user_search(cur):
+    """Индексы для поиска пользователей (вызывается из create_schema)."""
+    if USE_POSTGRESQL:
+        cur.execute('SAVEPOINT user_search')
+        try:
+            cur.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        except psycopg2.Error as e:
+            cur.execute('ROLLBACK TO SAVEPOINT user_search')
+            print(f"⚠️ pg_trgm недоступен, поиск пользователей без индекса: {e}")
+            return
+        cur.execute('RELEASE SAVEPOINT user_search')
+        cur.execute(f'CREATE INDEX IF NOT EXISTS idx_users_search_trgm ON users USING gin (({USER_SEARCH_TEXT}) gin_trgm_ops)')
+        cur.execute(f'CREATE INDEX IF NOT EXISTS idx_users_full_name_prefix ON users (({USER_SEARCH_PREFIX}) text_pattern_ops)')
+        return
+
+    cur.execute("SELECT name FROM sqlite_master WHERE name = 'users_search'")
+    exists = cur.fetchone() is not None
+    try:
+        cur.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS users_search USING fts5(
+                full_name, passport, account_number,
+                tokenize='unicode61', prefix='2 3'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        print(f"⚠️ FTS5 недоступен, поиск пользователей без индекса: {e}")
+        return
+    normalized = "replace(replace({}.full_name, 'ё', 'е'), 'Ё', 'Е')"
+    cur.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS users_search_insert AFTER INSERT ON users BEGIN
+            INSERT INTO users_search (rowid, full_name, passport, account_number)
+            VALUES (new.id, {normalized.format('new')}, new.passport, new.account_number);
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_search_delete AFTER DELETE ON users BEGIN
+            DELETE FROM users_search WHERE rowid = old.id;
+        END
+    ''')
+    # Только при изменении индексируемых полей: обновления баланса индекс не трогают
+    cur.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS users_search_update AFTER UPDATE OF full_name, passport, account_number ON users
+        BEGIN
+            DELETE FROM users_search WHERE rowid = old.id;
+            INSERT INTO users_search (rowid, full_name, passport, account_number)
+            VALUES (new.id, {normalized.format('new')}, new.passport, new.account_number);
+        END
+    ''')
+    if not exists:
+        cur.execute(f'''
+            INSERT INTO users_search (rowid, full_name, passport, account_number)
+            SELECT id, {normalized.format('users')}, passport, account_number FROM users
+        ''')
+
+def user_search_indexed(cur):
+    """Есть ли в БД поисковый индекс (проверяется один раз на процесс)."""
+    global _user_search_index
+    if _user_search_index is None:
+        if USE_POSTGRESQL:
+            cur.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        else:
+            cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'users_search'")
+        _user_search_index = cur.fetchone() is not None
+    return _user_search_index
+
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def search_users(cur, query, limit=USER_SEARCH_LIMIT):
+    """Пользователи, подходящие под строку поиска, — самые релевантные первыми."""
+    words = re.findall(r'\w+', query.lower().replace('ё', 'е'))
+    if not words:
+        return []
+
+    if not user_search_indexed(cur):
+        pattern = f'%{escape_like(query)}%'
+        if USE_POSTGRESQL:
+            cur.execute(f'''
+                SELECT {USER_SEARCH_COLUMNS} FROM users u
+                WHERE passport ILIKE %s OR full_name ILIKE %s OR account_number ILIKE %s
+                LIMIT %s
+            ''', (pattern, pattern, pattern, limit))
+        else:
+            cur.execute(f'''
+                SELECT {USER_SEARCH_COLUMNS} FROM users u
+                WHERE passport LIKE ? ESCAPE '\\' OR full_name LIKE ? ESCAPE '\\' OR account_number LIKE ? ESCAPE '\\'
+                LIMIT ?
+            ''', (pattern, pattern, pattern, limit))
+        return cur.fetchall()
+
+    if not USE_POSTGRESQL:
+        # Каждое слово — префиксный поиск; слова объединяются через AND
+        match = ' '.join(f'"{word}"*' for word in words)
+        cur.execute(f'''
+            SELECT {USER_SEARCH_COLUMNS}
+            FROM (
+                SELECT rowid, rank FROM users_search WHERE users_search MATCH ? ORDER BY rank LIMIT ?
+            ) s
+            JOIN users u ON u.id = s.rowid
+            ORDER BY s.rank
+            LIMIT ?
+        ''', (match, USER_SEARCH_CANDIDATES, limit))
+        return cur.fetchall()
+
+    text = ' '.join(words)
+    if len(text) < 3:
+        cur.execute(f'''
+            SELECT {USER_SEARCH_COLUMNS} FROM users u
+            WHERE {USER_SEARCH_PREFIX} LIKE %s OR passport ILIKE %s OR account_number ILIKE %s
+            ORDER BY full_name
+            LIMIT %s
+        ''', (escape_like(text) + '%', escape_like(text) + '%', escape_like(text) + '%', limit))
+        return cur.fetchall()
+
+    conditions = ' AND '.join([f'{USER_SEARCH_TEXT} ILIKE %s'] * len(words))
+    prefix = escape_like(text) + '%'
+    cur.execute(f'''
+        SELECT {USER_SEARCH_COLUMNS} FROM (
+            SELECT * FROM users WHERE {conditions}
+            ORDER BY %s <<-> {USER_SEARCH_TEXT}
+            LIMIT %s
+        ) u
+        ORDER BY (u.full_name ILIKE %s OR u.passport ILIKE %s OR u.account_number ILIKE %s) DESC,
+                 word_similarity(%s, {USER_SEARCH_TEXT}) DESC,
+                 u.full_name
+        LIMIT %s
+    ''', [f'%{escape_like(word)}%' for word in words] + [text, USER_SEARCH_CANDIDATES, prefix, prefix, prefix, text,
+                                                          limit])
+    return cur.fetchall()
 
 # ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
 
 def find_user_by_passport(passport):
     conn = get_db_connection()
     cur = conn.cursor()
-    if USE_POSTGRESQL:
-        cur.execute('''
-            SELECT u.*, r.role_name, r.level, r.permissions 
-            FROM users u
-            LEFT JOIN roles r ON u.role_id = r.id
-            WHERE u.passport = %s
-        ''', (passport,))
-    else:
-        cur.execute('''
-            SELECT u.*, r.role_name, r.level, r.permissions 
-            FROM users u
-            LEFT JOIN roles r ON u.role_id = r.id
-            WHERE u.passport = ?
-        ''', (passport,))
-    user = cur.fetchone()
+    execute_prepared(cur, 'user_by_passport', (passport,))
+    user = with_pending_credits(cur, cur.fetchone())
     cur.close()
     conn.close()
-    return dict(user) if user else None
+    return user
 
 def find_user_by_account(account_number):
     conn = get_db_connection()
     cur = conn.cursor()
-    if USE_POSTGRESQL:
-        cur.execute('SELECT * FROM users WHERE account_number = %s', (account_number,))
-    else:
-        cur.execute('SELECT * FROM users WHERE account_number = ?', (account_number,))
-    user = cur.fetchone()
+    execute_prepared(cur, 'user_by_account', (account_number,))
+    user = with_pending_credits(cur, cur.fetchone())
     cur.close()
     conn.close()
-    return dict(user) if user else None
+    return user
 
 def find_user_by_id(user_id):
     conn = get_db_connection()
     cur = conn.cursor()
-    if USE_POSTGRESQL:
-        cur.execute('SELECT * FROM users WHERE id = %s', (user_id,))
-    else:
-        cur.execute('SELECT * FROM users WHERE id = ?', (user_id,))
-    user = cur.fetchone()
+    execute(cur, 'SELECT * FROM users WHERE id = ?', (user_id,))
+    user = with_pending_credits(cur, cur.fetchone())
     cur.close()
     conn.close()
-    return dict(user) if user else None
+    return user
 
 def get_user_role(user_id):
     conn = get_db_connection()
     cur = conn.cursor()
-    if USE_POSTGRESQL:
-        cur.execute('''
-            SELECT r.* FROM roles r
-            JOIN users u ON r.id = u.role_id
-            WHERE u.id = %s
-        ''', (user_id,))
-    else:
-        cur.execute('''
-            SELECT r.* FROM roles r
-            JOIN users u ON r.id = u.role_id
-            WHERE u.id = ?
-        ''', (user_id,))
-    role = cur.fetchone()
+    role = fetch_one(cur, '''
+        SELECT r.* FROM roles r
+        JOIN users u ON r.id = u.role_id
+        WHERE u.id = ?
+    ''', (user_id,))
     cur.close()
     conn.close()
     return dict(role) if role else None
 
+def get_user_role_id(user_id):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    row = fetch_one(cur, 'SELECT role_id FROM users WHERE id = ?', (user_id,))
+    cur.close()
+    conn.close()
+    return row['role_id'] if row else None
+
 def get_role_by_name(role_name):
     conn = get_db_connection()
     cur = conn.cursor()
-    if USE_POSTGRESQL:
-        cur.execute('SELECT * FROM roles WHERE role_name = %s', (role_name,))
-    else:
-        cur.execute('SELECT * FROM roles WHERE role_name = ?', (role_name,))
-    role = cur.fetchone()
+    role = fetch_one(cur, 'SELECT * FROM roles WHERE role_name = ?', (role_name,))
     cur.close()
     conn.close()
     return dict(role) if role else None
@@ -606,11 +1472,7 @@ def get_role_by_name(role_name):
 def get_role_by_id(role_id):
     conn = get_db_connection()
     cur = conn.cursor()
-    if USE_POSTGRESQL:
-        cur.execute('SELECT * FROM roles WHERE id = %s', (role_id,))
-    else:
-        cur.execute('SELECT * FROM roles WHERE id = ?', (role_id,))
-    role = cur.fetchone()
+    role = fetch_one(cur, 'SELECT * FROM roles WHERE id = ?', (role_id,))
     cur.close()
     conn.close()
     return dict(role) if role else None
@@ -643,115 +1505,492 @@ def update_user_balance(account_number, new_balance):
     conn = get_db_connection()
     cur = conn.cursor()
     if USE_POSTGRESQL:
-        cur.execute('UPDATE users SET balance = %s WHERE account_number = %s', (new_balance, account_number))
+        cur.execute('SELECT id, balance, is_active, balance_buckets FROM users WHERE account_number = %s FOR UPDATE',
+                    (account_number,))
     else:
-        cur.execute('UPDATE users SET balance = ? WHERE account_number = ?', (new_balance, account_number))
+        begin_write_transaction(conn)
+        cur.execute('SELECT id, balance, is_active, balance_buckets FROM users WHERE account_number = ?',
+                    (account_number,))
+    user = cur.fetchone()
+    if user:
+        user = dict(user)
+        # Новый баланс задаётся целиком — несвёрнутые корзины сначала переносятся в него
+        user['balance'] += fold_balance_buckets(cur, user['id'])
+        execute(cur, 'UPDATE users SET balance = ? WHERE account_number = ?', (new_balance, account_number))
+        delta = new_balance - user['balance']
+        record_balance_change(cur, delta, delta if user['is_active'] else 0)
+        balances_changed(cur, [account_number])
     conn.commit()
     cur.close()
     conn.close()
 
-def add_transaction(transaction_type, from_account, to_account, amount, status, description, user_id=None):
-    conn = get_db_connection()
-    cur = conn.cursor()
+def insert_transaction(cur, transaction_type, from_account, to_account, amount, status, description, user_id=None):
+    """Добавляет запись в журнал транзакций в рамках уже открытой транзакции (без commit)."""
+    execute_prepared(cur, 'insert_transaction',
+                     (transaction_type, from_account, to_account, amount, status, description, user_id))
+    record_transaction_stats(cur, 1, amount if status == 'Успешно' else 0, [user_id] if user_id else [])
+
+# ==================== ФИЛЬТРЫ ПО ДАТАМ ====================
+# Условие DATE(column) = ? заставляет вычислять функцию для каждой строки и не
+# может использовать индекс по column. Фильтр по дням превращается в
+# полуоткрытый диапазон column >= начало AND column < начало следующего дня —
+# он идёт по индексу в SQLite и PostgreSQL одинаково.
+
+def parse_day(value):
+    """'YYYY-MM-DD' -> date. Бросает ValueError для неверной даты."""
+    try:
+        return datetime.strptime(value.strip(), '%Y-%m-%d').date()
+    except (AttributeError, ValueError):
+        raise ValueError('Неверная дата')
+
+def date_range_filter(column, date_from=None, date_to=None):
+    """
+    Условие ' AND ...' и параметры для дней [date_from, date_to] включительно.
+    Пустые границы пропускаются. Бросает ValueError для неверной даты.
+    """
+    condition = ''
+    params = []
+    if date_from:
+        condition += f' AND {column} >= ?'
+        params.append(parse_day(date_from).isoformat())
+    if date_to:
+        condition += f' AND {column} < ?'
+        params.append((parse_day(date_to) + timedelta(days=1)).isoformat())
+    return condition, params
+
+# ==================== ИСТОРИЯ ОПЕРАЦИЙ (ПОСТРАНИЧНО) ====================
+# Страницы листаются по ключу (date, id), а не через OFFSET: курсор хранит
+# дату и id последней показанной операции, и следующая страница начинается
+# сразу после неё по индексу — N-я страница стоит столько же, сколько первая.
+
+HISTORY_PAGE_MAX = 100
+
+def encode_history_cursor(row):
+    """Непрозрачный курсор следующей страницы по последней строке текущей."""
+    date = row['date']
+    if isinstance(date, datetime):
+        date = date.isoformat(sep=' ')
+    payload = json.dumps([str(date), row['id']]).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip('=')
+
+def decode_history_cursor(cursor):
+    """Курсор -> (date, id). Бросает ValueError для испорченного курсора."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        date, row_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return str(date), int(row_id)
+    except (ValueError, TypeError, binascii.Error):
+        raise ValueError('Неверный курсор')
+
+def parse_page_limit(value, default):
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(limit, HISTORY_PAGE_MAX))
+
+def split_history_page(rows, limit):
+    """Запрос выбирает limit + 1 строк: лишняя строка означает, что есть следующая страница."""
+    rows = [dict(r) for r in rows]
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, encode_history_cursor(rows[-1])
+    return rows, None
+
+def account_history_query(account_number, limit, cursor=None, with_names=False):
+    """
+    Запрос истории счета: (sql, params).
+
+    Условие «from_account = X OR to_account = X» не использует индексы, поэтому
+    стороны выбираются отдельно — каждая по своему индексу и сразу с LIMIT, —
+    склеиваются через UNION ALL и уже потом сортируются и обрезаются до limit.
+    Операция со счета на себя попадает только в исходящую ветку.
+    В строках есть поле direction ('outgoing'/'incoming'), а с with_names —
+    from_name и to_name (JOIN делается только для итоговых limit строк).
+    """
+    keyset = ' AND (date, id) < (?, ?)' if cursor else ''
+    keyset_params = list(decode_history_cursor(cursor)) if cursor else []
+    not_sender = 'from_account IS DISTINCT FROM ?' if USE_POSTGRESQL else 'from_account IS NOT ?'
+
+    query = f'''
+        SELECT * FROM (
+            SELECT t.*, 'outgoing' AS direction FROM transactions t
+            WHERE from_account = ?{keyset}
+            ORDER BY date DESC, id DESC LIMIT ?
+        ) sent
+        UNION ALL
+        SELECT * FROM (
+            SELECT t.*, 'incoming' AS direction FROM transactions t
+            WHERE to_account = ? AND {not_sender}{keyset}
+            ORDER BY date DESC, id DESC LIMIT ?
+        ) received
+    '''
+    params = [account_number] + keyset_params + [limit,
+              account_number, account_number] + keyset_params + [limit]
+
+    if with_names:
+        query = f'''
+            SELECT h.*, u_from.full_name AS from_name, u_to.full_name AS to_name
+            FROM (
+                SELECT * FROM ({query}) merged ORDER BY date DESC, id DESC LIMIT ?
+            ) h
+            LEFT JOIN users u_from ON h.from_account = u_from.account_number
+            LEFT JOIN users u_to ON h.to_account = u_to.account_number
+            ORDER BY h.date DESC, h.id DESC
+        '''
+    else:
+        query = f'SELECT * FROM ({query}) h ORDER BY date DESC, id DESC LIMIT ?'
+    params.append(limit)
+    return query, params
+
+def get_account_history_stats(cur, account_number):
+    """Итоги по счету: агрегаты считаются отдельно по каждой стороне и складываются."""
     if USE_POSTGRESQL:
         cur.execute('''
-            INSERT INTO transactions (type, from_account, to_account, amount, status, description, user_id)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-        ''', (transaction_type, from_account, to_account, amount, status, description, user_id))
+            SELECT COUNT(*) AS cnt, COALESCE(SUM(amount), 0) AS total, MAX(date) AS last
+            FROM transactions WHERE from_account = %s
+            UNION ALL
+            SELECT COUNT(*), COALESCE(SUM(amount), 0), MAX(date)
+            FROM transactions WHERE to_account = %s AND from_account IS DISTINCT FROM %s
+        ''', (account_number, account_number, account_number))
     else:
         cur.execute('''
-            INSERT INTO transactions (type, from_account, to_account, amount, status, description, user_id)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (transaction_type, from_account, to_account, amount, status, description, user_id))
-    conn.commit()
-    cur.close()
-    conn.close()
+            SELECT COUNT(*) AS cnt, COALESCE(SUM(amount), 0) AS total, MAX(date) AS last
+            FROM transactions WHERE from_account = ?
+            UNION ALL
+            SELECT COUNT(*), COALESCE(SUM(amount), 0), MAX(date)
+            FROM transactions WHERE to_account = ? AND from_account IS NOT ?
+        ''', (account_number, account_number, account_number))
+    sent, received = cur.fetchall()
+    last_dates = [d for d in (sent['last'], received['last']) if d is not None]
+    return {
+        'total_transactions': sent['cnt'] + received['cnt'],
+        'total_sent': int(sent['total']),
+        'total_received': int(received['total']),
+        'last_transaction': max(last_dates) if last_dates else None
+    }
+
+def get_user_transactions_page(account_number, limit=10, cursor=None):
+    """Страница истории операций счета (новые сверху) и курсор следующей страницы или None."""
+    query, params = account_history_query(account_number, limit + 1, cursor)
 
-def get_user_transactions(account_number, limit=10):
     conn = get_db_connection()
     cur = conn.cursor()
-    if USE_POSTGRESQL:
-        cur.execute('''
-            SELECT * FROM transactions
-            WHERE from_account = %s OR to_account = %s
-            ORDER BY date DESC
-            LIMIT %s
-        ''', (account_number, account_number, limit))
-    else:
-        cur.execute('''
-            SELECT * FROM transactions
-            WHERE from_account = ? OR to_account = ?
-            ORDER BY date DESC
-            LIMIT ?
-        ''', (account_number, account_number, limit))
-    transactions = cur.fetchall()
+    transactions = fetch_all(cur, query, params)
     cur.close()
     conn.close()
-    return [dict(t) for t in transactions]
+    return split_history_page(transactions, limit)
 
-def check_permission(user_id, permission):
-    role = get_user_role(user_id)
-    if not role:
-        return False
-    if role['role_name'] == 'super_admin':
-        return True
-    try:
-        permissions = json.loads(role['permissions'])
-        if permissions.get('all_permissions'):
-            return True
-        return permissions.get(permission, False)
-    except:
-        return False
+def get_user_transactions(account_number, limit=10):
+    return get_user_transactions_page(account_number, limit)[0]
 
-# ==================== EMAIL ФУНКЦИИ (без изменений) ====================
-def send_email(to_email, subject, body, html_body=None):
-    """Отправка email через SMTP (заглушка для отладки)."""
-    try:
-        print(f"\n{'='*60}")
-        print(f"📧 EMAIL НА: {to_email}")
-        print(f"📋 ТЕМА: {subject}")
-        print(f"📝 СОДЕРЖИМОЕ:\n{body}")
-        print(f"{'='*60}\n")
-        return True
-    except Exception as e:
-        print(f"❌ Ошибка отправки email: {e}")
-        return False
+# ==================== ПЕРЕВОДЫ ====================
 
-def send_business_approval_email(to_email, business_name, account_number, password, capital):
-    subject = f"Ваша заявка на бизнес '{business_name}' одобрена"
-    body = f"""
-    Уважаемый владелец бизнеса,
-    Ваша заявка на создание бизнеса "{business_name}" была одобрена.
-    Данные для входа: логин BUS{account_number}, пароль {password}.
-    Информация о счете: номер {account_number}, уставной капитал {capital} ₽.
-    """
-    return send_email(to_email, subject, body)
+class TransferError(Exception):
+    """Перевод отклонён; текст ошибки показывается пользователю."""
 
-def send_business_rejection_email(to_email, business_name, reason):
-    subject = f"Заявка на бизнес '{business_name}' отклонена"
-    body = f"Уважаемый заявитель, ваша заявка на создание бизнеса \"{business_name}\" отклонена. Причина: {reason}"
-    return send_email(to_email, subject, body)
+def begin_write_transaction(conn):
+    """Начинает пишущую транзакцию.
 
-def send_withdrawal_notification_email(to_email, amount, status, notes=None):
-    status_text = "одобрена" if status == 'approved' else "отклонена"
-    subject = f"Заявка на вывод средств {status_text}"
-    body = f"Ваша заявка на вывод {amount} ₽ {status_text}. {notes or ''}"
-    return send_email(to_email, subject, body)
+    В SQLite сразу берём блокировку записи (BEGIN IMMEDIATE), чтобы чтение баланса
+    и его изменение не разделял чужой коммит. В PostgreSQL транзакция начинается
+    неявно, а нужные строки блокируются через SELECT ... FOR UPDATE.
+    """
+    if not USE_POSTGRESQL and not conn.in_transaction:
+        conn.execute('BEGIN IMMEDIATE')
 
-# ==================== БИЗНЕС-ФУНКЦИИ (с поддержкой PostgreSQL RETURNING) ====================
+def execute_transfer(from_account, to_account, amount, description='', user_id=None):
+    """Переводит amount копеек между счетами одной транзакцией: списание, зачисление и запись в журнал.
+
+    Возвращает словарь с данными отправителя, получателя и новым балансом отправителя.
+    При отказе выбрасывает TransferError, ничего не изменив.
+    """
+    if amount <= 0:
+        raise TransferError('Неверная сумма')
+    if from_account == to_account:
+        raise TransferError('Нельзя перевести средства на тот же счет')
 
-def create_business_application(user_id, business_name, charter_capital, legal_name=None, tax_id=None,
-                                address=None, email=None, phone=None):
     conn = get_db_connection()
     cur = conn.cursor()
     try:
+        begin_write_transaction(conn)
+        # Блокируем обе строки в порядке номеров счетов, чтобы встречные переводы не взаимоблокировались
         if USE_POSTGRESQL:
+            execute_prepared(cur, 'lock_transfer_accounts', (from_account, to_account))
+        else:
             cur.execute('''
-                INSERT INTO businesses (user_id, business_name, charter_capital, legal_name, tax_id,
-                                        address, email, phone, status)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 'pending')
-                RETURNING id
-            ''', (user_id, business_name, charter_capital, legal_name, tax_id, address, email, phone))
+                SELECT id, passport, full_name, account_number, balance, is_active, balance_buckets
+                FROM users
+                WHERE account_number IN (?, ?)
+                ORDER BY account_number
+            ''', (from_account, to_account))
+        accounts = {row['account_number']: dict(row) for row in cur.fetchall()}
+        from_user = accounts.get(from_account)
+        to_user = accounts.get(to_account)
+
+        if not from_user or not to_user:
+            raise TransferError('Счет не найден')
+        if from_user['balance_buckets']:
+            from_user['balance'] += fold_balance_buckets(cur, from_user['id'])
+        if from_user['balance'] < amount:
+            raise TransferError('Недостаточно средств')
+        if not from_user['is_active'] or not to_user['is_active']:
+            raise TransferError('Счет заблокирован')
+
+        # Относительные обновления: баланс изменяется в БД, а не перезаписывается значением из Python
+        execute_prepared(cur, 'debit_balance', (amount, from_user['id'], amount))
+        if cur.rowcount != 1:
+            raise TransferError('Недостаточно средств')
+        execute_prepared(cur, 'credit_balance', (amount, to_user['id']))
+
+        insert_transaction(cur, 'Перевод', from_account, to_account, amount, 'Успешно', description,
+                           user_id or from_user['id'])
+        balances_changed(cur, [from_account, to_account])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+    return {
+        'from_user': from_user,
+        'to_user': to_user,
+        'new_from_balance': from_user['balance'] - amount
+    }
+
+def execute_deposit(account_number, amount, description):
+    """Зачисляет amount копеек на счет от имени системы: баланс и запись в журнал в одной транзакции.
+
+    Возвращает пользователя-получателя или None, если счет не найден.
+    """
+    if amount <= 0:
+        raise TransferError('Неверная сумма')
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        execute(cur, 'UPDATE users SET balance = balance + ? WHERE account_number = ?', (amount, account_number))
+        if cur.rowcount != 1:
+            conn.rollback()
+            return None
+        execute(cur, 'SELECT id, account_number, balance, is_active FROM users WHERE account_number = ?',
+                     (account_number,))
+        user = dict(cur.fetchone())
+        insert_transaction(cur, 'Начисление', 'Система', account_number, amount, 'Успешно', description, user['id'])
+        record_balance_change(cur, amount, amount if user['is_active'] else 0)
+        balances_changed(cur, [account_number])
+        conn.commit()
+        return user
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+# Ограничение на размер одного пакета выплат
+BATCH_TRANSFER_MAX_ROWS = int(os.environ.get('BATCH_TRANSFER_MAX_ROWS', 10000))
+# SQLite ограничивает число параметров в запросе, поэтому IN (...) разбиваем на части
+SQLITE_IN_CHUNK = 500
+
+def execute_batch_transfer(from_user_id, rows, transaction_type='Перевод'):
+    """Пакетный перевод (зарплатная ведомость) с одного счета на множество счетов.
+
+    Суммы в строках rows указываются в рублях, в результатах возвращаются в копейках.
+
+    Все получатели проверяются одним запросом, счет отправителя списывается один раз,
+    зачисления и записи в журнал вставляются пачкой, всё в одной транзакции.
+    Строки с ошибками (неверная сумма, счет не найден или заблокирован) пропускаются;
+    нехватка средств или блокировка отправителя отклоняет весь пакет (TransferError).
+    """
+    if len(rows) > BATCH_TRANSFER_MAX_ROWS:
+        raise TransferError(f'Слишком много строк в пакете (максимум {BATCH_TRANSFER_MAX_ROWS})')
+
+    results = []
+    for index, row in enumerate(rows):
+        if not isinstance(row, dict):
+            row = {}
+        to_account = str(row.get('to_account') or '').strip()
+        try:
+            amount = to_minor(row.get('amount'))
+        except ValueError:
+            amount = None
+        result = {
+            'row': index,
+            'to_account': to_account,
+            'amount': amount,
+            'description': str(row.get('description') or ''),
+            'status': 'ok'
+        }
+        if not to_account:
+            result.update(status='error', error='Не указан счет получателя')
+        elif amount is None or amount <= 0:
+            result.update(status='error', error='Неверная сумма')
+        results.append(result)
+
+    accounts = sorted({r['to_account'] for r in results if r['status'] == 'ok'})
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        begin_write_transaction(conn)
+        # Отправитель и все получатели одним запросом; в PostgreSQL строки блокируются
+        # в порядке номеров счетов — так же, как в execute_transfer
+        if USE_POSTGRESQL:
+            cur.execute('''
+                SELECT id, account_number, balance, is_active, balance_buckets
+                FROM users
+                WHERE id = %s OR account_number = ANY(%s)
+                ORDER BY account_number
+                FOR UPDATE
+            ''', (from_user_id, accounts))
+            found = [dict(r) for r in cur.fetchall()]
+        else:
+            cur.execute('SELECT id, account_number, balance, is_active, balance_buckets FROM users WHERE id = ?',
+                        (from_user_id,))
+            found = [dict(r) for r in cur.fetchall()]
+            for start in range(0, len(accounts), SQLITE_IN_CHUNK):
+                chunk = accounts[start:start + SQLITE_IN_CHUNK]
+                placeholders = ','.join(['?'] * len(chunk))
+                cur.execute(f'''
+                    SELECT id, account_number, balance, is_active
+                    FROM users
+                    WHERE account_number IN ({placeholders})
+                ''', chunk)
+                found.extend(dict(r) for r in cur.fetchall())
+
+        from_user = next((u for u in found if u['id'] == from_user_id), None)
+        if not from_user:
+            raise TransferError('Счет не найден')
+        if not from_user['is_active']:
+            raise TransferError('Счет заблокирован')
+        if from_user.get('balance_buckets'):
+            from_user['balance'] += fold_balance_buckets(cur, from_user['id'])
+        by_account = {u['account_number']: u for u in found}
+
+        credits = defaultdict(int)
+        for result in results:
+            if result['status'] != 'ok':
+                continue
+            recipient = by_account.get(result['to_account'])
+            if not recipient:
+                result.update(status='error', error='Счет не найден')
+            elif not recipient['is_active']:
+                result.update(status='error', error='Счет заблокирован')
+            elif recipient['id'] == from_user['id']:
+                result.update(status='error', error='Нельзя перевести средства на тот же счет')
+            else:
+                credits[result['to_account']] += result['amount']
+
+        total = sum(credits.values())
+        if from_user['balance'] < total:
+            raise TransferError('Недостаточно средств')
+
+        ok_rows = [r for r in results if r['status'] == 'ok']
+        if ok_rows:
+            execute(cur, 'UPDATE users SET balance = balance - ? WHERE id = ? AND balance >= ?',
+                         (total, from_user['id'], total))
+            if cur.rowcount != 1:
+                raise TransferError('Недостаточно средств')
+
+            ledger = [(transaction_type, from_user['account_number'], r['to_account'], r['amount'],
+                       'Успешно', r['description'], from_user['id']) for r in ok_rows]
+            if USE_POSTGRESQL:
+                execute_values(cur, '''
+                    UPDATE users AS u SET balance = u.balance + v.amount
+                    FROM (VALUES %s) AS v(account_number, amount)
+                    WHERE u.account_number = v.account_number
+                ''', sorted(credits.items()))
+                execute_values(cur, '''
+                    INSERT INTO transactions (type, from_account, to_account, amount, status, description, user_id)
+                    VALUES %s
+                ''', ledger, page_size=1000)
+            else:
+                cur.executemany('UPDATE users SET balance = balance + ? WHERE account_number = ?',
+                                [(amount, account) for account, amount in sorted(credits.items())])
+                cur.executemany('''
+                    INSERT INTO transactions (type, from_account, to_account, amount, status, description, user_id)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', ledger)
+            record_transaction_stats(cur, len(ledger), total, [from_user['id']])
+            balances_changed(cur, [from_user['account_number']] + list(credits))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+    return {
+        'from_user': from_user,
+        'total': total,
+        'processed': len(ok_rows),
+        'failed': len(results) - len(ok_rows),
+        'new_balance': from_user['balance'] - total,
+        'results': results
+    }
+
+def check_permission(user_id, permission):
+    if has_request_context() and session.get('user_id') == user_id:
+        role = session_role()
+    else:
+        role = find_role(get_user_role_id(user_id))
+    if not role:
+        return False
+    if role.role_name == 'super_admin':
+        return True
+    return 'all_permissions' in role.permissions or permission in role.permissions
+
+# ==================== EMAIL ФУНКЦИИ ====================
+# Обработчики не ждут SMTP: send_email кладёт письмо в таблицу email_outbox в той
+# же транзакции, что и само действие, — письмо уйдёт, только если одобрение или
+# отклонение зафиксировано. Доставляет очередь фоновая задача deliver_emails
+# (раздел «ДОСТАВКА ПИСЕМ»).
+
+def send_email(cur, to_email, subject, body, html_body=None):
+    """Ставит письмо в очередь на отправку (без commit)."""
+    execute(cur, '''
+        INSERT INTO email_outbox (to_email, subject, body, html_body, next_attempt_at) VALUES (?, ?, ?, ?, ?)
+    ''', (to_email, subject, body, html_body, datetime.now()))
+    return True
+
+def send_business_approval_email(cur, to_email, business_name, account_number, password, capital):
+    subject = f"Ваша заявка на бизнес '{business_name}' одобрена"
+    body = f"""
+    Уважаемый владелец бизнеса,
+    Ваша заявка на создание бизнеса "{business_name}" была одобрена.
+    Данные для входа: логин BUS{account_number}, пароль {password}.
+    Информация о счете: номер {account_number}, уставной капитал {format_money(capital)} ₽.
+    """
+    return send_email(cur, to_email, subject, body)
+
+def send_business_rejection_email(cur, to_email, business_name, reason):
+    subject = f"Заявка на бизнес '{business_name}' отклонена"
+    body = f"Уважаемый заявитель, ваша заявка на создание бизнеса \"{business_name}\" отклонена. Причина: {reason}"
+    return send_email(cur, to_email, subject, body)
+
+def send_withdrawal_notification_email(cur, to_email, amount, status, notes=None):
+    status_text = "одобрена" if status == 'approved' else "отклонена"
+    subject = f"Заявка на вывод средств {status_text}"
+    body = f"Ваша заявка на вывод {format_money(amount)} ₽ {status_text}. {notes or ''}"
+    return send_email(cur, to_email, subject, body)
+
+# ==================== БИЗНЕС-ФУНКЦИИ (с поддержкой PostgreSQL RETURNING) ====================
+
+def create_business_application(user_id, business_name, charter_capital, legal_name=None, tax_id=None,
+                                address=None, email=None, phone=None):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        if USE_POSTGRESQL:
+            cur.execute('''
+                INSERT INTO businesses (user_id, business_name, charter_capital, legal_name, tax_id,
+                                        address, email, phone, status)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 'pending')
+                RETURNING id
+            ''', (user_id, business_name, charter_capital, legal_name, tax_id, address, email, phone))
             application_id = cur.fetchone()['id']
         else:
             cur.execute('''
@@ -762,25 +2001,10 @@ def create_business_application(user_id, business_name, charter_capital, legal_n
             application_id = cur.lastrowid
         conn.commit()
         # Логирование в аудит
-        if USE_POSTGRESQL:
-            cur.execute("SELECT * FROM users WHERE id = %s", (user_id,))
-        else:
-            cur.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-        user = cur.fetchone()
-        if USE_POSTGRESQL:
-            cur.execute('''
-                INSERT INTO audit_log (admin_passport, admin_name, action, target_user, details)
-                VALUES (%s, %s, %s, %s, %s)
-            ''', ('SYSTEM', 'Система', 'Подача заявки на бизнес',
-                  user['passport'] if user else str(user_id),
-                  f'Название: {business_name}, Уставной капитал: {charter_capital}'))
-        else:
-            cur.execute('''
-                INSERT INTO audit_log (admin_passport, admin_name, action, target_user, details)
-                VALUES (?, ?, ?, ?, ?)
-            ''', ('SYSTEM', 'Система', 'Подача заявки на бизнес',
-                  user['passport'] if user else str(user_id),
-                  f'Название: {business_name}, Уставной капитал: {charter_capital}'))
+        user = fetch_one(cur, "SELECT * FROM users WHERE id = ?", (user_id,))
+        audit('Подача заявки на бизнес', user['passport'] if user else str(user_id),
+              f'Название: {business_name}, Уставной капитал: {format_money(charter_capital)}',
+              cur=cur, admin_passport='SYSTEM', admin_name='Система')
         conn.commit()
         return application_id
     except Exception as e:
@@ -802,14 +2026,10 @@ def get_business_applications(status=None):
     '''
     params = []
     if status:
-        query += ' WHERE b.status = %s' if USE_POSTGRESQL else ' WHERE b.status = ?'
+        query += ' WHERE b.status = ?'
         params.append(status)
     query += ' ORDER BY b.created_at DESC'
-    if USE_POSTGRESQL:
-        cur.execute(query, params)
-    else:
-        cur.execute(query, params)
-    applications = cur.fetchall()
+    applications = fetch_all(cur, query, params)
     cur.close()
     conn.close()
     return [dict(app) for app in applications]
@@ -817,21 +2037,12 @@ def get_business_applications(status=None):
 def get_business_by_id(business_id):
     conn = get_db_connection()
     cur = conn.cursor()
-    if USE_POSTGRESQL:
-        cur.execute('''
-            SELECT b.*, u.passport, u.full_name, u.email as user_email
-            FROM businesses b
-            JOIN users u ON b.user_id = u.id
-            WHERE b.id = %s
-        ''', (business_id,))
-    else:
-        cur.execute('''
-            SELECT b.*, u.passport, u.full_name, u.email as user_email
-            FROM businesses b
-            JOIN users u ON b.user_id = u.id
-            WHERE b.id = ?
-        ''', (business_id,))
-    business = cur.fetchone()
+    business = fetch_one(cur, '''
+        SELECT b.*, u.passport, u.full_name, u.email as user_email
+        FROM businesses b
+        JOIN users u ON b.user_id = u.id
+        WHERE b.id = ?
+    ''', (business_id,))
     cur.close()
     conn.close()
     return dict(business) if business else None
@@ -841,46 +2052,26 @@ def approve_business_application(business_id, admin_id, admin_notes=None):
     cur = conn.cursor()
     try:
         # Обновляем статус
-        if USE_POSTGRESQL:
-            cur.execute('''
-                UPDATE businesses
-                SET status = 'approved', approved_by = %s, approved_at = CURRENT_TIMESTAMP,
-                    admin_notes = %s, updated_at = CURRENT_TIMESTAMP
-                WHERE id = %s
-            ''', (admin_id, admin_notes, business_id))
-        else:
-            cur.execute('''
-                UPDATE businesses
-                SET status = 'approved', approved_by = ?, approved_at = CURRENT_TIMESTAMP,
-                    admin_notes = ?, updated_at = CURRENT_TIMESTAMP
-                WHERE id = ?
-            ''', (admin_id, admin_notes, business_id))
+        execute(cur, '''
+            UPDATE businesses
+            SET status = 'approved', approved_by = ?, approved_at = CURRENT_TIMESTAMP,
+                admin_notes = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (admin_id, admin_notes, business_id))
 
         # Получаем данные бизнеса
-        if USE_POSTGRESQL:
-            cur.execute('SELECT * FROM businesses WHERE id = %s', (business_id,))
-        else:
-            cur.execute('SELECT * FROM businesses WHERE id = ?', (business_id,))
+        execute(cur, 'SELECT * FROM businesses WHERE id = ?', (business_id,))
         business = row_to_dict(cur.fetchone())
 
         # Создаём бизнес-счёт
         account_number = f'BUS{random.randint(100000, 999999)}'
-        if USE_POSTGRESQL:
-            cur.execute('''
-                INSERT INTO business_accounts (business_id, account_number, balance)
-                VALUES (%s, %s, %s)
-            ''', (business_id, account_number, business['charter_capital']))
-        else:
-            cur.execute('''
-                INSERT INTO business_accounts (business_id, account_number, balance)
-                VALUES (?, ?, ?)
-            ''', (business_id, account_number, business['charter_capital']))
+        execute(cur, '''
+            INSERT INTO business_accounts (business_id, account_number, balance)
+            VALUES (?, ?, ?)
+        ''', (business_id, account_number, business['charter_capital']))
 
         # Получаем данные пользователя
-        if USE_POSTGRESQL:
-            cur.execute('SELECT * FROM users WHERE id = %s', (business['user_id'],))
-        else:
-            cur.execute('SELECT * FROM users WHERE id = ?', (business['user_id'],))
+        execute(cur, 'SELECT * FROM users WHERE id = ?', (business['user_id'],))
         user = row_to_dict(cur.fetchone())
 
         # Генерируем пароль для бизнес-аккаунта
@@ -918,30 +2109,21 @@ def approve_business_application(business_id, admin_id, admin_notes=None):
                 business.get('phone') or user['phone']
             ))
             business_user_id = cur.lastrowid
+        record_new_user(cur, business['charter_capital'])
+        invalidate_account_cache(cur, [account_number])
 
         # Логируем в аудит
-        if USE_POSTGRESQL:
-            cur.execute('''
-                INSERT INTO audit_log (admin_passport, admin_name, action, target_user, details)
-                VALUES (%s, %s, %s, %s, %s)
-            ''', ('SYSTEM', 'Система', 'Создание бизнес-аккаунта',
-                  user['passport'],
-                  f'Бизнес: {business["business_name"]}, Счет: {account_number}'))
-        else:
-            cur.execute('''
-                INSERT INTO audit_log (admin_passport, admin_name, action, target_user, details)
-                VALUES (?, ?, ?, ?, ?)
-            ''', ('SYSTEM', 'Система', 'Создание бизнес-аккаунта',
-                  user['passport'],
-                  f'Бизнес: {business["business_name"]}, Счет: {account_number}'))
-
-        conn.commit()
+        audit('Создание бизнес-аккаунта', user['passport'],
+              f'Бизнес: {business["business_name"]}, Счет: {account_number}',
+              cur=cur, admin_passport='SYSTEM', admin_name='Система')
 
         email_to = business.get('email') or user.get('email')
         if email_to:
-            send_business_approval_email(email_to, business['business_name'], account_number,
+            send_business_approval_email(cur, email_to, business['business_name'], account_number,
                                          business_password, business['charter_capital'])
 
+        conn.commit()
+
         return {
             'business_id': business_id,
             'account_number': account_number,
@@ -959,51 +2141,26 @@ def reject_business_application(business_id, admin_id, admin_notes):
     conn = get_db_connection()
     cur = conn.cursor()
     try:
-        if USE_POSTGRESQL:
-            cur.execute('''
-                UPDATE businesses
-                SET status = 'rejected', approved_by = %s, admin_notes = %s, updated_at = CURRENT_TIMESTAMP
-                WHERE id = %s
-            ''', (admin_id, admin_notes, business_id))
-        else:
-            cur.execute('''
-                UPDATE businesses
-                SET status = 'rejected', approved_by = ?, admin_notes = ?, updated_at = CURRENT_TIMESTAMP
-                WHERE id = ?
-            ''', (admin_id, admin_notes, business_id))
+        execute(cur, '''
+            UPDATE businesses
+            SET status = 'rejected', approved_by = ?, admin_notes = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (admin_id, admin_notes, business_id))
 
         # Логируем
-        if USE_POSTGRESQL:
-            cur.execute('SELECT * FROM businesses WHERE id = %s', (business_id,))
-        else:
-            cur.execute('SELECT * FROM businesses WHERE id = ?', (business_id,))
+        execute(cur, 'SELECT * FROM businesses WHERE id = ?', (business_id,))
         business = row_to_dict(cur.fetchone())
 
         if business:
-            if USE_POSTGRESQL:
-                cur.execute('SELECT * FROM users WHERE id = %s', (business['user_id'],))
-            else:
-                cur.execute('SELECT * FROM users WHERE id = ?', (business['user_id'],))
+            execute(cur, 'SELECT * FROM users WHERE id = ?', (business['user_id'],))
             user = row_to_dict(cur.fetchone())
 
-            if USE_POSTGRESQL:
-                cur.execute('''
-                    INSERT INTO audit_log (admin_passport, admin_name, action, target_user, details)
-                    VALUES (%s, %s, %s, %s, %s)
-                ''', ('SYSTEM', 'Система', 'Отклонение заявки на бизнес',
-                      user['passport'] if user else str(business['user_id']),
-                      f'Причина: {admin_notes}'))
-            else:
-                cur.execute('''
-                    INSERT INTO audit_log (admin_passport, admin_name, action, target_user, details)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', ('SYSTEM', 'Система', 'Отклонение заявки на бизнес',
-                      user['passport'] if user else str(business['user_id']),
-                      f'Причина: {admin_notes}'))
+            audit('Отклонение заявки на бизнес', user['passport'] if user else str(business['user_id']),
+                  f'Причина: {admin_notes}', cur=cur, admin_passport='SYSTEM', admin_name='Система')
 
             email_to = business.get('email') or (user.get('email') if user else None)
             if email_to:
-                send_business_rejection_email(email_to, business['business_name'], admin_notes)
+                send_business_rejection_email(cur, email_to, business['business_name'], admin_notes)
 
         conn.commit()
         return True
@@ -1020,11 +2177,7 @@ def create_withdrawal_request(business_account_id, user_id, amount, purpose,
     cur = conn.cursor()
     try:
         # Проверяем баланс
-        if USE_POSTGRESQL:
-            cur.execute('SELECT * FROM business_accounts WHERE id = %s', (business_account_id,))
-        else:
-            cur.execute('SELECT * FROM business_accounts WHERE id = ?', (business_account_id,))
-        account = cur.fetchone()
+        account = fetch_one(cur, 'SELECT * FROM business_accounts WHERE id = ?', (business_account_id,))
         if account['balance'] < amount:
             raise ValueError("Недостаточно средств на счете")
 
@@ -1045,20 +2198,8 @@ def create_withdrawal_request(business_account_id, user_id, amount, purpose,
             request_id = cur.lastrowid
 
         # Логируем
-        if USE_POSTGRESQL:
-            cur.execute('''
-                INSERT INTO audit_log (admin_passport, admin_name, action, target_user, details)
-                VALUES (%s, %s, %s, %s, %s)
-            ''', ('SYSTEM', 'Система', 'Заявка на вывод средств',
-                  str(user_id),
-                  f'Сумма: {amount}, Назначение: {purpose}'))
-        else:
-            cur.execute('''
-                INSERT INTO audit_log (admin_passport, admin_name, action, target_user, details)
-                VALUES (?, ?, ?, ?, ?)
-            ''', ('SYSTEM', 'Система', 'Заявка на вывод средств',
-                  str(user_id),
-                  f'Сумма: {amount}, Назначение: {purpose}'))
+        audit('Заявка на вывод средств', str(user_id), f'Сумма: {format_money(amount)}, Назначение: {purpose}',
+              cur=cur, admin_passport='SYSTEM', admin_name='Система')
 
         conn.commit()
         return request_id
@@ -1086,38 +2227,27 @@ def get_withdrawal_requests(status=None):
     '''
     params = []
     if status:
-        query += ' WHERE wr.status = %s' if USE_POSTGRESQL else ' WHERE wr.status = ?'
+        query += ' WHERE wr.status = ?'
         params.append(status)
     query += ' ORDER BY wr.created_at DESC'
-    if USE_POSTGRESQL:
-        cur.execute(query, params)
-    else:
-        cur.execute(query, params)
-    requests = cur.fetchall()
+    requests = fetch_all(cur, query, params)
     cur.close()
     conn.close()
     return [dict(req) for req in requests]
 
 def process_withdrawal_request(request_id, admin_id, status, admin_notes=None):
+    """Списание, запись в журнал, смена статуса и аудит — одной транзакцией."""
     conn = get_db_connection()
     cur = conn.cursor()
     try:
+        begin_write_transaction(conn)
         # Получаем данные заявки
-        if USE_POSTGRESQL:
-            cur.execute('''
-                SELECT wr.*, ba.balance, ba.account_number
-                FROM withdrawal_requests wr
-                JOIN business_accounts ba ON wr.business_account_id = ba.id
-                WHERE wr.id = %s
-            ''', (request_id,))
-        else:
-            cur.execute('''
-                SELECT wr.*, ba.balance, ba.account_number
-                FROM withdrawal_requests wr
-                JOIN business_accounts ba ON wr.business_account_id = ba.id
-                WHERE wr.id = ?
-            ''', (request_id,))
-        request = cur.fetchone()
+        request = fetch_one(cur, '''
+            SELECT wr.*, ba.balance, ba.account_number
+            FROM withdrawal_requests wr
+            JOIN business_accounts ba ON wr.business_account_id = ba.id
+            WHERE wr.id = ?
+        ''', (request_id,))
 
         if not request:
             raise ValueError("Заявка не найдена")
@@ -1128,58 +2258,35 @@ def process_withdrawal_request(request_id, admin_id, status, admin_notes=None):
         if status == 'approved':
             if request['balance'] < request['amount']:
                 raise ValueError("Недостаточно средств на счете")
-            new_balance = request['balance'] - request['amount']
-            if USE_POSTGRESQL:
-                cur.execute('UPDATE business_accounts SET balance = %s WHERE id = %s',
-                            (new_balance, request['business_account_id']))
-            else:
-                cur.execute('UPDATE business_accounts SET balance = ? WHERE id = ?',
-                            (new_balance, request['business_account_id']))
+            # Относительное списание: параллельная операция по счёту не перезапишется
+            execute(cur, 'UPDATE business_accounts SET balance = balance - ? WHERE id = ? AND balance >= ?',
+                    (request['amount'], request['business_account_id'], request['amount']))
+            if cur.rowcount != 1:
+                raise ValueError("Недостаточно средств на счете")
 
-            add_transaction('Вывод с бизнес-счета', request['account_number'], 'Банк',
-                            request['amount'], 'Успешно', f'Вывод средств: {request["purpose"]}')
+            insert_transaction(cur, 'Вывод с бизнес-счета', request['account_number'], 'Банк',
+                               request['amount'], 'Успешно', f'Вывод средств: {request["purpose"]}')
 
-        # Обновляем статус заявки
-        if USE_POSTGRESQL:
-            cur.execute('''
-                UPDATE withdrawal_requests
-                SET status = %s, processed_by = %s, processed_at = CURRENT_TIMESTAMP, admin_notes = %s
-                WHERE id = %s
-            ''', (status, admin_id, admin_notes, request_id))
-        else:
-            cur.execute('''
-                UPDATE withdrawal_requests
-                SET status = ?, processed_by = ?, processed_at = CURRENT_TIMESTAMP, admin_notes = ?
-                WHERE id = ?
-            ''', (status, admin_id, admin_notes, request_id))
+        # Обновляем статус заявки; параллельная обработка той же заявки сюда не дойдёт
+        execute(cur, '''
+            UPDATE withdrawal_requests
+            SET status = ?, processed_by = ?, processed_at = CURRENT_TIMESTAMP, admin_notes = ?
+            WHERE id = ? AND status = 'pending'
+        ''', (status, admin_id, admin_notes, request_id))
+        if cur.rowcount != 1:
+            raise ValueError("Заявка уже обработана")
 
         # Логируем
-        if USE_POSTGRESQL:
-            cur.execute('''
-                INSERT INTO audit_log (admin_passport, admin_name, action, target_user, details)
-                VALUES (%s, %s, %s, %s, %s)
-            ''', ('SYSTEM', 'Система', f'Обработка заявки на вывод: {status}',
-                  str(request['user_id']),
-                  f'Сумма: {request["amount"]}, Статус: {status}'))
-        else:
-            cur.execute('''
-                INSERT INTO audit_log (admin_passport, admin_name, action, target_user, details)
-                VALUES (?, ?, ?, ?, ?)
-            ''', ('SYSTEM', 'Система', f'Обработка заявки на вывод: {status}',
-                  str(request['user_id']),
-                  f'Сумма: {request["amount"]}, Статус: {status}'))
-
-        conn.commit()
+        audit(f'Обработка заявки на вывод: {status}', str(request['user_id']),
+              f'Сумма: {format_money(request["amount"])}, Статус: {status}',
+              cur=cur, admin_passport='SYSTEM', admin_name='Система')
 
-        # Отправляем email
-        if USE_POSTGRESQL:
-            cur.execute('SELECT * FROM users WHERE id = %s', (request['user_id'],))
-        else:
-            cur.execute('SELECT * FROM users WHERE id = ?', (request['user_id'],))
-        user = cur.fetchone()
+        # Ставим email в очередь
+        user = fetch_one(cur, 'SELECT * FROM users WHERE id = ?', (request['user_id'],))
         if user and user['email']:
-            send_withdrawal_notification_email(user['email'], request['amount'], status, admin_notes)
+            send_withdrawal_notification_email(cur, user['email'], request['amount'], status, admin_notes)
 
+        conn.commit()
         return True
     except Exception as e:
         conn.rollback()
@@ -1190,9 +2297,8 @@ def process_withdrawal_request(request_id, admin_id, status, admin_notes=None):
 
 # ==================== NFC ФУНКЦИИ ====================
 
-def create_pin_for_nfc(user_id, nfc_tag_id, pin):
-    conn = get_db_connection()
-    cur = conn.cursor()
+def create_pin_for_nfc(cur, user_id, nfc_tag_id, pin):
+    """Задаёт PIN метки в рамках транзакции вызывающего (без commit)."""
     salt = secrets.token_hex(16)
     pin_hash = hashlib.sha256((pin + salt).encode()).hexdigest()
     if USE_POSTGRESQL:
@@ -1210,19 +2316,16 @@ def create_pin_for_nfc(user_id, nfc_tag_id, pin):
             INSERT OR REPLACE INTO user_pins (user_id, nfc_tag_id, pin_hash, pin_salt)
             VALUES (?, ?, ?, ?)
         ''', (user_id, nfc_tag_id, pin_hash, salt))
-    conn.commit()
-    cur.close()
-    conn.close()
     return pin
 
-def verify_pin(user_id, nfc_tag_id, pin):
-    conn = get_db_connection()
-    cur = conn.cursor()
+def check_pin(cur, user_id, nfc_tag_id, pin):
+    """
+    Проверяет PIN и обновляет счётчик попыток на переданном курсоре (без commit).
+    В PostgreSQL строка PIN блокируется до конца транзакции: параллельные
+    проверки одного PIN не теряют неудачные попытки.
+    """
     if USE_POSTGRESQL:
-        cur.execute('''
-            SELECT * FROM user_pins
-            WHERE user_id = %s AND nfc_tag_id = %s AND is_locked = FALSE
-        ''', (user_id, nfc_tag_id))
+        execute_prepared(cur, 'lock_pin', (user_id, nfc_tag_id))
     else:
         cur.execute('''
             SELECT * FROM user_pins
@@ -1231,49 +2334,41 @@ def verify_pin(user_id, nfc_tag_id, pin):
     pin_data = cur.fetchone()
 
     if not pin_data:
-        cur.close()
-        conn.close()
         return False
 
     if pin_data['attempts'] >= 5:
-        if USE_POSTGRESQL:
-            cur.execute('UPDATE user_pins SET is_locked = TRUE WHERE id = %s', (pin_data['id'],))
-        else:
-            cur.execute('UPDATE user_pins SET is_locked = 1 WHERE id = ?', (pin_data['id'],))
-        conn.commit()
-        cur.close()
-        conn.close()
+        execute(cur, 'UPDATE user_pins SET is_locked = TRUE WHERE id = ?', (pin_data['id'],))
         return False
 
     salt = pin_data['pin_salt']
-    pin_hash = hashlib.sha256((pin + salt).encode()).hexdigest()
+    pin_hash = hashlib.sha256(((pin or '') + salt).encode()).hexdigest()
 
-    if pin_hash == pin_data['pin_hash']:
-        if USE_POSTGRESQL:
-            cur.execute('UPDATE user_pins SET attempts = 0 WHERE id = %s', (pin_data['id'],))
-        else:
-            cur.execute('UPDATE user_pins SET attempts = 0 WHERE id = ?', (pin_data['id'],))
-        conn.commit()
-        cur.close()
-        conn.close()
+    if secrets.compare_digest(pin_hash, pin_data['pin_hash']):
+        if pin_data['attempts']:
+            execute(cur, 'UPDATE user_pins SET attempts = 0 WHERE id = ?', (pin_data['id'],))
         return True
-    else:
-        if USE_POSTGRESQL:
-            cur.execute('''
-                UPDATE user_pins
-                SET attempts = attempts + 1, last_attempt = CURRENT_TIMESTAMP
-                WHERE id = %s
-            ''', (pin_data['id'],))
-        else:
-            cur.execute('''
-                UPDATE user_pins
-                SET attempts = attempts + 1, last_attempt = CURRENT_TIMESTAMP
-                WHERE id = ?
-            ''', (pin_data['id'],))
+
+    execute(cur, '''
+        UPDATE user_pins
+        SET attempts = attempts + 1, last_attempt = CURRENT_TIMESTAMP
+        WHERE id = ?
+    ''', (pin_data['id'],))
+    return False
+
+def verify_pin(user_id, nfc_tag_id, pin):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        begin_write_transaction(conn)
+        result = check_pin(cur, user_id, nfc_tag_id, pin)
         conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
         cur.close()
         conn.close()
-        return False
+    return result
 
 def generate_nfc_url(nfc_tag_id):
     unique_token = secrets.token_urlsafe(32)
@@ -1290,13 +2385,9 @@ def require_permission(permission):
                 return redirect(url_for('index'))
             if session.get('role') == 'super_admin':
                 return f(*args, **kwargs)
-            try:
-                permissions = json.loads(session.get('permissions', '{}'))
-                if not permissions.get(permission, False):
-                    flash('Доступ запрещен. Недостаточно прав.', 'error')
-                    return redirect(url_for('dashboard'))
-            except:
-                flash('Ошибка проверки прав доступа', 'error')
+            role = session_role()
+            if role is None or permission not in role.permissions:
+                flash('Доступ запрещен. Недостаточно прав.', 'error')
                 return redirect(url_for('dashboard'))
             return f(*args, **kwargs)
         return decorated_function
@@ -1316,13 +2407,1851 @@ def require_role(min_level):
         return decorated_function
     return decorator
 
+# ==================== ИДЕМПОТЕНТНОСТЬ ====================
+
+# Сколько хранить ответ на запрос с заголовком Idempotency-Key
+IDEMPOTENCY_TTL = timedelta(hours=int(os.environ.get('IDEMPOTENCY_TTL_HOURS', 24)))
+# Раз в сколько захватов ключей удалять просроченные записи и сколько за раз
+IDEMPOTENCY_EVICT_EVERY = 100
+IDEMPOTENCY_EVICT_BATCH = 1000
+
+_idempotency_claims = 0
+_idempotency_lock = threading.Lock()
+
+def request_fingerprint():
+    """Хеш метода, пути и содержимого запроса — повтор с тем же ключом должен совпадать с ним."""
+    if request.is_json:
+        body = json.dumps(request.get_json(silent=True), sort_keys=True, ensure_ascii=False)
+    elif request.form:
+        body = json.dumps(sorted(request.form.items(multi=True)), ensure_ascii=False)
+    else:
+        body = request.get_data(as_text=True)
+    payload = '\n'.join([request.method, request.path, request.query_string.decode('latin-1'), body])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def claim_idempotency_key(key, request_hash):
+    """Пытается занять ключ. Возвращает None, если ключ свободен и теперь наш,
+    иначе сохранённую запись (status_code = None означает, что запрос ещё выполняется)."""
+    global _idempotency_claims
+    now = datetime.now()
+    expires_at = now + IDEMPOTENCY_TTL
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        if USE_POSTGRESQL:
+            cur.execute('''
+                INSERT INTO idempotency_keys (idem_key, request_hash, expires_at)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (idem_key) DO NOTHING
+            ''', (key, request_hash, expires_at))
+        else:
+            cur.execute('''
+                INSERT OR IGNORE INTO idempotency_keys (idem_key, request_hash, expires_at)
+                VALUES (?, ?, ?)
+            ''', (key, request_hash, expires_at))
+        claimed = cur.rowcount == 1
+        if not claimed:
+            # Просроченный ключ можно занять заново
+            execute(cur, '''
+                UPDATE idempotency_keys
+                SET request_hash = ?, status_code = NULL, response_body = NULL, created_at = CURRENT_TIMESTAMP,
+                    expires_at = ?
+                WHERE idem_key = ? AND expires_at < ?
+            ''', (request_hash, expires_at, key, now))
+            claimed = cur.rowcount == 1
+        stored = None
+        if not claimed:
+            execute(cur, 'SELECT request_hash, status_code, response_body FROM idempotency_keys WHERE idem_key = ?',
+                    (key,))
+            stored = row_to_dict(cur.fetchone())
+
+        with _idempotency_lock:
+            _idempotency_claims += 1
+            evict = _idempotency_claims % IDEMPOTENCY_EVICT_EVERY == 0
+        if evict:
+            execute(cur, '''
+                DELETE FROM idempotency_keys WHERE idem_key IN (
+                    SELECT idem_key FROM idempotency_keys WHERE expires_at < ? LIMIT ?
+                )
+            ''', (now, IDEMPOTENCY_EVICT_BATCH))
+        conn.commit()
+        # Ключ мог быть удалён между INSERT и SELECT — тогда просто выполняем запрос
+        return stored
+    finally:
+        cur.close()
+        conn.close()
+
+def store_idempotency_response(key, status_code, response_body):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    # Обработчик уже зафиксировал всё, что хотел; незавершённое — отбрасываем,
+    # а не фиксируем вместе с ответом
+    conn.rollback()
+    execute(cur, 'UPDATE idempotency_keys SET status_code = ?, response_body = ? WHERE idem_key = ?',
+                 (status_code, response_body, key))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+def release_idempotency_key(key):
+    """Освобождает ключ, если ответ не стоит запоминать (ошибка сервера)."""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    # Отбрасываем незавершённые изменения упавшего обработчика
+    conn.rollback()
+    execute(cur, 'DELETE FROM idempotency_keys WHERE idem_key = ? AND status_code IS NULL', (key,))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+def idempotent(f):
+    """Повтор запроса с тем же заголовком Idempotency-Key возвращает сохранённый ответ,
+    не выполняя обработчик повторно. Тот же ключ с другим содержимым запроса — ошибка 422."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        client_key = request.headers.get('Idempotency-Key')
+        if not client_key:
+            return f(*args, **kwargs)
+        if len(client_key) > 255:
+            return jsonify({'success': False, 'error': 'Слишком длинный Idempotency-Key'}), 400
+
+        # Ключ привязан к маршруту и пользователю, в БД хранится только его хеш
+        scope = f'{request.endpoint}:{session.get("user_id", "")}:{client_key}'
+        key = hashlib.sha256(scope.encode()).hexdigest()
+
+        request_hash = request_fingerprint()
+        stored = claim_idempotency_key(key, request_hash)
+        if stored is not None:
+            # Записи, сохранённые до появления request_hash, сравнить не с чем
+            if stored['request_hash'] and stored['request_hash'] != request_hash:
+                return jsonify({'success': False,
+                                'error': 'Idempotency-Key уже использован для другого запроса'}), 422
+            if stored['status_code'] is None:
+                return jsonify({'success': False, 'error': 'Запрос с этим ключом уже выполняется'}), 409
+            response = app.response_class(stored['response_body'], status=stored['status_code'],
+                                          mimetype='application/json')
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        try:
+            response = make_response(f(*args, **kwargs))
+        except Exception:
+            release_idempotency_key(key)
+            raise
+        if response.status_code >= 500 or not response.is_json:
+            release_idempotency_key(key)
+        else:
+            store_idempotency_response(key, response.status_code, response.get_data(as_text=True))
+        return response
+    return decorated_function
+
+# ==================== КЭШ ОТВЕТОВ ====================
+# Небольшой кэш в памяти процесса: запись живёт ttl секунд, при переполнении
+# вытесняется та, к которой дольше всего не обращались. У каждого воркера gunicorn
+# свой кэш, поэтому данные могут отставать от БД не больше чем на ttl.
+
+CACHE_TTL = float(os.environ.get('ADMIN_STATS_CACHE_TTL', 15))
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 256))
+
+class TTLCache:
+    def __init__(self, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] <= time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+response_cache = TTLCache()
+
+def cached_json(f):
+    """
+    Кэширует успешный JSON-ответ маршрута на CACHE_TTL секунд (ключ — путь с параметрами).
+    Ответ получает ETag, и повторный запрос с тем же If-None-Match получает 304 без тела.
+    Данные одинаковы для всех, кто прошёл проверку прав, поэтому декоратор ставится
+    после @require_permission.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        key = f'{request.endpoint}:{request.full_path}'
+        cached = response_cache.get(key)
+        if cached is None:
+            response = make_response(f(*args, **kwargs))
+            if response.status_code != 200 or not response.is_json:
+                return response
+            cached = (response.get_data(), hashlib.sha1(response.get_data()).hexdigest())
+            response_cache.set(key, cached)
+        body, etag = cached
+        response = app.response_class(body, mimetype='application/json')
+        response.set_etag(etag)
+        # Браузер хранит ответ, но каждый раз переспрашивает сервер через If-None-Match
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response.make_conditional(request)
+    return decorated_function
+
+# ==================== ХРАНИЛИЩЕ ПЛАТЁЖНЫХ СЕССИЙ ====================
+# Сессия оплаты по NFC живёт 10 минут, и пока она не оплачена, её незачем
+# держать в основной БД. По умолчанию ожидающие сессии лежат в локальном файле
+# SQLite в /dev/shm (общем для всех воркеров gunicorn на машине), а в
+# payment_sessions записывается только итог — в той же транзакции, что и оплата.
+# PAYMENT_SESSION_STORE=database возвращает хранение в payment_sessions целиком —
+# это нужно, если приложение запущено на нескольких машинах.
+
+PAYMENT_SESSION_STORE = os.environ.get('PAYMENT_SESSION_STORE', 'local')
+PAYMENT_SESSION_TTL = timedelta(minutes=10)
+
+def default_payment_store_path():
+    # Отдельный файл для каждой основной БД, чтобы разные инсталляции на одной машине не смешивались
+    target = os.environ.get('DATABASE_URL') or os.path.abspath(SQLITE_PATH)
+    suffix = hashlib.sha256(target.encode()).hexdigest()[:12]
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, f'dvorpay_payment_sessions_{suffix}.db')
+
+def payment_session_expired(payment_session):
+    return payment_session['expires_at'] <= datetime.now()
+
+def insert_final_payment_session(cur, payment_session, status):
+    """Единственная запись сессии в payment_sessions — её итог (без commit)."""
+    execute(cur, '''
+        INSERT INTO payment_sessions (session_id, buyer_id, seller_id, amount, status,
+                                      created_at, expires_at, completed_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+    ''', (payment_session['session_id'], payment_session['buyer_id'], payment_session['seller_id'],
+          payment_session['amount'], status, payment_session['created_at'], payment_session['expires_at']))
+
+class LocalPaymentSessionStore:
+    """Ожидающие сессии в локальном файле SQLite, общем для процессов одной машины."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _connection(self):
+        # После fork соединение родителя не используем — у каждого воркера своё
+        if self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            # Файл — это не журнал денег, а кэш на 10 минут: fsync не нужен
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS pending_payment_sessions (
+                    session_id TEXT PRIMARY KEY,
+                    buyer_id INTEGER NOT NULL,
+                    seller_id INTEGER NOT NULL,
+                    amount INTEGER,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    created_at REAL NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_pending_payment_sessions_expires '
+                         'ON pending_payment_sessions(expires_at)')
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            cur = self._connection().execute(sql, params)
+            return cur.fetchall(), cur.rowcount
+
+    def _execute_many(self, sql, rows):
+        with self._lock:
+            self._connection().executemany(sql, rows)
+
+    @staticmethod
+    def _to_dict(row):
+        session = dict(row)
+        session['created_at'] = datetime.fromtimestamp(session['created_at'])
+        session['expires_at'] = datetime.fromtimestamp(session['expires_at'])
+        return session
+
+    def create(self, session_id, buyer_id, seller_id, expires_at):
+        self._execute('''
+            INSERT INTO pending_payment_sessions (session_id, buyer_id, seller_id, created_at, expires_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (session_id, buyer_id, seller_id, time.time(), expires_at.timestamp()))
+
+    def get(self, session_id):
+        rows, _ = self._execute('SELECT * FROM pending_payment_sessions WHERE session_id = ?', (session_id,))
+        return self._to_dict(rows[0]) if rows else None
+
+    def set_amount(self, session_id, amount):
+        _, count = self._execute('''
+            UPDATE pending_payment_sessions SET amount = ?
+            WHERE session_id = ? AND status = 'pending' AND expires_at > ?
+        ''', (amount, session_id, time.time()))
+        return count == 1
+
+    def claim(self, session_id):
+        """Переводит сессию в 'processing': второй параллельный confirm её уже не получит."""
+        _, count = self._execute('''
+            UPDATE pending_payment_sessions SET status = 'processing'
+            WHERE session_id = ? AND status = 'pending' AND expires_at > ?
+        ''', (session_id, time.time()))
+        return self.get(session_id) if count == 1 else None
+
+    def release(self, session_id):
+        self._execute("UPDATE pending_payment_sessions SET status = 'pending' "
+                      "WHERE session_id = ? AND status = 'processing'", (session_id,))
+
+    def complete(self, cur, payment_session, status):
+        insert_final_payment_session(cur, payment_session, status)
+
+    def forget(self, session_id):
+        """Вызывается после commit итоговой записи."""
+        self._execute('DELETE FROM pending_payment_sessions WHERE session_id = ?', (session_id,))
+
+    def count_pending(self):
+        rows, _ = self._execute("SELECT COUNT(*) AS count FROM pending_payment_sessions "
+                                "WHERE status IN ('pending', 'processing') AND expires_at > ?", (time.time(),))
+        return rows[0]['count']
+
+    def pop_expired(self, limit=1000):
+        """
+        Забирает из хранилища до limit истёкших сессий (их итог записывает вызывающий).
+        Сессия в 'processing' забирается с запасом в 5 минут: оплата по ней могла ещё идти.
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            # BEGIN IMMEDIATE: одну и ту же сессию не заберут два воркера сразу
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = conn.execute('''
+                    SELECT * FROM pending_payment_sessions
+                    WHERE (status = 'pending' AND expires_at <= ?)
+                       OR (status = 'processing' AND expires_at <= ?)
+                    LIMIT ?
+                ''', (now, now - 300, limit)).fetchall()
+                conn.executemany('DELETE FROM pending_payment_sessions WHERE session_id = ?',
+                                 [(r['session_id'],) for r in rows])
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return [self._to_dict(r) for r in rows]
+
+    def restore(self, sessions):
+        """Возвращает сессии, забранные pop_expired, если их итог не удалось записать."""
+        self._execute_many('''
+            INSERT OR IGNORE INTO pending_payment_sessions
+                (session_id, buyer_id, seller_id, amount, status, created_at, expires_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [(s['session_id'], s['buyer_id'], s['seller_id'], s['amount'], s['status'],
+               s['created_at'].timestamp(), s['expires_at'].timestamp()) for s in sessions])
+
+class DatabasePaymentSessionStore:
+    """Прежнее поведение: сессия целиком живёт в payment_sessions основной БД."""
+
+    def _execute(self, query, params=(), fetch=False):
+        conn = get_db_connection()
+        cur = conn.cursor()
+        execute(cur, query, params)
+        rows = cur.fetchall() if fetch else None
+        count = cur.rowcount
+        conn.commit()
+        cur.close()
+        conn.close()
+        return rows, count
+
+    @staticmethod
+    def _to_dict(row):
+        session = dict(row)
+        for field in ('created_at', 'expires_at'):
+            if isinstance(session.get(field), str):
+                session[field] = datetime.fromisoformat(session[field])
+        return session
+
+    def create(self, session_id, buyer_id, seller_id, expires_at):
+        self._execute('''
+            INSERT INTO payment_sessions (session_id, buyer_id, seller_id, expires_at)
+            VALUES (?, ?, ?, ?)
+        ''', (session_id, buyer_id, seller_id, expires_at))
+
+    def get(self, session_id):
+        conn = get_db_connection()
+        cur = conn.cursor()
+        row = execute_prepared(cur, 'payment_session_by_id', (session_id,)).fetchone()
+        conn.commit()
+        cur.close()
+        conn.close()
+        return self._to_dict(row) if row else None
+
+    def set_amount(self, session_id, amount):
+        _, count = self._execute(
+            "UPDATE payment_sessions SET amount = ? WHERE session_id = ? AND status = 'pending' AND expires_at > ?",
+            (amount, session_id, datetime.now()))
+        return count == 1
+
+    def claim(self, session_id):
+        _, count = self._execute(
+            "UPDATE payment_sessions SET status = 'processing' "
+            "WHERE session_id = ? AND status = 'pending' AND expires_at > ?",
+            (session_id, datetime.now()))
+        return self.get(session_id) if count == 1 else None
+
+    def release(self, session_id):
+        self._execute("UPDATE payment_sessions SET status = 'pending' WHERE session_id = ? AND status = 'processing'",
+                      (session_id,))
+
+    def complete(self, cur, payment_session, status):
+        execute(cur, 'UPDATE payment_sessions SET status = ?, completed_at = CURRENT_TIMESTAMP WHERE session_id = ?',
+                     (status, payment_session['session_id']))
+
+    def forget(self, session_id):
+        pass
+
+    def count_pending(self):
+        rows, _ = self._execute(
+            "SELECT COUNT(*) AS count FROM payment_sessions WHERE status IN ('pending', 'processing') AND expires_at > ?",
+            (datetime.now(),), fetch=True)
+        return rows[0]['count']
+
+    def pop_expired(self, limit=1000):
+        # Истёкшие сессии остаются в payment_sessions, их статус меняет уборщик
+        return []
+
+    def restore(self, sessions):
+        pass
+
+_payment_session_store = None
+
+def get_payment_session_store():
+    global _payment_session_store
+    if _payment_session_store is None:
+        if PAYMENT_SESSION_STORE == 'database':
+            _payment_session_store = DatabasePaymentSessionStore()
+        else:
+            _payment_session_store = LocalPaymentSessionStore(
+                os.environ.get('PAYMENT_SESSION_STORE_PATH') or default_payment_store_path())
+    return _payment_session_store
+
+# ==================== ФОНОВЫЕ ЗАДАЧИ ====================
+# Периодические задачи выполняются в потоках-демонах каждого воркера. Потоки
+# стартуют при первом запросе в процессе (после fork gunicorn), поэтому задачи
+# должны быть безопасны при одновременном запуске в нескольких воркерах.
+# BACKGROUND_TASKS_ENABLED=0 отключает их — тогда уборку запускают командами flask.
+
+BACKGROUND_TASKS_ENABLED = os.environ.get('BACKGROUND_TASKS_ENABLED', '1') == '1'
+BACKGROUND_TASKS = {}
+_background_tasks_pid = None
+_background_tasks_lock = threading.Lock()
+
+def background_task(name, interval):
+    """Регистрирует функцию как периодическую задачу с интервалом interval секунд."""
+    def decorator(f):
+        BACKGROUND_TASKS[name] = {'func': f, 'interval': interval, 'runs': 0, 'errors': 0,
+                                  'last_run': None, 'last_result': None, 'last_error': None}
+        return f
+    return decorator
+
+def _background_task_loop(name):
+    task = BACKGROUND_TASKS[name]
+    # Случайный сдвиг, чтобы воркеры не запускали задачу в одну и ту же секунду
+    time.sleep(random.uniform(0, task['interval']))
+    while True:
+        try:
+            task['last_result'] = task['func']()
+        except Exception as e:
+            task['errors'] += 1
+            task['last_error'] = str(e)
+            print(f"⚠️ Фоновая задача {name}: {e}")
+        task['runs'] += 1
+        task['last_run'] = datetime.now().isoformat(sep=' ', timespec='seconds')
+        time.sleep(task['interval'])
+
+def start_background_tasks():
+    global _background_tasks_pid
+    if not BACKGROUND_TASKS_ENABLED or _background_tasks_pid == os.getpid():
+        return
+    with _background_tasks_lock:
+        if _background_tasks_pid == os.getpid():
+            return
+        for name in BACKGROUND_TASKS:
+            threading.Thread(target=_background_task_loop, args=(name,), name=f'task-{name}', daemon=True).start()
+        _background_tasks_pid = os.getpid()
+
+@app.before_request
+def ensure_background_tasks():
+    start_background_tasks()
+
+def background_tasks_snapshot():
+    return {name: {k: v for k, v in task.items() if k != 'func'} for name, task in BACKGROUND_TASKS.items()}
+
+# ==================== УБОРКА ПЛАТЁЖНЫХ СЕССИЙ ====================
+
+PAYMENT_SWEEP_INTERVAL = float(os.environ.get('PAYMENT_SWEEP_INTERVAL', 60))
+PAYMENT_SWEEP_BATCH = int(os.environ.get('PAYMENT_SWEEP_BATCH', 1000))
+# Завершённые сессии (оплаченные и истёкшие) хранятся столько дней; сами платежи остаются в transactions
+PAYMENT_SESSION_RETENTION_DAYS = int(os.environ.get('PAYMENT_SESSION_RETENTION_DAYS', 30))
+# Сессию в 'processing' считаем брошенной только через столько после expires_at
+PAYMENT_SESSION_GRACE = timedelta(minutes=5)
+
+def _sweep_in_batches(query, params, batch_size, max_batches):
+    total = 0
+    for _ in range(max_batches):
+        conn = get_db_connection()
+        cur = conn.cursor()
+        execute(cur, query, list(params) + [batch_size])
+        count = cur.rowcount
+        conn.commit()
+        cur.close()
+        conn.close()
+        total += count
+        if count < batch_size:
+            break
+    return total
+
+def sweep_payment_sessions(batch_size=PAYMENT_SWEEP_BATCH, max_batches=100):
+    """
+    Закрывает истёкшие сессии и удаляет старые завершённые — пачками по batch_size строк,
+    каждая пачка в своей короткой транзакции. Возвращает счётчики для журнала.
+    """
+    result = {'archived': 0, 'expired': 0, 'deleted': 0}
+    store = get_payment_session_store()
+
+    # 1. Истёкшие сессии из локального хранилища получают итоговую запись 'expired'
+    for _ in range(max_batches):
+        expired = store.pop_expired(batch_size)
+        if not expired:
+            break
+        conn = get_db_connection()
+        cur = conn.cursor()
+        try:
+            for payment_session in expired:
+                insert_final_payment_session(cur, payment_session, 'expired')
+            conn.commit()
+        except Exception:
+            # Из хранилища сессии уже удалены — возвращаем их, иначе итог 'expired' потеряется
+            conn.rollback()
+            store.restore(expired)
+            raise
+        finally:
+            cur.close()
+            conn.close()
+        result['archived'] += len(expired)
+        if len(expired) < batch_size:
+            break
+
+    # 2. Истёкшие сессии, живущие в payment_sessions (PAYMENT_SESSION_STORE=database)
+    result['expired'] = _sweep_in_batches('''
+        UPDATE payment_sessions SET status = 'expired', completed_at = CURRENT_TIMESTAMP
+        WHERE id IN (
+            SELECT id FROM payment_sessions
+            WHERE status IN ('pending', 'processing') AND expires_at <= ?
+            LIMIT ?
+        )
+    ''', [datetime.now() - PAYMENT_SESSION_GRACE], batch_size, max_batches)
+
+    # 3. Завершённые сессии старше срока хранения
+    result['deleted'] = _sweep_in_batches('''
+        DELETE FROM payment_sessions
+        WHERE id IN (
+            SELECT id FROM payment_sessions
+            WHERE expires_at < ? AND status NOT IN ('pending', 'processing')
+            LIMIT ?
+        )
+    ''', [datetime.now() - timedelta(days=PAYMENT_SESSION_RETENTION_DAYS)], batch_size, max_batches)
+    return result
+
+@background_task('sweep_payment_sessions', PAYMENT_SWEEP_INTERVAL)
+def sweep_payment_sessions_task():
+    return sweep_payment_sessions()
+
+@app.cli.command('sweep-payment-sessions')
+def sweep_payment_sessions_command():
+    """Закрыть истёкшие платёжные сессии и удалить старые завершённые."""
+    result = sweep_payment_sessions()
+    print(f"✅ Закрыто истёкших: {result['archived'] + result['expired']}, удалено старых: {result['deleted']}")
+
+# ==================== РАЗДЕЛЁННЫЕ БАЛАНСЫ ====================
+# Все NFC-оплаты популярному продавцу обновляют одну строку users, и под
+# блокировкой строки его очередь на кассе выстраивается в цепочку. Для счетов с
+# users.balance_buckets = N > 0 зачисления по NFC идут в одну из N строк
+# balance_buckets (номер — по хешу сессии) без блокировки строки продавца.
+# Баланс такого счета — users.balance плюс сумма его корзин. Списания со счета
+# и фоновая задача сначала сворачивают корзины в users.balance.
+# Включается для счета командой `flask set-hot-account <счет> --buckets N`.
+
+BALANCE_COMPACT_INTERVAL = float(os.environ.get('BALANCE_COMPACT_INTERVAL', 5))
+# Баланс строки users вместе с несвёрнутыми корзинами — для агрегатов по таблице users
+BALANCE_WITH_BUCKETS = 'balance + COALESCE((SELECT SUM(b.amount) FROM balance_buckets b WHERE b.user_id = users.id), 0)'
+
+def pick_balance_bucket(key, buckets):
+    return int(hashlib.sha1(str(key).encode()).hexdigest()[:8], 16) % buckets
+
+def credit_balance_bucket(cur, user_id, bucket, amount):
+    """Зачисляет amount копеек в корзину счета (без commit и без блокировки строки users)."""
+    if USE_POSTGRESQL:
+        cur.execute('''
+            INSERT INTO balance_buckets (user_id, bucket, amount) VALUES (%s, %s, %s)
+            ON CONFLICT (user_id, bucket) DO UPDATE SET amount = balance_buckets.amount + EXCLUDED.amount
+        ''', (user_id, bucket, amount))
+    else:
+        cur.execute('''
+            INSERT INTO balance_buckets (user_id, bucket, amount) VALUES (?, ?, ?)
+            ON CONFLICT (user_id, bucket) DO UPDATE SET amount = amount + excluded.amount
+        ''', (user_id, bucket, amount))
+
+def fold_balance_buckets(cur, user_id):
+    """
+    Переносит сумму корзин счета в users.balance (без commit). Вызывается, когда
+    строка users этого счета уже заблокирована. Возвращает перенесённую сумму.
+    """
+    if USE_POSTGRESQL:
+        cur.execute('''
+            WITH moved AS (DELETE FROM balance_buckets WHERE user_id = %s RETURNING amount)
+            SELECT COALESCE(SUM(amount), 0) AS total FROM moved
+        ''', (user_id,))
+        total = int(cur.fetchone()['total'])
+        if total:
+            cur.execute('UPDATE users SET balance = balance + %s WHERE id = %s', (total, user_id))
+    else:
+        cur.execute('SELECT COALESCE(SUM(amount), 0) AS total FROM balance_buckets WHERE user_id = ?', (user_id,))
+        total = cur.fetchone()['total']
+        cur.execute('DELETE FROM balance_buckets WHERE user_id = ?', (user_id,))
+        if total:
+            cur.execute('UPDATE users SET balance = balance + ? WHERE id = ?', (total, user_id))
+    return total
+
+def with_pending_credits(cur, user):
+    """Строка users -> словарь, где balance уже включает несвёрнутые корзины."""
+    if not user:
+        return None
+    user = dict(user)
+    if user.get('balance_buckets'):
+        execute(cur, 'SELECT COALESCE(SUM(amount), 0) AS total FROM balance_buckets WHERE user_id = ?',
+                     (user['id'],))
+        user['balance'] += int(cur.fetchone()['total'])
+    return user
+
+def compact_balance_buckets():
+    """Сворачивает корзины всех счетов — каждая пара «счет + его корзины» в своей транзакции."""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('SELECT DISTINCT user_id FROM balance_buckets')
+    user_ids = [row['user_id'] for row in cur.fetchall()]
+    conn.commit()
+    folded = 0
+    for user_id in user_ids:
+        try:
+            begin_write_transaction(conn)
+            if USE_POSTGRESQL:
+                cur.execute('SELECT id FROM users WHERE id = %s FOR UPDATE', (user_id,))
+            folded += fold_balance_buckets(cur, user_id)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    cur.close()
+    conn.close()
+    return {'accounts': len(user_ids), 'folded': folded}
+
+@background_task('compact_balance_buckets', BALANCE_COMPACT_INTERVAL)
+def compact_balance_buckets_task():
+    return compact_balance_buckets()
+
+@app.cli.command('set-hot-account')
+@click.argument('account_number')
+@click.option('--buckets', default=8, show_default=True, help='Число корзин; 0 — выключить разделение.')
+def set_hot_account_command(account_number, buckets):
+    """Включить или выключить разделённый баланс для счета."""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    begin_write_transaction(conn)
+    if USE_POSTGRESQL:
+        cur.execute('SELECT id FROM users WHERE account_number = %s FOR UPDATE', (account_number,))
+    else:
+        cur.execute('SELECT id FROM users WHERE account_number = ?', (account_number,))
+    user = cur.fetchone()
+    if not user:
+        conn.rollback()
+        cur.close()
+        conn.close()
+        print(f"❌ Счет {account_number} не найден")
+        return
+    fold_balance_buckets(cur, user['id'])
+    execute(cur, 'UPDATE users SET balance_buckets = ? WHERE id = ?', (max(buckets, 0), user['id']))
+    conn.commit()
+    cur.close()
+    conn.close()
+    print(f"✅ Счет {account_number}: корзин {max(buckets, 0)}")
+
+# ==================== ДОСТАВКА ПИСЕМ ====================
+# Задача забирает из email_outbox пачку писем, срок которых подошёл, и отправляет
+# их пулом из EMAIL_WORKERS потоков. Каждый поток держит своё SMTP-соединение и
+# переиспользует его между письмами и пачками. Неудачная попытка откладывает
+# письмо с экспоненциально растущей задержкой, после EMAIL_MAX_ATTEMPTS оно
+# помечается 'failed'. Забранное письмо получает статус 'sending' и срок
+# next_attempt_at = сейчас + EMAIL_SEND_LEASE: если воркер упадёт посреди
+# отправки, письмо снова станет доступно после этого срока.
+# Без SMTP_HOST письма только печатаются в лог, как раньше.
+
+SMTP_HOST = os.environ.get('SMTP_HOST')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', 587))
+SMTP_USER = os.environ.get('SMTP_USER')
+SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD')
+SMTP_STARTTLS = os.environ.get('SMTP_STARTTLS', '1') == '1'
+SMTP_TIMEOUT = float(os.environ.get('SMTP_TIMEOUT', 10))
+EMAIL_FROM = os.environ.get('EMAIL_FROM', 'noreply@dvorpay.local')
+
+EMAIL_OUTBOX_INTERVAL = float(os.environ.get('EMAIL_OUTBOX_INTERVAL', 5))
+EMAIL_BATCH = int(os.environ.get('EMAIL_BATCH', 50))
+EMAIL_WORKERS = int(os.environ.get('EMAIL_WORKERS', 2))
+EMAIL_MAX_ATTEMPTS = int(os.environ.get('EMAIL_MAX_ATTEMPTS', 8))
+# Задержка перед повтором: 30 с, 60 с, 120 с, ... но не больше часа
+EMAIL_RETRY_BASE = 30
+EMAIL_RETRY_MAX = 3600
+EMAIL_SEND_LEASE = timedelta(minutes=5)
+
+_email_executor = None
+_email_executor_pid = None
+_email_executor_lock = threading.Lock()
+_smtp_local = threading.local()
+
+def get_email_executor():
+    """Пул потоков отправки — свой в каждом процессе (после fork gunicorn)."""
+    global _email_executor, _email_executor_pid
+    if _email_executor_pid != os.getpid():
+        with _email_executor_lock:
+            if _email_executor_pid != os.getpid():
+                _email_executor = ThreadPoolExecutor(max_workers=EMAIL_WORKERS, thread_name_prefix='email')
+                _email_executor_pid = os.getpid()
+    return _email_executor
+
+def build_email_message(email):
+    if email['html_body']:
+        message = MIMEMultipart('alternative')
+        message.attach(MIMEText(email['body'], 'plain', 'utf-8'))
+        message.attach(MIMEText(email['html_body'], 'html', 'utf-8'))
+    else:
+        message = MIMEText(email['body'], 'plain', 'utf-8')
+    message['Subject'] = email['subject']
+    message['From'] = EMAIL_FROM
+    message['To'] = email['to_email']
+    return message
+
+def _smtp_connection():
+    """SMTP-соединение текущего потока пула: открывается при первой отправке и дальше переиспользуется."""
+    smtp = getattr(_smtp_local, 'smtp', None)
+    if smtp is None:
+        smtp = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+        if SMTP_STARTTLS:
+            smtp.starttls()
+        if SMTP_USER:
+            smtp.login(SMTP_USER, SMTP_PASSWORD or '')
+        _smtp_local.smtp = smtp
+    return smtp
+
+def _drop_smtp_connection():
+    smtp = getattr(_smtp_local, 'smtp', None)
+    _smtp_local.smtp = None
+    if smtp is not None:
+        try:
+            smtp.close()
+        except Exception:
+            pass
+
+def deliver_email(email):
+    """Отправляет одно письмо. Возвращает None при успехе или текст ошибки."""
+    if not SMTP_HOST:
+        print(f"\n{'='*60}")
+        print(f"📧 EMAIL НА: {email['to_email']}")
+        print(f"📋 ТЕМА: {email['subject']}")
+        print(f"📝 СОДЕРЖИМОЕ:\n{email['body']}")
+        print(f"{'='*60}\n")
+        return None
+    message = build_email_message(email)
+    try:
+        try:
+            _smtp_connection().send_message(message)
+        except smtplib.SMTPServerDisconnected:
+            # Сервер закрыл простаивавшее соединение — переподключаемся один раз
+            _drop_smtp_connection()
+            _smtp_connection().send_message(message)
+        return None
+    except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused) as e:
+        # Сервер отказал в приёме письма, но соединение осталось рабочим
+        return str(e)
+    except (smtplib.SMTPException, OSError) as e:
+        _drop_smtp_connection()
+        return str(e) or e.__class__.__name__
+
+def _deliver_chunk(emails):
+    return [(email['id'], deliver_email(email)) for email in emails]
+
+def email_retry_delay(attempts):
+    delay = min(EMAIL_RETRY_BASE * 2 ** (attempts - 1), EMAIL_RETRY_MAX)
+    return timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+def claim_outbox_batch(limit):
+    """Забирает до limit писем к отправке, продлевая им срок на EMAIL_SEND_LEASE."""
+    now = datetime.now()
+    conn = get_db_connection()
+    cur = conn.cursor()
+    if USE_POSTGRESQL:
+        # SKIP LOCKED: воркеры разбирают разные письма, не дожидаясь друг друга
+        cur.execute('''
+            UPDATE email_outbox SET status = 'sending', attempts = attempts + 1, next_attempt_at = %s
+            WHERE id IN (
+                SELECT id FROM email_outbox
+                WHERE status IN ('pending', 'sending') AND next_attempt_at <= %s
+                ORDER BY next_attempt_at
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, to_email, subject, body, html_body, attempts
+        ''', (now + EMAIL_SEND_LEASE, now, limit))
+        emails = [dict(row) for row in cur.fetchall()]
+    else:
+        begin_write_transaction(conn)
+        cur.execute('''
+            SELECT id, to_email, subject, body, html_body, attempts FROM email_outbox
+            WHERE status IN ('pending', 'sending') AND next_attempt_at <= ?
+            ORDER BY next_attempt_at
+            LIMIT ?
+        ''', (now, limit))
+        emails = [dict(row) for row in cur.fetchall()]
+        cur.executemany('''
+            UPDATE email_outbox SET status = 'sending', attempts = attempts + 1, next_attempt_at = ? WHERE id = ?
+        ''', [(now + EMAIL_SEND_LEASE, email['id']) for email in emails])
+        for email in emails:
+            email['attempts'] += 1
+    conn.commit()
+    cur.close()
+    conn.close()
+    return emails
+
+def record_delivery_results(emails, results):
+    now = datetime.now()
+    attempts = {email['id']: email['attempts'] for email in emails}
+    sent, retry, failed = [], [], []
+    for email_id, error in results:
+        if error is None:
+            sent.append((now, email_id))
+        elif attempts[email_id] >= EMAIL_MAX_ATTEMPTS:
+            failed.append((error[:500], email_id))
+        else:
+            retry.append((now + email_retry_delay(attempts[email_id]), error[:500], email_id))
+    conn = get_db_connection()
+    cur = conn.cursor()
+    # Текст отправленного письма не храним: в письме об одобрении бизнеса есть пароль
+    execute_many(cur, '''
+        UPDATE email_outbox SET status = 'sent', sent_at = ?, body = '', html_body = NULL, last_error = NULL
+        WHERE id = ?
+    ''', sent)
+    execute_many(cur, "UPDATE email_outbox SET status = 'pending', next_attempt_at = ?, last_error = ? WHERE id = ?",
+                 retry)
+    execute_many(cur, "UPDATE email_outbox SET status = 'failed', last_error = ? WHERE id = ?", failed)
+    conn.commit()
+    cur.close()
+    conn.close()
+    return {'sent': len(sent), 'retry': len(retry), 'failed': len(failed)}
+
+def deliver_emails(batch_size=EMAIL_BATCH, max_batches=20):
+    """Отправляет письма из очереди пачками по batch_size. Возвращает счётчики для журнала."""
+    result = {'sent': 0, 'retry': 0, 'failed': 0}
+    executor = get_email_executor()
+    for _ in range(max_batches):
+        emails = claim_outbox_batch(batch_size)
+        if not emails:
+            break
+        # Пачка делится между потоками пула, каждый отправляет свою часть по своему соединению
+        chunks = [emails[i::EMAIL_WORKERS] for i in range(EMAIL_WORKERS)]
+        results = [r for chunk in executor.map(_deliver_chunk, [c for c in chunks if c]) for r in chunk]
+        for key, count in record_delivery_results(emails, results).items():
+            result[key] += count
+        if len(emails) < batch_size:
+            break
+    return result
+
+@background_task('deliver_emails', EMAIL_OUTBOX_INTERVAL)
+def deliver_emails_task():
+    return deliver_emails()
+
+@app.cli.command('deliver-emails')
+def deliver_emails_command():
+    """Отправить письма из очереди."""
+    result = deliver_emails()
+    print(f"✅ Отправлено: {result['sent']}, отложено: {result['retry']}, не доставлено: {result['failed']}")
+
+# ==================== ЖУРНАЛ АУДИТА ====================
+# Все записи в audit_log идут через audit(). С cur запись делается в транзакции
+# вызывающего кода — она появится вместе с изменением или не появится вовсе.
+# Без cur запись попадает в буфер процесса, который фоновый поток сбрасывает
+# одной пачкой раз в AUDIT_FLUSH_INTERVAL_MS или сразу при AUDIT_FLUSH_ROWS
+# записях; остаток сбрасывается при завершении процесса (atexit).
+# Чтобы чтение последних записей не замедлялось с ростом журнала, в PostgreSQL
+# audit_log секционирован по месяцам, а в SQLite прошлые месяцы переносятся
+# в архивные таблицы audit_log_ГГГГ_ММ.
+
+AUDIT_BUFFERED = os.environ.get('AUDIT_BUFFERED', '1') == '1'
+AUDIT_FLUSH_INTERVAL_MS = int(os.environ.get('AUDIT_FLUSH_INTERVAL_MS', 200))
+AUDIT_FLUSH_ROWS = int(os.environ.get('AUDIT_FLUSH_ROWS', 100))
+# Секции PostgreSQL создаются заранее на столько месяцев вперёд
+AUDIT_PARTITIONS_AHEAD = 2
+AUDIT_MAINTENANCE_INTERVAL = float(os.environ.get('AUDIT_MAINTENANCE_INTERVAL', 3600))
+AUDIT_ARCHIVE_PATTERN = re.compile(r'^audit_log_\d{4}_\d{2}$')
+
+def month_start(value):
+    return datetime(value.year, value.month, 1)
+
+def next_month(value):
+    return datetime(value.year + value.month // 12, value.month % 12 + 1, 1)
+
+def insert_audit_entries(cur, entries):
+    """entries — кортежи (admin_passport, admin_name, action, target_user, details, timestamp)."""
+    if USE_POSTGRESQL:
+        execute_values(cur, '''
+            INSERT INTO audit_log (admin_passport, admin_name, action, target_user, details, timestamp)
+            VALUES %s
+        ''', entries)
+    else:
+        cur.executemany('''
+            INSERT INTO audit_log (admin_passport, admin_name, action, target_user, details, timestamp)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', entries)
+
+def write_audit_entries(entries):
+    # Отдельное соединение из пула, а не соединение запроса: commit не должен
+    # зафиксировать чужую незавершённую транзакцию
+    conn = DBConnection(get_db_pool().acquire(), request_scoped=False)
+    cur = conn.cursor()
+    try:
+        insert_audit_entries(cur, entries)
+        conn.commit()
+    finally:
+        cur.close()
+        conn.close()
+
+class AuditBuffer:
+    """Очередь записей аудита процесса с групповой записью в БД."""
+
+    def __init__(self, flush_interval, flush_rows):
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self._entries = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+        self._stats = {'queued': 0, 'written': 0, 'flushes': 0, 'errors': 0}
+
+    def add(self, entry):
+        with self._lock:
+            self._entries.append(entry)
+            self._stats['queued'] += 1
+            pending = len(self._entries)
+            if self._pid != os.getpid():
+                # Поток записи — свой в каждом процессе (после fork gunicorn)
+                threading.Thread(target=self._run, name='audit-writer', daemon=True).start()
+                self._pid = os.getpid()
+        if pending >= self.flush_rows:
+            self._wakeup.set()
+
+    def flush(self):
+        """Записывает накопленное одной транзакцией. Возвращает число записей."""
+        with self._flush_lock:
+            with self._lock:
+                entries, self._entries = self._entries, []
+            if not entries:
+                return 0
+            try:
+                write_audit_entries(entries)
+            except Exception:
+                with self._lock:
+                    # Возвращаем в начало очереди, чтобы сохранить порядок записей
+                    self._entries[:0] = entries
+                    self._stats['errors'] += 1
+                raise
+            with self._lock:
+                self._stats['written'] += len(entries)
+                self._stats['flushes'] += 1
+            return len(entries)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"⚠️ Запись журнала аудита: {e}")
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._stats, pending=len(self._entries))
+
+audit_buffer = AuditBuffer(AUDIT_FLUSH_INTERVAL_MS / 1000, AUDIT_FLUSH_ROWS)
+
+@atexit.register
+def flush_audit_buffer():
+    try:
+        audit_buffer.flush()
+    except Exception as e:
+        print(f"❌ Не удалось записать журнал аудита при завершении: {e}")
+
+def audit(action, target_user=None, details=None, cur=None, admin_passport=None, admin_name=None):
+    """
+    Записывает действие в журнал аудита. По умолчанию автор — администратор
+    текущей сессии (вне запроса — система).
+    """
+    if admin_passport is None:
+        if has_request_context() and session.get('passport'):
+            admin_passport = session['passport']
+            user_info = current_user_info()
+            admin_name = admin_name or (user_info['full_name'] if user_info else 'Администратор')
+        else:
+            admin_passport, admin_name = 'SYSTEM', admin_name or 'Система'
+    entry = (admin_passport, admin_name or 'Администратор', action, target_user, details, datetime.now())
+    if cur is not None:
+        insert_audit_entries(cur, [entry])
+    elif AUDIT_BUFFERED:
+        audit_buffer.add(entry)
+    else:
+        write_audit_entries([entry])
+
+def ensure_audit_partitions(cur, since=None):
+    """PostgreSQL: секции audit_log по месяцам от since (по умолчанию — текущего) и на несколько месяцев вперёд."""
+    cur.execute('CREATE TABLE IF NOT EXISTS audit_log_default PARTITION OF audit_log DEFAULT')
+    month = month_start(since or datetime.now())
+    last = month_start(datetime.now())
+    for _ in range(AUDIT_PARTITIONS_AHEAD):
+        last = next_month(last)
+    while month <= last:
+        cur.execute(f'''
+            CREATE TABLE IF NOT EXISTS audit_log_{month:%Y_%m} PARTITION OF audit_log
+            FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{next_month(month):%Y-%m-%d}')
+        ''')
+        month = next_month(month)
+
+def rename_legacy_audit_log(cur):
+    """PostgreSQL: журнал, созданный до секционирования, переименовывается для переноса. True, если он был."""
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('audit_log')")
+    row = cur.fetchone()
+    if not row or row['relkind'] == 'p':
+        return False
+    cur.execute('ALTER TABLE audit_log RENAME TO audit_log_legacy')
+    cur.execute('ALTER INDEX IF EXISTS idx_audit_log_timestamp RENAME TO idx_audit_log_legacy_timestamp')
+    return True
+
+def import_legacy_audit_log(cur):
+    cur.execute('SELECT MIN(timestamp) AS first FROM audit_log_legacy')
+    ensure_audit_partitions(cur, cur.fetchone()['first'])
+    cur.execute('''
+        INSERT INTO audit_log (id, admin_passport, admin_name, action, target_user, details, timestamp)
+        SELECT id, admin_passport, admin_name, action, target_user, details, COALESCE(timestamp, CURRENT_TIMESTAMP)
+        FROM audit_log_legacy
+    ''')
+    cur.execute('''
+        SELECT setval(pg_get_serial_sequence('audit_log', 'id'), COALESCE((SELECT MAX(id) FROM audit_log), 0) + 1, false)
+    ''')
+    cur.execute('DROP TABLE audit_log_legacy')
+    print("✅ Журнал аудита перенесён в секционированную таблицу")
+
+def audit_archive_tables(cur):
+    """SQLite: архивные таблицы журнала, от новых к старым."""
+    cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'audit_log_%'")
+    return sorted((row['name'] for row in cur.fetchall() if AUDIT_ARCHIVE_PATTERN.match(row['name'])), reverse=True)
+
+def rotate_audit_log(cur):
+    """SQLite: переносит записи прошлых месяцев из audit_log в audit_log_ГГГГ_ММ (без commit)."""
+    current = month_start(datetime.now()).strftime('%Y-%m-%d')
+    cur.execute("SELECT DISTINCT strftime('%Y_%m', timestamp) AS month FROM audit_log WHERE timestamp < ?",
+                (current,))
+    months = [row['month'] for row in cur.fetchall() if row['month']]
+    for month in months:
+        table = f'audit_log_{month}'
+        cur.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                id INTEGER PRIMARY KEY,
+                admin_passport TEXT NOT NULL,
+                admin_name TEXT NOT NULL,
+                action TEXT NOT NULL,
+                target_user TEXT,
+                details TEXT,
+                timestamp TIMESTAMP
+            )
+        ''')
+        cur.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_timestamp ON {table}(timestamp)')
+        cur.execute(f'''
+            INSERT INTO {table} (id, admin_passport, admin_name, action, target_user, details, timestamp)
+            SELECT id, admin_passport, admin_name, action, target_user, details, timestamp FROM audit_log
+            WHERE strftime('%Y_%m', timestamp) = ? AND timestamp < ?
+        ''', (month, current))
+    if months:
+        cur.execute('DELETE FROM audit_log WHERE timestamp < ?', (current,))
+    return len(months)
+
+def maintain_audit_log():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        begin_write_transaction(conn)
+        if USE_POSTGRESQL:
+            ensure_audit_partitions(cur)
+            result = {'partitions_ahead': AUDIT_PARTITIONS_AHEAD}
+        else:
+            result = {'rotated_months': rotate_audit_log(cur)}
+        conn.commit()
+        return result
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+@background_task('maintain_audit_log', AUDIT_MAINTENANCE_INTERVAL)
+def maintain_audit_log_task():
+    return maintain_audit_log()
+
+def fetch_audit_log(cur, limit):
+    """Последние limit записей журнала (включая ещё не сброшенные из буфера этого процесса)."""
+    audit_buffer.flush()
+    if USE_POSTGRESQL:
+        cur.execute('SELECT * FROM audit_log ORDER BY timestamp DESC, id DESC LIMIT %s', (limit,))
+        return [dict(row) for row in cur.fetchall()]
+    logs = []
+    for table in ['audit_log'] + audit_archive_tables(cur):
+        cur.execute(f'SELECT * FROM {table} ORDER BY timestamp DESC, id DESC LIMIT ?', (limit - len(logs),))
+        logs.extend(dict(row) for row in cur.fetchall())
+        if len(logs) >= limit:
+            break
+    return logs
+
+# ==================== СЕССИИ НА СЕРВЕРЕ ====================
+# В cookie лежит только случайный идентификатор сессии, а её содержимое
+# (вход, id пользователя, роль, flash-сообщения) — на сервере:
+# - SESSION_STORE=database (по умолчанию) — таблица web_sessions основной БД;
+# - SESSION_STORE=local — файл SQLite в /dev/shm, общий для воркеров одной машины.
+# Перед БД по умолчанию стоит этот же файл как общий кэш машины, так что
+# обычный запрос читает сессию без обращения к БД. Сервис на Render работает
+# на одной машине (у него примонтирован диск); если машин станет несколько,
+# кэш нужно выключить (SESSION_LOCAL_CACHE=0) — выход на одной машине не
+# удалит сессию из кэша другой. Профиль пользователя в сессию не кладётся:
+# current_user_info() читает его из БД при первом обращении в запросе.
+# Сессия записывается, только если изменилась или истекает меньше чем через
+# половину срока. Запросы к статике и запросы без cookie хранилище не трогают.
+
+SESSION_STORE = os.environ.get('SESSION_STORE', 'database')
+SESSION_LOCAL_CACHE = os.environ.get('SESSION_LOCAL_CACHE', '1') == '1'
+SESSION_SWEEP_INTERVAL = float(os.environ.get('SESSION_SWEEP_INTERVAL', 3600))
+
+def default_session_store_path():
+    target = os.environ.get('DATABASE_URL') or os.path.abspath(SQLITE_PATH)
+    suffix = hashlib.sha256(target.encode()).hexdigest()[:12]
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, f'dvorpay_sessions_{suffix}.db')
+
+class LocalSessionStore:
+    """Сессии в локальном файле SQLite, общем для процессов одной машины."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _connection(self):
+        if self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS web_sessions (
+                    sid TEXT PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_web_sessions_expires ON web_sessions(expires_at)')
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            cur = self._connection().execute(sql, params)
+            return cur.fetchall(), cur.rowcount
+
+    def get(self, sid):
+        """(data, expires_at) живой сессии или None."""
+        rows, _ = self._execute('SELECT data, expires_at FROM web_sessions WHERE sid = ? AND expires_at > ?',
+                                (sid, time.time()))
+        return (rows[0][0], datetime.fromtimestamp(rows[0][1])) if rows else None
+
+    def save(self, sid, data, expires_at):
+        self._execute('INSERT OR REPLACE INTO web_sessions (sid, data, expires_at) VALUES (?, ?, ?)',
+                      (sid, data, expires_at.timestamp()))
+
+    def delete(self, sid):
+        self._execute('DELETE FROM web_sessions WHERE sid = ?', (sid,))
+
+    def sweep(self):
+        _, count = self._execute('DELETE FROM web_sessions WHERE expires_at <= ?', (time.time(),))
+        return count
+
+class DatabaseSessionStore:
+    """Сессии в таблице web_sessions основной БД."""
+
+    def _execute(self, query, params=(), fetch=False):
+        # Отдельное соединение из пула: commit сессии не должен зафиксировать
+        # незавершённую транзакцию обработчика
+        conn = DBConnection(get_db_pool().acquire(), request_scoped=False)
+        cur = conn.cursor()
+        try:
+            execute(cur, query, params)
+            rows = cur.fetchall() if fetch else None
+            count = cur.rowcount
+            conn.commit()
+        finally:
+            cur.close()
+            conn.close()
+        return rows, count
+
+    def get(self, sid):
+        rows, _ = self._execute('SELECT data, expires_at FROM web_sessions WHERE sid = ? AND expires_at > ?',
+                                (sid, datetime.now()), fetch=True)
+        if not rows:
+            return None
+        expires_at = rows[0]['expires_at']
+        if isinstance(expires_at, str):
+            expires_at = datetime.fromisoformat(expires_at)
+        return rows[0]['data'], expires_at
+
+    def save(self, sid, data, expires_at):
+        self._execute('''
+            INSERT INTO web_sessions (sid, data, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT (sid) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at
+        ''', (sid, data, expires_at))
+
+    def delete(self, sid):
+        self._execute('DELETE FROM web_sessions WHERE sid = ?', (sid,))
+
+    def sweep(self):
+        _, count = self._execute('DELETE FROM web_sessions WHERE expires_at <= ?', (datetime.now(),))
+        return count
+
+class CachedSessionStore:
+    """Основное хранилище с общим кэшем машины перед ним (сквозная запись)."""
+
+    def __init__(self, primary, cache):
+        self.primary = primary
+        self.cache = cache
+
+    def get(self, sid):
+        found = self.cache.get(sid)
+        if found is None:
+            found = self.primary.get(sid)
+            if found is not None:
+                self.cache.save(sid, *found)
+        return found
+
+    def save(self, sid, data, expires_at):
+        self.primary.save(sid, data, expires_at)
+        self.cache.save(sid, data, expires_at)
+
+    def delete(self, sid):
+        self.primary.delete(sid)
+        self.cache.delete(sid)
+
+    def sweep(self):
+        self.cache.sweep()
+        return self.primary.sweep()
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, expires_at=None, detached=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires_at = expires_at
+        self.modified = False
+        # Сессия не читалась из хранилища (статика, ошибка хранилища) —
+        # записывать её нельзя, иначе пустая сессия заменит настоящую
+        self.detached = detached
+
+    def regenerate(self):
+        """Новый идентификатор при входе: прежний (возможно, известный злоумышленнику) удаляется."""
+        self.previous_sid = self.sid
+        self.sid = None
+        self.modified = True
+
+class ServerSessionInterface(SessionInterface):
+    serializer = session_json_serializer
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if not sid:
+            return ServerSession()
+        # open_session вызывается до сопоставления URL, поэтому статика — по пути
+        if app.static_url_path and request.path.startswith(app.static_url_path + '/'):
+            return ServerSession(detached=True)
+        try:
+            found = self.store.get(sid)
+        except Exception as e:
+            # Недоступное хранилище (например, PoolTimeout) не должно ронять каждую страницу
+            print(f"⚠️ Хранилище сессий недоступно: {e}")
+            return ServerSession(detached=True)
+        if found is not None:
+            data, expires_at = found
+            try:
+                return ServerSession(self.serializer.loads(data), sid, expires_at)
+            except ValueError:
+                pass
+        return ServerSession()
+
+    def save_session(self, app, session, response):
+        if getattr(session, 'detached', False):
+            return
+        # Обработчик закончил работу: его соединение возвращается в пул до записи
+        # сессии, чтобы запрос не занимал два соединения сразу
+        release_db_connection(None)
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        previous_sid = getattr(session, 'previous_sid', None)
+        if previous_sid:
+            self.store.delete(previous_sid)
+        if not session:
+            if session.sid:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        now = datetime.now()
+        lifetime = app.permanent_session_lifetime
+        if not session.modified and session.expires_at and session.expires_at - now > lifetime / 2:
+            return
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(32)
+        session.expires_at = now + lifetime
+        self.store.save(session.sid, self.serializer.dumps(dict(session)), session.expires_at)
+        response.set_cookie(name, session.sid,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path,
+                            secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+def make_session_store():
+    if SESSION_STORE == 'local':
+        return LocalSessionStore(os.environ.get('SESSION_STORE_PATH') or default_session_store_path())
+    if SESSION_LOCAL_CACHE:
+        return CachedSessionStore(DatabaseSessionStore(),
+                                  LocalSessionStore(os.environ.get('SESSION_STORE_PATH') or default_session_store_path()))
+    return DatabaseSessionStore()
+
+app.session_interface = ServerSessionInterface(make_session_store())
+
+def current_user_info():
+    """Профиль вошедшего пользователя (без хэша пароля); читается из БД один раз за запрос."""
+    if not session.get('user_id'):
+        return None
+    if 'current_user_info' not in g:
+        user = find_user_by_id(session['user_id'])
+        if user is not None:
+            user = dict(user)
+            user.pop('password_hash', None)
+        g.current_user_info = user
+    return g.current_user_info
+
+class SessionUser:
+    """Вошедший пользователь для шаблонов: ФИО — из кэша счетов, остальное — из профиля при первом обращении."""
+
+    def __bool__(self):
+        return bool(session.get('user_id'))
+
+    def __getattr__(self, name):
+        if name in ('passport', 'account_number') and name in session:
+            return session[name]
+        if name == 'full_name' and session.get('account_number'):
+            preview = lookup_account_preview(session['account_number'])
+            if preview is not None:
+                return preview['full_name']
+        user = current_user_info()
+        return user.get(name) if user else None
+
+@app.context_processor
+def inject_current_user():
+    return {'current_user': SessionUser()}
+
+@background_task('sweep_web_sessions', SESSION_SWEEP_INTERVAL)
+def sweep_web_sessions_task():
+    return {'deleted': app.session_interface.store.sweep()}
+
+# ==================== УВЕДОМЛЕНИЯ О ПЛАТЕЖАХ ====================
+# Терминал ждёт оплату через Server-Sent Events вместо опроса раз в 2 секунды.
+# confirm_nfc_payment после commit будит ожидающих в своём процессе, а в PostgreSQL
+# ещё и отправляет NOTIFY: остальные воркеры получают его через LISTEN в фоновом
+# потоке. Каждое ожидание занимает поток gunicorn, поэтому их число в процессе
+# ограничено NFC_EVENTS_MAX_WAITERS; сверх лимита отдаётся 503 и страница
+# возвращается к опросу.
+
+PAYMENT_CHANNEL = 'payment_status'
+NFC_EVENTS_MAX_WAITERS = int(os.environ.get('NFC_EVENTS_MAX_WAITERS', 2))
+NFC_EVENTS_MAX_WAIT = float(os.environ.get('NFC_EVENTS_MAX_WAIT', 55))
+# Раз в столько секунд ожидание перепроверяет статус в БД (страховка от потерянного уведомления)
+NFC_EVENTS_RECHECK = float(os.environ.get('NFC_EVENTS_RECHECK', 15))
+
+class PaymentNotifier:
+    """Будит потоки, ждущие изменения статуса конкретной платёжной сессии."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = defaultdict(set)
+        self.published = 0
+
+    def wait(self, session_id, timeout):
+        """Ждёт publish для session_id не дольше timeout секунд. Возвращает payload или None."""
+        event = threading.Event()
+        event.payload = None
+        with self._lock:
+            self._waiters[session_id].add(event)
+        try:
+            event.wait(timeout)
+            return event.payload
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(session_id)
+                if waiters is not None:
+                    waiters.discard(event)
+                    if not waiters:
+                        del self._waiters[session_id]
+
+    def publish(self, session_id, payload):
+        with self._lock:
+            waiters = list(self._waiters.get(session_id, ()))
+            self.published += 1
+        for event in waiters:
+            event.payload = payload
+            event.set()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'sessions': len(self._waiters),
+                'waiters': sum(len(w) for w in self._waiters.values()),
+                'published': self.published
+            }
+
+payment_notifier = PaymentNotifier()
+payment_waiters = threading.BoundedSemaphore(NFC_EVENTS_MAX_WAITERS)
+_payment_listener_pid = None
+_payment_listener_lock = threading.Lock()
+
+def notify_payment_status(cur, session_id, payload):
+    """Ставит NOTIFY в текущую транзакцию: в PostgreSQL он уйдёт остальным воркерам при commit."""
+    if USE_POSTGRESQL:
+        cur.execute('SELECT pg_notify(%s, %s)', (PAYMENT_CHANNEL, json.dumps({'session_id': session_id, **payload})))
+
+def _publish_payment_notify(payload):
+    payload = json.loads(payload)
+    payment_notifier.publish(payload.pop('session_id'), payload)
+
+# Каналы NOTIFY, которые слушает поток LISTEN процесса: канал -> обработчик payload
+DB_LISTENERS = {PAYMENT_CHANNEL: _publish_payment_notify}
+
+def _payment_listener_loop():
+    while True:
+        conn = None
+        try:
+            conn = open_db_connection()
+            conn.autocommit = True
+            cur = conn.cursor()
+            for channel in DB_LISTENERS:
+                cur.execute(f'LISTEN {channel}')
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    try:
+                        DB_LISTENERS[notify.channel](notify.payload)
+                    except (ValueError, KeyError):
+                        continue
+        except Exception as e:
+            print(f"⚠️ LISTEN прерван: {e}")
+            time.sleep(5)
+        finally:
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+
+def ensure_payment_listener():
+    """Запускает поток LISTEN один раз в каждом процессе (после fork у воркера свой поток)."""
+    global _payment_listener_pid
+    if not USE_POSTGRESQL or _payment_listener_pid == os.getpid():
+        return
+    with _payment_listener_lock:
+        if _payment_listener_pid == os.getpid():
+            return
+        threading.Thread(target=_payment_listener_loop, name='payment-listener', daemon=True).start()
+        _payment_listener_pid = os.getpid()
+
+def fetch_payment_status(session_id):
+    """Статус для терминала: ожидающая сессия из хранилища, иначе итог из payment_sessions."""
+    payment_session = get_payment_session_store().get(session_id)
+    if payment_session:
+        status = payment_session['status']
+        if status in ('pending', 'processing'):
+            status = 'expired' if payment_session_expired(payment_session) else 'pending'
+        return {'status': status, 'amount': from_minor(payment_session['amount'])}
+    conn = get_db_connection()
+    cur = conn.cursor()
+    session = fetch_one(cur, 'SELECT status, amount FROM payment_sessions WHERE session_id = ?', (session_id,))
+    cur.close()
+    conn.close()
+    if session:
+        return money_to_json(session)
+    return {'status': 'not_found'}
+
+# ==================== КЭШ СЧЕТОВ ====================
+# Превью получателя перевода запрашивается на каждое нажатие клавиши, поэтому
+# номер счета -> (ФИО, активен ли) кэшируется в процессе (LRU с TTL); несуществующие
+# номера тоже запоминаются, но ненадолго. Изменения users сбрасывают записи
+# через invalidate_account_cache: в своём процессе — после commit, в остальных
+# воркерах — по NOTIFY (PostgreSQL доставляет его тоже только после commit).
+# Раньше commit сбрасывать нельзя: другой поток успеет закэшировать ещё
+# старую строку. Значение, прочитанное до сброса, в кэш тоже не попадает —
+# за этим следит счётчик сбросов. В SQLite межпроцессного канала нет, и
+# чужие воркеры увидят изменение не позже чем через ACCOUNT_CACHE_TTL.
+
+ACCOUNT_CACHE_CHANNEL = 'account_changed'
+ACCOUNT_CACHE_TTL = float(os.environ.get('ACCOUNT_CACHE_TTL', 60))
+ACCOUNT_CACHE_MISS_TTL = 5
+ACCOUNT_CACHE_MAX_ENTRIES = int(os.environ.get('ACCOUNT_CACHE_MAX_ENTRIES', 10000))
+
+account_cache = TTLCache(ACCOUNT_CACHE_TTL, ACCOUNT_CACHE_MAX_ENTRIES)
+_account_cache_resets = 0
+
+def drop_account_cache_entries(account_numbers):
+    global _account_cache_resets
+    _account_cache_resets += 1
+    if account_numbers is None:
+        account_cache.clear()
+    else:
+        for account_number in account_numbers:
+            account_cache.delete(account_number)
+
+DB_LISTENERS[ACCOUNT_CACHE_CHANNEL] = lambda payload: drop_account_cache_entries(json.loads(payload))
+
+def invalidate_account_cache(cur, account_numbers=None):
+    """Сбрасывает кэш для указанных счетов (None — весь кэш) после commit текущей транзакции."""
+    if account_numbers is not None:
+        account_numbers = list(account_numbers)
+    after_commit(cur, lambda: drop_account_cache_entries(account_numbers))
+    if USE_POSTGRESQL:
+        cur.execute('SELECT pg_notify(%s, %s)', (ACCOUNT_CACHE_CHANNEL, json.dumps(account_numbers)))
+
+def lookup_account_preview(account_number):
+    """Возвращает {'full_name', 'is_active'} для номера счета или None."""
+    ensure_payment_listener()
+    cached = account_cache.get(account_number)
+    if cached is not None:
+        return cached or None
+    resets = _account_cache_resets
+    conn = get_db_connection()
+    cur = conn.cursor()
+    row = fetch_one(cur, 'SELECT full_name, is_active FROM users WHERE account_number = ?', (account_number,))
+    cur.close()
+    conn.close()
+    preview = {'full_name': row['full_name'], 'is_active': bool(row['is_active'])} if row else None
+    # Пока шёл запрос, кэш сбрасывали — прочитанная строка могла уже устареть
+    if resets == _account_cache_resets:
+        if preview is None:
+            account_cache.set(account_number, False, ACCOUNT_CACHE_MISS_TTL)
+        else:
+            account_cache.set(account_number, preview)
+    return preview
+
+# ==================== КЭШ БАЛАНСОВ ====================
+# Баланс на дашборде и в /api/me/balance читается из кэша процесса по номеру
+# счета. Каждая запись, меняющая баланс, вызывает balances_changed: после commit
+# версия счета в процессе увеличивается и запись кэша удаляется, а другие
+# воркеры получают NOTIFY (PostgreSQL). Версия защищает от гонки: значение,
+# прочитанное из БД до изменения, не попадёт в кэш после него. В SQLite другие
+# процессы узнают об изменении не позже чем через BALANCE_CACHE_TTL.
+
+BALANCE_CACHE_CHANNEL = 'balance_changed'
+BALANCE_CACHE_TTL = float(os.environ.get('BALANCE_CACHE_TTL', 30))
+BALANCE_CACHE_MAX_ENTRIES = int(os.environ.get('BALANCE_CACHE_MAX_ENTRIES', 10000))
+
+balance_cache = TTLCache(BALANCE_CACHE_TTL, BALANCE_CACHE_MAX_ENTRIES)
+_balance_versions = defaultdict(int)
+_balance_versions_lock = threading.Lock()
+
+def bump_balance_versions(account_numbers):
+    with _balance_versions_lock:
+        for account_number in account_numbers:
+            _balance_versions[account_number] += 1
+            balance_cache.delete(account_number)
+
+def balances_changed(cur, account_numbers):
+    """Отмечает изменение балансов счетов в текущей транзакции (без commit)."""
+    account_numbers = sorted(set(account_numbers))
+    after_commit(cur, lambda: bump_balance_versions(account_numbers))
+    if USE_POSTGRESQL:
+        cur.execute('SELECT pg_notify(%s, %s)', (BALANCE_CACHE_CHANNEL, json.dumps(account_numbers)))
+
+DB_LISTENERS[BALANCE_CACHE_CHANNEL] = lambda payload: bump_balance_versions(json.loads(payload))
+
+def get_account_balance(account_number):
+    """Баланс счета в копейках (с несвёрнутыми корзинами) или None, если счета нет."""
+    ensure_payment_listener()
+    version = _balance_versions[account_number]
+    cached = balance_cache.get(account_number)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    conn = get_db_connection()
+    cur = conn.cursor()
+    if USE_POSTGRESQL:
+        cur.execute(f'SELECT {BALANCE_WITH_BUCKETS} AS balance FROM users WHERE account_number = %s', (account_number,))
+    else:
+        cur.execute(f'SELECT {BALANCE_WITH_BUCKETS} AS balance FROM users WHERE account_number = ?', (account_number,))
+    row = cur.fetchone()
+    cur.close()
+    conn.close()
+    if row is None:
+        return None
+    with _balance_versions_lock:
+        if _balance_versions[account_number] == version:
+            balance_cache.set(account_number, (version, row['balance']))
+    return row['balance']
+
+# ==================== ТАБЛИЦА РОЛЕЙ ====================
+# Проверка прав не читает БД и не разбирает JSON: роли загружаются один раз в
+# неизменяемую таблицу процесса (id -> Role), а права каждой роли разобраны в
+# frozenset. edit_role сбрасывает таблицу через invalidate_role_table: в своём
+# процессе — после commit, в остальных воркерах — по NOTIFY (PostgreSQL).
+# Кроме того, таблица перечитывается раз в ROLE_TABLE_TTL секунд на обеих БД:
+# уведомление может потеряться, пока поток LISTEN переподключается, а в SQLite
+# межпроцессного канала нет вовсе. Таблица, загруженная до сброса, не
+# запоминается — за этим следит счётчик сбросов.
+
+ROLE_TABLE_CHANNEL = 'roles_changed'
+ROLE_TABLE_TTL = float(os.environ.get('ROLE_TABLE_TTL', 30))
+
+Role = namedtuple('Role', ['id', 'role_name', 'level', 'permissions', 'description'])
+
+_role_table = None
+_role_table_loaded_at = 0.0
+_role_table_resets = 0
+_role_table_lock = threading.Lock()
+
+def compile_permissions(raw):
+    """JSON прав из roles.permissions -> frozenset включённых прав."""
+    try:
+        permissions = json.loads(raw or '{}')
+    except ValueError:
+        return frozenset()
+    if not isinstance(permissions, dict):
+        return frozenset()
+    return frozenset(name for name, enabled in permissions.items() if enabled)
+
+def load_role_table():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('SELECT id, role_name, level, permissions, description FROM roles')
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    return MappingProxyType({
+        row['id']: Role(row['id'], row['role_name'], row['level'], compile_permissions(row['permissions']),
+                        row['description'])
+        for row in rows
+    })
+
+def get_role_table():
+    """Таблица ролей процесса; загружается при первом обращении и после сброса."""
+    global _role_table, _role_table_loaded_at
+    ensure_payment_listener()
+    table = _role_table
+    if table is not None and time.monotonic() - _role_table_loaded_at < ROLE_TABLE_TTL:
+        return table
+    with _role_table_lock:
+        if _role_table is table:
+            resets = _role_table_resets
+            loaded = load_role_table()
+            if resets != _role_table_resets:
+                # Таблицу сбросили, пока она читалась, — прочитанное могло устареть
+                return loaded
+            _role_table = loaded
+            _role_table_loaded_at = time.monotonic()
+        return _role_table
+
+def reset_role_table():
+    global _role_table, _role_table_resets
+    _role_table_resets += 1
+    _role_table = None
+
+def invalidate_role_table(cur=None):
+    """Сбрасывает таблицу ролей после commit транзакции cur (без cur — сразу)."""
+    if cur is None:
+        reset_role_table()
+        return
+    after_commit(cur, reset_role_table)
+    if USE_POSTGRESQL:
+        cur.execute('SELECT pg_notify(%s, %s)', (ROLE_TABLE_CHANNEL, ''))
+
+DB_LISTENERS[ROLE_TABLE_CHANNEL] = lambda payload: reset_role_table()
+
+def find_role(role_id=None, role_name=None):
+    """Роль из таблицы по id (или по имени, если id неизвестен)."""
+    table = get_role_table()
+    if role_id is not None:
+        return table.get(role_id)
+    for role in table.values():
+        if role.role_name == role_name:
+            return role
+    return None
+
+def session_role():
+    """Роль текущего пользователя. Сессии, открытые до появления role_id, ищутся по имени роли."""
+    return find_role(session.get('role_id'), session.get('role'))
+
+# ==================== МИГРАЦИИ СХЕМЫ ====================
+# Схема БД меняется упорядоченными миграциями, номер последней применённой
+# хранится в schema_version. При импорте приложение только сравнивает этот
+# номер с SCHEMA_VERSION; миграции выполняются, лишь если БД отстала. С
+# preload_app (gunicorn_config.py) импорт происходит один раз в мастере gunicorn
+# до fork, и воркеры стартуют сразу. Применить миграции вручную — `flask migrate-db`.
+# Новая миграция добавляется в конец MIGRATIONS со следующим номером.
+
+def add_idempotency_request_hash(cur):
+    add_column_if_missing(cur, 'idempotency_keys', 'request_hash', 'TEXT')
+
+MIGRATIONS = [
+    (1, 'Базовая схема', create_schema),
+    (2, 'Тестовые пользователи и бизнес', seed_test_data),
+    (3, 'Сводная статистика', init_stats),
+    (4, 'Хеш запроса для ключей идемпотентности', add_idempotency_request_hash),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version(cur):
+    """Номер последней применённой миграции (0 — БД ещё не размечена)."""
+    if USE_POSTGRESQL:
+        cur.execute("SELECT to_regclass('schema_version') IS NOT NULL AS present")
+    else:
+        cur.execute("SELECT COUNT(*) > 0 AS present FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'")
+    if not cur.fetchone()['present']:
+        return 0
+    cur.execute('SELECT COALESCE(MAX(version), 0) AS version FROM schema_version')
+    return cur.fetchone()['version']
+
+def migrate_db():
+    """Применяет недостающие миграции, каждую в своей транзакции. Возвращает список применённых."""
+    applied = []
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        for version, name, migration in MIGRATIONS:
+            begin_write_transaction(conn)
+            if USE_POSTGRESQL:
+                # Воркеры без preload_app могут стартовать одновременно — миграции идут по очереди
+                cur.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', ('schema_version',))
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            if get_schema_version(cur) >= version:
+                conn.commit()
+                continue
+            migration(cur)
+            execute(cur, 'INSERT INTO schema_version (version, name) VALUES (?, ?)', (version, name))
+            conn.commit()
+            applied.append((version, name))
+            print(f"✅ Миграция {version}: {name}")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+    return applied
+
+def ensure_schema():
+    """Проверка при старте: миграции запускаются, только если БД отстала от кода."""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    version = get_schema_version(cur)
+    conn.rollback()
+    cur.close()
+    conn.close()
+    if version > SCHEMA_VERSION:
+        print(f"⚠️ Схема БД ({version}) новее кода ({SCHEMA_VERSION})")
+    elif version < SCHEMA_VERSION:
+        migrate_db()
+    return version
+
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    """Применить недостающие миграции схемы."""
+    applied = migrate_db()
+    print(f"✅ Схема БД в версии {SCHEMA_VERSION}, применено миграций: {len(applied)}")
+
 # ==================== ИНИЦИАЛИЗАЦИЯ БД ПРИ СТАРТЕ ====================
 with app.app_context():
     try:
-        init_db()
-        print("✅ База данных инициализирована при старте")
+        ensure_schema()
     except Exception as e:
         print(f"❌ Ошибка инициализации БД: {e}")
+# Соединения, открытые при импорте, не должны достаться воркерам после fork
+get_db_pool().close_idle()
+
 
 # ==================== МАРШРУТЫ (с исправлениями для NFC) ====================
 
@@ -1344,13 +4273,14 @@ def login():
             flash('Неверный номер паспорта или пароль', 'error')
             return redirect(url_for('index'))
 
+        session.regenerate()
         session['logged_in'] = True
         session['passport'] = passport
         session['user_id'] = user['id']
-        session['user_info'] = user
+        session['account_number'] = user['account_number']
         session['role'] = user['role_name']
+        session['role_id'] = user['role_id']
         session['role_level'] = user['level']
-        session['permissions'] = user['permissions']
 
         if user['role_name'] != 'user':
             return redirect(url_for('admin_panel'))
@@ -1364,15 +4294,38 @@ def login():
 def dashboard():
     if not session.get('logged_in'):
         return redirect(url_for('index'))
-    user_info = session.get('user_info', {})
-    transactions = get_user_transactions(user_info['account_number'], 10)
-    return render_template('dashboard.html', user=user_info, transactions=transactions)
+    # Профиль целиком не нужен: ФИО, статус и баланс берутся из кэшей процесса
+    account_number = session['account_number']
+    preview = lookup_account_preview(account_number)
+    if preview is None:
+        session.clear()
+        return redirect(url_for('index'))
+    user_info = {
+        'passport': session['passport'],
+        'account_number': account_number,
+        'full_name': preview['full_name'],
+        'is_active': preview['is_active'],
+        'balance': get_account_balance(account_number),
+    }
+    transactions, next_cursor = get_user_transactions_page(account_number, 10)
+    return render_template('dashboard.html', user=user_info, transactions=transactions, next_cursor=next_cursor)
+
+@app.route('/api/me/balance')
+def api_my_balance():
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Не авторизован'}), 401
+    balance = get_account_balance(session['account_number'])
+    if balance is None:
+        return jsonify({'error': 'Пользователь не найден'}), 404
+    response = jsonify({'balance': from_minor(balance), 'formatted': format_money(balance)})
+    response.headers['Cache-Control'] = 'no-store'
+    return response
 
 @app.route('/documents')
 def documents():
     if not session.get('logged_in'):
         return redirect(url_for('index'))
-    user_info = session.get('user_info', {})
+    user_info = current_user_info()
     return render_template('documents.html', user=user_info)
 
 @app.route('/change_password', methods=['GET', 'POST'])
@@ -1400,12 +4353,8 @@ def change_password():
 
         conn = get_db_connection()
         cur = conn.cursor()
-        if USE_POSTGRESQL:
-            cur.execute('UPDATE users SET password_hash = %s WHERE passport = %s',
-                        (generate_password_hash(new_password), session.get('passport')))
-        else:
-            cur.execute('UPDATE users SET password_hash = ? WHERE passport = ?',
-                        (generate_password_hash(new_password), session.get('passport')))
+        execute(cur, 'UPDATE users SET password_hash = ? WHERE passport = ?',
+                     (generate_password_hash(new_password), session.get('passport')))
         conn.commit()
         cur.close()
         conn.close()
@@ -1416,54 +4365,60 @@ def change_password():
     return render_template('change_password.html')
 
 @app.route('/transfer', methods=['POST'])
+@idempotent
 def transfer_money():
     if not session.get('logged_in'):
         return jsonify({'success': False, 'message': 'Не авторизован'})
 
-    from_account = request.form['from_account']
+    # Списать можно только со своего счета; поле формы оставлено для старых клиентов
+    from_account = session['account_number']
+    if request.form.get('from_account', from_account) != from_account:
+        return jsonify({'success': False, 'message': 'Перевод возможен только со своего счета'}), 403
     to_account = request.form['to_account']
-    amount = float(request.form['amount'])
+    try:
+        amount = to_minor(request.form['amount'])
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Неверная сумма'})
     description = request.form.get('description', '')
 
-    from_user = find_user_by_account(from_account)
-    to_user = find_user_by_account(to_account)
-
-    if not from_user or not to_user:
-        return jsonify({'success': False, 'message': 'Счет не найден'})
-
-    if from_user['balance'] < amount:
-        return jsonify({'success': False, 'message': 'Недостаточно средств'})
-
-    if not from_user['is_active'] or not to_user['is_active']:
-        return jsonify({'success': False, 'message': 'Счет заблокирован'})
-
-    new_from_balance = from_user['balance'] - amount
-    new_to_balance = to_user['balance'] + amount
-
-    update_user_balance(from_account, new_from_balance)
-    update_user_balance(to_account, new_to_balance)
-
-    add_transaction('Перевод', from_account, to_account, amount, 'Успешно', description, from_user['id'])
+    try:
+        result = execute_transfer(from_account, to_account, amount, description, session['user_id'])
+    except TransferError as e:
+        return jsonify({'success': False, 'message': str(e)})
 
-    if session.get('passport') == from_user['passport']:
-        session['user_info']['balance'] = new_from_balance
+    new_from_balance = result['new_from_balance']
 
     return jsonify({
         'success': True,
-        'message': f'Перевод на сумму {amount} руб. успешно выполнен',
-        'new_balance': new_from_balance
+        'message': f'Перевод на сумму {format_money(amount)} руб. успешно выполнен',
+        'new_balance': from_minor(new_from_balance)
     })
 
 @app.route('/get_user_by_account/<account>')
 def get_user_by_account(account):
     if not session.get('logged_in'):
         return jsonify({'error': 'Не авторизован'})
-    user = find_user_by_account(account)
+    user = lookup_account_preview(account)
     if user:
-        return jsonify({'name': user['full_name'], 'account': user['account_number']})
+        return jsonify({'name': user['full_name'], 'account': account})
     else:
         return jsonify({'error': 'Пользователь не найден'})
 
+@app.route('/api/transactions')
+def api_user_transactions():
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Не авторизован'}), 401
+    limit = parse_page_limit(request.args.get('limit'), 20)
+    try:
+        transactions, next_cursor = get_user_transactions_page(
+            session['account_number'], limit, request.args.get('cursor'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({
+        'transactions': [money_to_json(t) for t in transactions],
+        'next_cursor': next_cursor
+    })
+
 # ==================== БИЗНЕС МАРШРУТЫ ====================
 
 @app.route('/business/apply', methods=['GET', 'POST'])
@@ -1473,14 +4428,14 @@ def business_apply():
     if request.method == 'POST':
         try:
             business_name = request.form['business_name']
-            charter_capital = float(request.form['charter_capital'])
+            charter_capital = to_minor(request.form['charter_capital'])
             legal_name = request.form.get('legal_name', '')
             tax_id = request.form.get('tax_id', '')
             address = request.form.get('address', '')
             email = request.form.get('email', '')
             phone = request.form.get('phone', '')
 
-            if charter_capital < 10000:
+            if charter_capital < to_minor(10000):
                 flash('Минимальный уставной капитал - 10,000 ₽', 'error')
                 return render_template('business_apply.html')
 
@@ -1494,6 +4449,33 @@ def business_apply():
             flash(f'Ошибка при подаче заявки: {str(e)}', 'error')
     return render_template('business_apply.html')
 
+@app.route('/api/business/batch_transfer', methods=['POST'])
+@idempotent
+def business_batch_transfer():
+    if not session.get('logged_in'):
+        return jsonify({'success': False, 'error': 'Не авторизован'}), 401
+    if session.get('role') != 'business':
+        return jsonify({'success': False, 'error': 'Пакетные переводы доступны только бизнес-счетам'}), 403
+    data = request.get_json(silent=True) or {}
+    rows = data.get('rows')
+    if not isinstance(rows, list) or not rows:
+        return jsonify({'success': False, 'error': 'Нет строк для перевода'}), 400
+
+    try:
+        result = execute_batch_transfer(session['user_id'], rows)
+    except TransferError as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+    return jsonify({
+        'success': True,
+        'message': f'Выполнено переводов: {result["processed"]}, с ошибками: {result["failed"]}',
+        'processed': result['processed'],
+        'failed': result['failed'],
+        'total': from_minor(result['total']),
+        'new_balance': from_minor(result['new_balance']),
+        'results': [money_to_json(r) for r in result['results']]
+    })
+
 @app.route('/admin/business_applications')
 @require_permission('manage_users')
 def admin_business_applications():
@@ -1541,28 +4523,19 @@ def business_withdraw():
         return redirect(url_for('index'))
     conn = get_db_connection()
     cur = conn.cursor()
-    if USE_POSTGRESQL:
-        cur.execute('''
-            SELECT ba.*, b.business_name
-            FROM business_accounts ba
-            JOIN businesses b ON ba.business_id = b.id
-            WHERE b.user_id = %s AND b.status = 'approved' AND ba.is_active = TRUE
-        ''', (session['user_id'],))
-    else:
-        cur.execute('''
-            SELECT ba.*, b.business_name
-            FROM business_accounts ba
-            JOIN businesses b ON ba.business_id = b.id
-            WHERE b.user_id = ? AND b.status = 'approved' AND ba.is_active = 1
-        ''', (session['user_id'],))
-    business_accounts = cur.fetchall()
+    business_accounts = fetch_all(cur, '''
+        SELECT ba.*, b.business_name
+        FROM business_accounts ba
+        JOIN businesses b ON ba.business_id = b.id
+        WHERE b.user_id = ? AND b.status = 'approved' AND ba.is_active = TRUE
+    ''', (session['user_id'],))
     cur.close()
     conn.close()
 
     if request.method == 'POST':
         try:
             business_account_id = int(request.form['business_account_id'])
-            amount = float(request.form['amount'])
+            amount = to_minor(request.form['amount'])
             purpose = request.form['purpose']
             recipient_name = request.form.get('recipient_name', '')
             recipient_account = request.form.get('recipient_account', '')
@@ -1597,35 +4570,19 @@ def admin_withdrawal_requests():
 def view_withdrawal_request(request_id):
     conn = get_db_connection()
     cur = conn.cursor()
-    if USE_POSTGRESQL:
-        cur.execute('''
-            SELECT wr.*,
-                   ba.account_number,
-                   b.business_name, b.legal_name, b.tax_id,
-                   u.passport, u.full_name, u.email, u.phone,
-                   p.full_name as processed_by_name
-            FROM withdrawal_requests wr
-            JOIN business_accounts ba ON wr.business_account_id = ba.id
-            JOIN businesses b ON ba.business_id = b.id
-            JOIN users u ON wr.user_id = u.id
-            LEFT JOIN users p ON wr.processed_by = p.id
-            WHERE wr.id = %s
-        ''', (request_id,))
-    else:
-        cur.execute('''
-            SELECT wr.*,
-                   ba.account_number,
-                   b.business_name, b.legal_name, b.tax_id,
-                   u.passport, u.full_name, u.email, u.phone,
-                   p.full_name as processed_by_name
-            FROM withdrawal_requests wr
-            JOIN business_accounts ba ON wr.business_account_id = ba.id
-            JOIN businesses b ON ba.business_id = b.id
-            JOIN users u ON wr.user_id = u.id
-            LEFT JOIN users p ON wr.processed_by = p.id
-            WHERE wr.id = ?
-        ''', (request_id,))
-    request_data = cur.fetchone()
+    request_data = fetch_one(cur, '''
+        SELECT wr.*,
+               ba.account_number,
+               b.business_name, b.legal_name, b.tax_id,
+               u.passport, u.full_name, u.email, u.phone,
+               p.full_name as processed_by_name
+        FROM withdrawal_requests wr
+        JOIN business_accounts ba ON wr.business_account_id = ba.id
+        JOIN businesses b ON ba.business_id = b.id
+        JOIN users u ON wr.user_id = u.id
+        LEFT JOIN users p ON wr.processed_by = p.id
+        WHERE wr.id = ?
+    ''', (request_id,))
     cur.close()
     conn.close()
 
@@ -1662,11 +4619,7 @@ def admin_nfc():
             if not user_id:
                 passport = request.form.get('passport')
                 if passport:
-                    if USE_POSTGRESQL:
-                        cur.execute("SELECT id FROM users WHERE passport = %s", (passport,))
-                    else:
-                        cur.execute("SELECT id FROM users WHERE passport = ?", (passport,))
-                    user_row = cur.fetchone()
+                    user_row = fetch_one(cur, "SELECT id FROM users WHERE passport = ?", (passport,))
                     if user_row:
                         user_id = user_row['id']
             if not user_id:
@@ -1680,11 +4633,7 @@ def admin_nfc():
             pin_code = request.form.get('pin_code', '0000')
 
             # проверка уникальности UID
-            if USE_POSTGRESQL:
-                cur.execute("SELECT * FROM nfc_tags WHERE tag_uid = %s", (tag_uid,))
-            else:
-                cur.execute("SELECT * FROM nfc_tags WHERE tag_uid = ?", (tag_uid,))
-            existing = cur.fetchone()
+            existing = fetch_one(cur, "SELECT * FROM nfc_tags WHERE tag_uid = ?", (tag_uid,))
             if existing:
                 flash('NFC-метка с таким UID уже зарегистрирована', 'error')
                 return redirect(url_for('admin_nfc'))
@@ -1706,63 +4655,34 @@ def admin_nfc():
                 nfc_tag_id = cur.lastrowid
 
             real_url = generate_nfc_url(nfc_tag_id)
-            if USE_POSTGRESQL:
-                cur.execute("UPDATE nfc_tags SET tag_url = %s WHERE id = %s", (real_url, nfc_tag_id))
-            else:
-                cur.execute("UPDATE nfc_tags SET tag_url = ? WHERE id = ?", (real_url, nfc_tag_id))
+            execute(cur, "UPDATE nfc_tags SET tag_url = ? WHERE id = ?", (real_url, nfc_tag_id))
 
-            create_pin_for_nfc(user_id, nfc_tag_id, pin_code)
+            create_pin_for_nfc(cur, user_id, nfc_tag_id, pin_code)
 
             conn.commit()
 
-            if USE_POSTGRESQL:
-                cur.execute("SELECT * FROM users WHERE id = %s", (user_id,))
-            else:
-                cur.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-            user = cur.fetchone()
+            user = fetch_one(cur, "SELECT * FROM users WHERE id = ?", (user_id,))
             flash(f'NFC-метка зарегистрирована для пользователя {user["full_name"]}. PIN: {pin_code}', 'success')
 
     # Загружаем список пользователей для выпадающего списка (только role_id=6)
-    if USE_POSTGRESQL:
-        cur.execute('''
-            SELECT u.id, u.full_name, u.passport, u.account_number, r.role_name
-            FROM users u
-            JOIN roles r ON u.role_id = r.id
-            WHERE u.is_active = TRUE AND u.role_id = 6
-            ORDER BY u.full_name
-        ''')
-    else:
-        cur.execute('''
-            SELECT u.id, u.full_name, u.passport, u.account_number, r.role_name
-            FROM users u
-            JOIN roles r ON u.role_id = r.id
-            WHERE u.is_active = 1 AND u.role_id = 6
-            ORDER BY u.full_name
-        ''')
-    users = cur.fetchall()
+    users = fetch_all(cur, '''
+        SELECT u.id, u.full_name, u.passport, u.account_number, r.role_name
+        FROM users u
+        JOIN roles r ON u.role_id = r.id
+        WHERE u.is_active = TRUE AND u.role_id = 6
+        ORDER BY u.full_name
+    ''')
 
     # Загружаем зарегистрированные NFC-метки
-    if USE_POSTGRESQL:
-        cur.execute('''
-            SELECT n.*, u.full_name, u.passport, u.account_number, r.role_name,
-                   up.attempts, up.is_locked, up.last_attempt
-            FROM nfc_tags n
-            JOIN users u ON n.user_id = u.id
-            JOIN roles r ON u.role_id = r.id
-            LEFT JOIN user_pins up ON n.id = up.nfc_tag_id AND u.id = up.user_id
-            ORDER BY n.created_at DESC
-        ''')
-    else:
-        cur.execute('''
-            SELECT n.*, u.full_name, u.passport, u.account_number, r.role_name,
-                   up.attempts, up.is_locked, up.last_attempt
-            FROM nfc_tags n
-            JOIN users u ON n.user_id = u.id
-            JOIN roles r ON u.role_id = r.id
-            LEFT JOIN user_pins up ON n.id = up.nfc_tag_id AND u.id = up.user_id
-            ORDER BY n.created_at DESC
-        ''')
-    nfc_tags = cur.fetchall()
+    nfc_tags = fetch_all(cur, '''
+        SELECT n.*, u.full_name, u.passport, u.account_number, r.role_name,
+               up.attempts, up.is_locked, up.last_attempt
+        FROM nfc_tags n
+        JOIN users u ON n.user_id = u.id
+        JOIN roles r ON u.role_id = r.id
+        LEFT JOIN user_pins up ON n.id = up.nfc_tag_id AND u.id = up.user_id
+        ORDER BY n.created_at DESC
+    ''')
 
     cur.close()
     conn.close()
@@ -1781,21 +4701,12 @@ def nfc_payment_page(nfc_tag_id, token):
     cur = conn.cursor()
 
     # получаем данные NFC-метки
-    if USE_POSTGRESQL:
-        cur.execute('''
-            SELECT n.*, u.full_name, u.account_number, u.balance, u.email
-            FROM nfc_tags n
-            JOIN users u ON n.user_id = u.id
-            WHERE n.id = %s AND n.is_active = TRUE
-        ''', (nfc_tag_id,))
-    else:
-        cur.execute('''
-            SELECT n.*, u.full_name, u.account_number, u.balance, u.email
-            FROM nfc_tags n
-            JOIN users u ON n.user_id = u.id
-            WHERE n.id = ? AND n.is_active = 1
-        ''', (nfc_tag_id,))
-    nfc_tag = cur.fetchone()
+    nfc_tag = fetch_one(cur, '''
+        SELECT n.*, u.full_name, u.account_number, u.balance, u.email
+        FROM nfc_tags n
+        JOIN users u ON n.user_id = u.id
+        WHERE n.id = ? AND n.is_active = TRUE
+    ''', (nfc_tag_id,))
 
     if not nfc_tag:
         cur.close()
@@ -1803,21 +4714,12 @@ def nfc_payment_page(nfc_tag_id, token):
         return render_template('nfc_error.html', error="NFC-метка не найдена или заблокирована")
 
     # получаем продавца (текущий пользователь) – должен быть бизнесом
-    if USE_POSTGRESQL:
-        cur.execute('''
-            SELECT u.*, r.role_name
-            FROM users u
-            JOIN roles r ON u.role_id = r.id
-            WHERE u.id = %s
-        ''', (session['user_id'],))
-    else:
-        cur.execute('''
-            SELECT u.*, r.role_name
-            FROM users u
-            JOIN roles r ON u.role_id = r.id
-            WHERE u.id = ?
-        ''', (session['user_id'],))
-    seller = cur.fetchone()
+    seller = fetch_one(cur, '''
+        SELECT u.*, r.role_name
+        FROM users u
+        JOIN roles r ON u.role_id = r.id
+        WHERE u.id = ?
+    ''', (session['user_id'],))
 
     if seller['role_name'] != 'business':
         cur.close()
@@ -1829,25 +4731,14 @@ def nfc_payment_page(nfc_tag_id, token):
         conn.close()
         return render_template('nfc_error.html', error="Вы не можете оплачивать сами себе")
 
-    # создаём сессию оплаты
-    session_id = secrets.token_urlsafe(32)
-    expires_at = datetime.now() + timedelta(minutes=10)
-
-    if USE_POSTGRESQL:
-        cur.execute('''
-            INSERT INTO payment_sessions (session_id, buyer_id, seller_id, expires_at)
-            VALUES (%s, %s, %s, %s)
-        ''', (session_id, nfc_tag['user_id'], seller['id'], expires_at))
-    else:
-        cur.execute('''
-            INSERT INTO payment_sessions (session_id, buyer_id, seller_id, expires_at)
-            VALUES (?, ?, ?, ?)
-        ''', (session_id, nfc_tag['user_id'], seller['id'], expires_at))
-
-    conn.commit()
     cur.close()
     conn.close()
 
+    # создаём сессию оплаты (в основную БД попадёт только её итог)
+    session_id = secrets.token_urlsafe(32)
+    expires_at = datetime.now() + PAYMENT_SESSION_TTL
+    get_payment_session_store().create(session_id, nfc_tag['user_id'], seller['id'], expires_at)
+
     return render_template('nfc_payment.html',
                            buyer={
                                'full_name': nfc_tag['full_name'],
@@ -1900,6 +4791,8 @@ def admin_transactions():
     date_from = request.args.get('date_from', '')
     date_to = request.args.get('date_to', '')
     account = request.args.get('account', '')
+    cursor = request.args.get('cursor', '')
+    limit = parse_page_limit(request.args.get('limit'), 100)
 
     query = '''
         SELECT t.*, u1.full_name as from_name, u2.full_name as to_name
@@ -1908,37 +4801,42 @@ def admin_transactions():
         LEFT JOIN users u2 ON t.to_account = u2.account_number
         WHERE 1=1
     '''
-    params = []
-    if date_from:
-        query += ' AND DATE(t.date) >= %s' if USE_POSTGRESQL else ' AND DATE(t.date) >= ?'
-        params.append(date_from)
-    if date_to:
-        query += ' AND DATE(t.date) <= %s' if USE_POSTGRESQL else ' AND DATE(t.date) <= ?'
-        params.append(date_to)
+    try:
+        date_sql, params = date_range_filter('t.date', date_from, date_to)
+    except ValueError:
+        flash('Неверный формат даты', 'error')
+        return redirect(url_for('admin_transactions'))
+    query += date_sql
     if account:
-        query += ' AND (t.from_account LIKE %s OR t.to_account LIKE %s)' if USE_POSTGRESQL else ' AND (t.from_account LIKE ? OR t.to_account LIKE ?)'
+        query += ' AND (t.from_account LIKE ? OR t.to_account LIKE ?)'
         params.append(f'%{account}%')
         params.append(f'%{account}%')
-    query += ' ORDER BY t.date DESC LIMIT 100'
-    if USE_POSTGRESQL:
-        cur.execute(query, params)
-    else:
-        cur.execute(query, params)
-    transactions = cur.fetchall()
+    if cursor:
+        try:
+            params.extend(decode_history_cursor(cursor))
+        except ValueError:
+            flash('Неверная ссылка на страницу', 'error')
+            return redirect(url_for('admin_transactions'))
+        query += ' AND (t.date, t.id) < (?, ?)'
+    query += ' ORDER BY t.date DESC, t.id DESC LIMIT ?'
+    params.append(limit + 1)
+    execute(cur, query, params)
+    transactions, next_cursor = split_history_page(cur.fetchall(), limit)
     cur.close()
     conn.close()
-    return render_template('admin_transactions.html', transactions=[dict(t) for t in transactions])
+    filters = {'date_from': date_from, 'date_to': date_to, 'account': account}
+    return render_template('admin_transactions.html', transactions=transactions,
+                           next_cursor=next_cursor, filters=filters)
 
 @app.route('/admin/audit_logs')
 @require_permission('audit_logs')
 def admin_audit_logs():
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute('SELECT * FROM audit_log ORDER BY timestamp DESC LIMIT 100')
-    logs = cur.fetchall()
+    logs = fetch_audit_log(cur, 100)
     cur.close()
     conn.close()
-    return render_template('admin_audit.html', logs=[dict(log) for log in logs])
+    return render_template('admin_audit.html', logs=logs)
 
 @app.route('/admin/system_settings')
 @require_permission('all_permissions')
@@ -1963,7 +4861,11 @@ def add_user():
     passport = request.form['passport']
     full_name = request.form['fio']
     account_number = request.form['account']
-    balance = float(request.form['balance'])
+    try:
+        balance = to_minor(request.form['balance'])
+    except ValueError:
+        flash('Неверная сумма начального баланса', 'error')
+        return redirect(url_for('admin_users'))
     role_id = 3 if 'is_admin' in request.form else 6
     password = request.form['password']
     email = request.form.get('email', '')
@@ -1985,6 +4887,8 @@ def add_user():
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)
             ''', (passport, full_name, account_number, balance, role_id, generate_password_hash(password), email, phone))
             user_id = cur.lastrowid
+        record_new_user(cur, balance)
+        invalidate_account_cache(cur, [account_number])
         conn.commit()
         flash(f'Пользователь успешно добавлен (ID: {user_id})', 'success')
     except Exception as e:
@@ -1999,20 +4903,12 @@ def add_user():
 def change_user_role(passport):
     conn = get_db_connection()
     cur = conn.cursor()
-    if USE_POSTGRESQL:
-        cur.execute('SELECT * FROM users WHERE passport = %s', (passport,))
-    else:
-        cur.execute('SELECT * FROM users WHERE passport = ?', (passport,))
-    user = cur.fetchone()
+    user = fetch_one(cur, 'SELECT * FROM users WHERE passport = ?', (passport,))
     if not user:
         flash('Пользователь не найден', 'error')
         return redirect(url_for('admin_users'))
 
-    if USE_POSTGRESQL:
-        cur.execute('SELECT * FROM roles WHERE id > 1 ORDER BY level DESC')
-    else:
-        cur.execute('SELECT * FROM roles WHERE id > 1 ORDER BY level DESC')
-    roles = cur.fetchall()
+    roles = fetch_all(cur, 'SELECT * FROM roles WHERE id > 1 ORDER BY level DESC')
 
     if request.method == 'POST':
         new_role_id = int(request.form['role_id'])
@@ -2020,41 +4916,17 @@ def change_user_role(passport):
             flash('Нельзя изменять роль суперадмина', 'error')
             return redirect(url_for('admin_users'))
 
-        if USE_POSTGRESQL:
-            cur.execute('UPDATE users SET role_id = %s WHERE passport = %s', (new_role_id, passport))
-            cur.execute('SELECT * FROM roles WHERE id = %s', (new_role_id,))
-        else:
-            cur.execute('UPDATE users SET role_id = ? WHERE passport = ?', (new_role_id, passport))
-            cur.execute('SELECT * FROM roles WHERE id = ?', (new_role_id,))
+        execute(cur, 'UPDATE users SET role_id = ? WHERE passport = ?', (new_role_id, passport))
+        execute(cur, 'SELECT * FROM roles WHERE id = ?', (new_role_id,))
         new_role = cur.fetchone()
 
-        if USE_POSTGRESQL:
-            cur.execute('''
-                INSERT INTO audit_log (admin_passport, admin_name, action, target_user, details)
-                VALUES (%s, %s, %s, %s, %s)
-            ''', (session.get('passport'),
-                  session.get('user_info', {}).get('full_name', 'Администратор'),
-                  'Изменение роли пользователя',
-                  passport,
-                  f'Новая роль: {new_role["role_name"] if new_role else "Неизвестно"}'))
-        else:
-            cur.execute('''
-                INSERT INTO audit_log (admin_passport, admin_name, action, target_user, details)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (session.get('passport'),
-                  session.get('user_info', {}).get('full_name', 'Администратор'),
-                  'Изменение роли пользователя',
-                  passport,
-                  f'Новая роль: {new_role["role_name"] if new_role else "Неизвестно"}'))
+        audit('Изменение роли пользователя', passport,
+              f'Новая роль: {new_role["role_name"] if new_role else "Неизвестно"}', cur=cur)
         conn.commit()
         flash(f'Роль пользователя {user["full_name"]} изменена на "{new_role["role_name"] if new_role else "Неизвестно"}"', 'success')
         return redirect(url_for('admin_users'))
 
-    if USE_POSTGRESQL:
-        cur.execute('SELECT * FROM roles WHERE id = %s', (user['role_id'],))
-    else:
-        cur.execute('SELECT * FROM roles WHERE id = ?', (user['role_id'],))
-    current_role = cur.fetchone()
+    current_role = fetch_one(cur, 'SELECT * FROM roles WHERE id = ?', (user['role_id'],))
 
     cur.close()
     conn.close()
@@ -2069,33 +4941,14 @@ def change_user_role(passport):
 def toggle_block_user(passport):
     conn = get_db_connection()
     cur = conn.cursor()
-    if USE_POSTGRESQL:
-        cur.execute('SELECT * FROM users WHERE passport = %s', (passport,))
-    else:
-        cur.execute('SELECT * FROM users WHERE passport = ?', (passport,))
-    user = cur.fetchone()
+    user = fetch_one(cur, 'SELECT * FROM users WHERE passport = ?', (passport,))
     if user:
         new_status = 0 if user['is_active'] else 1
-        if USE_POSTGRESQL:
-            cur.execute('UPDATE users SET is_active = %s WHERE passport = %s', (new_status, passport))
-            cur.execute('''
-                INSERT INTO audit_log (admin_passport, admin_name, action, target_user, details)
-                VALUES (%s, %s, %s, %s, %s)
-            ''', (session.get('passport'),
-                  session.get('user_info', {}).get('full_name', 'Администратор'),
-                  'Изменение статуса блокировки',
-                  passport,
-                  f'Новый статус: {"разблокирован" if new_status else "заблокирован"}'))
-        else:
-            cur.execute('UPDATE users SET is_active = ? WHERE passport = ?', (new_status, passport))
-            cur.execute('''
-                INSERT INTO audit_log (admin_passport, admin_name, action, target_user, details)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (session.get('passport'),
-                  session.get('user_info', {}).get('full_name', 'Администратор'),
-                  'Изменение статуса блокировки',
-                  passport,
-                  f'Новый статус: {"разблокирован" if new_status else "заблокирован"}'))
+        record_activity_change(cur, [passport], new_status)
+        execute(cur, 'UPDATE users SET is_active = ? WHERE passport = ?', (new_status, passport))
+        invalidate_account_cache(cur, [user['account_number']])
+        audit('Изменение статуса блокировки', passport,
+              f'Новый статус: {"разблокирован" if new_status else "заблокирован"}', cur=cur)
         conn.commit()
         flash(f'Пользователь {passport} {"разблокирован" if new_status else "заблокирован"}', 'success')
     cur.close()
@@ -2107,17 +4960,10 @@ def toggle_block_user(passport):
 def toggle_admin_status_route(passport):
     conn = get_db_connection()
     cur = conn.cursor()
-    if USE_POSTGRESQL:
-        cur.execute('SELECT * FROM users WHERE passport = %s', (passport,))
-    else:
-        cur.execute('SELECT * FROM users WHERE passport = ?', (passport,))
-    user = cur.fetchone()
+    user = fetch_one(cur, 'SELECT * FROM users WHERE passport = ?', (passport,))
     if user:
         new_role_id = 6 if user['role_id'] <= 3 else 3
-        if USE_POSTGRESQL:
-            cur.execute('UPDATE users SET role_id = %s WHERE passport = %s', (new_role_id, passport))
-        else:
-            cur.execute('UPDATE users SET role_id = ? WHERE passport = ?', (new_role_id, passport))
+        execute(cur, 'UPDATE users SET role_id = ? WHERE passport = ?', (new_role_id, passport))
         conn.commit()
         role_name = "администратором" if new_role_id <= 3 else "обычным пользователем"
         flash(f'Пользователь {passport} назначен {role_name}', 'success')
@@ -2131,18 +4977,10 @@ def reset_password(passport):
     new_password = ''.join(random.choices(string.digits, k=8))
     conn = get_db_connection()
     cur = conn.cursor()
-    if USE_POSTGRESQL:
-        cur.execute('SELECT * FROM users WHERE passport = %s', (passport,))
-    else:
-        cur.execute('SELECT * FROM users WHERE passport = ?', (passport,))
-    user = cur.fetchone()
+    user = fetch_one(cur, 'SELECT * FROM users WHERE passport = ?', (passport,))
     if user:
-        if USE_POSTGRESQL:
-            cur.execute('UPDATE users SET password_hash = %s WHERE passport = %s',
-                        (generate_password_hash(new_password), passport))
-        else:
-            cur.execute('UPDATE users SET password_hash = ? WHERE passport = ?',
-                        (generate_password_hash(new_password), passport))
+        execute(cur, 'UPDATE users SET password_hash = ? WHERE passport = ?',
+                     (generate_password_hash(new_password), passport))
         conn.commit()
         flash(f'Пароль для пользователя {passport} сброшен. Новый пароль: {new_password}', 'success')
     else:
@@ -2155,14 +4993,15 @@ def reset_password(passport):
 @require_permission('manage_users')
 def add_money():
     account = request.form['account']
-    amount = float(request.form['amount'])
+    try:
+        amount = to_minor(request.form['amount'])
+        user = execute_deposit(account, amount, 'Административное начисление')
+    except (ValueError, TransferError) as e:
+        flash(str(e), 'error')
+        return redirect(url_for('admin_panel'))
 
-    user = find_user_by_account(account)
     if user:
-        new_balance = user['balance'] + amount
-        update_user_balance(account, new_balance)
-        add_transaction('Начисление', 'Система', account, amount, 'Успешно', 'Административное начисление', user['id'])
-        flash(f'На счет {account} успешно начислено {amount} руб.', 'success')
+        flash(f'На счет {account} успешно начислено {format_money(amount)} руб.', 'success')
     else:
         flash('Счет не найден', 'error')
 
@@ -2173,104 +5012,31 @@ def add_money():
 def nfc_details(nfc_id):
     conn = get_db_connection()
     cur = conn.cursor()
-    if USE_POSTGRESQL:
-        cur.execute('''
-            SELECT n.*, u.passport, u.full_name, u.account_number,
-                   u.balance, u.email, u.phone, u.created_at as user_created
-            FROM nfc_tags n
-            JOIN users u ON n.user_id = u.id
-            WHERE n.id = %s
-        ''', (nfc_id,))
-    else:
-        cur.execute('''
-            SELECT n.*, u.passport, u.full_name, u.account_number,
-                   u.balance, u.email, u.phone, u.created_at as user_created
-            FROM nfc_tags n
-            JOIN users u ON n.user_id = u.id
-            WHERE n.id = ?
-        ''', (nfc_id,))
-    nfc_tag = cur.fetchone()
+    nfc_tag = fetch_one(cur, '''
+        SELECT n.*, u.passport, u.full_name, u.account_number,
+               u.balance, u.email, u.phone, u.created_at as user_created
+        FROM nfc_tags n
+        JOIN users u ON n.user_id = u.id
+        WHERE n.id = ?
+    ''', (nfc_id,))
 
     if not nfc_tag:
         flash('NFC-метка не найдена', 'error')
         return redirect(url_for('admin_nfc'))
 
     # транзакции
-    if USE_POSTGRESQL:
-        cur.execute('''
-            SELECT t.*,
-                   u_from.full_name as from_name,
-                   u_to.full_name as to_name,
-                   CASE
-                       WHEN t.from_account = u.account_number THEN 'outgoing'
-                       ELSE 'incoming'
-                   END as direction
-            FROM transactions t
-            JOIN users u ON (t.from_account = u.account_number OR t.to_account = u.account_number)
-            LEFT JOIN users u_from ON t.from_account = u_from.account_number
-            LEFT JOIN users u_to ON t.to_account = u_to.account_number
-            WHERE u.id = %s
-            ORDER BY t.date DESC
-            LIMIT 50
-        ''', (nfc_tag['user_id'],))
-    else:
-        cur.execute('''
-            SELECT t.*,
-                   u_from.full_name as from_name,
-                   u_to.full_name as to_name,
-                   CASE
-                       WHEN t.from_account = u.account_number THEN 'outgoing'
-                       ELSE 'incoming'
-                   END as direction
-            FROM transactions t
-            JOIN users u ON (t.from_account = u.account_number OR t.to_account = u.account_number)
-            LEFT JOIN users u_from ON t.from_account = u_from.account_number
-            LEFT JOIN users u_to ON t.to_account = u_to.account_number
-            WHERE u.id = ?
-            ORDER BY t.date DESC
-            LIMIT 50
-        ''', (nfc_tag['user_id'],))
-    transactions = cur.fetchall()
+    query, params = account_history_query(nfc_tag['account_number'], 50, with_names=True)
+    transactions = fetch_all(cur, query, params)
 
     # статистика
-    if USE_POSTGRESQL:
-        cur.execute('''
-            SELECT
-                COUNT(*) as total_transactions,
-                SUM(CASE WHEN t.from_account = u.account_number THEN t.amount ELSE 0 END) as total_sent,
-                SUM(CASE WHEN t.to_account = u.account_number THEN t.amount ELSE 0 END) as total_received,
-                MAX(t.date) as last_transaction
-            FROM transactions t
-            JOIN users u ON (t.from_account = u.account_number OR t.to_account = u.account_number)
-            WHERE u.id = %s
-        ''', (nfc_tag['user_id'],))
-    else:
-        cur.execute('''
-            SELECT
-                COUNT(*) as total_transactions,
-                SUM(CASE WHEN t.from_account = u.account_number THEN t.amount ELSE 0 END) as total_sent,
-                SUM(CASE WHEN t.to_account = u.account_number THEN t.amount ELSE 0 END) as total_received,
-                MAX(t.date) as last_transaction
-            FROM transactions t
-            JOIN users u ON (t.from_account = u.account_number OR t.to_account = u.account_number)
-            WHERE u.id = ?
-        ''', (nfc_tag['user_id'],))
-    stats = cur.fetchone()
+    stats = get_account_history_stats(cur, nfc_tag['account_number'])
 
     # информация о PIN
-    if USE_POSTGRESQL:
-        cur.execute('''
-            SELECT attempts, is_locked, last_attempt, created_at
-            FROM user_pins
-            WHERE nfc_tag_id = %s
-        ''', (nfc_id,))
-    else:
-        cur.execute('''
-            SELECT attempts, is_locked, last_attempt, created_at
-            FROM user_pins
-            WHERE nfc_tag_id = ?
-        ''', (nfc_id,))
-    pin_info = cur.fetchone()
+    pin_info = fetch_one(cur, '''
+        SELECT attempts, is_locked, last_attempt, created_at
+        FROM user_pins
+        WHERE nfc_tag_id = ?
+    ''', (nfc_id,))
 
     cur.close()
     conn.close()
@@ -2278,7 +5044,7 @@ def nfc_details(nfc_id):
     return render_template('nfc_details.html',
                            nfc_tag=dict(nfc_tag),
                            transactions=[dict(t) for t in transactions],
-                           stats=dict(stats) if stats else {},
+                           stats=stats,
                            pin_info=dict(pin_info) if pin_info else {})
 
 @app.route('/api/nfc/set_amount', methods=['POST'])
@@ -2287,42 +5053,19 @@ def set_payment_amount():
         return jsonify({'success': False, 'error': 'Неверный формат данных'})
     data = request.json
     session_id = data.get('session_id')
-    amount = float(data.get('amount', 0))
+    try:
+        amount = to_minor(data.get('amount', 0))
+    except ValueError:
+        amount = 0
     if amount <= 0:
         return jsonify({'success': False, 'error': 'Неверная сумма'})
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-    if USE_POSTGRESQL:
-        cur.execute('''
-            SELECT ps.*, s.account_number as seller_account
-            FROM payment_sessions ps
-            JOIN users s ON ps.seller_id = s.id
-            WHERE ps.session_id = %s AND ps.status = 'pending'
-        ''', (session_id,))
-    else:
-        cur.execute('''
-            SELECT ps.*, s.account_number as seller_account
-            FROM payment_sessions ps
-            JOIN users s ON ps.seller_id = s.id
-            WHERE ps.session_id = ? AND ps.status = 'pending'
-        ''', (session_id,))
-    session = cur.fetchone()
-    if not session:
-        cur.close()
-        conn.close()
+    if not get_payment_session_store().set_amount(session_id, amount):
         return jsonify({'success': False, 'error': 'Сессия не найдена'})
-
-    if USE_POSTGRESQL:
-        cur.execute('UPDATE payment_sessions SET amount = %s WHERE session_id = %s', (amount, session_id))
-    else:
-        cur.execute('UPDATE payment_sessions SET amount = ? WHERE session_id = ?', (amount, session_id))
-    conn.commit()
-    cur.close()
-    conn.close()
-    return jsonify({'success': True, 'amount': amount})
+    return jsonify({'success': True, 'amount': from_minor(amount)})
 
 @app.route('/api/nfc/confirm_payment', methods=['POST'])
+@idempotent
 def confirm_nfc_payment():
     if not request.is_json:
         return jsonify({'success': False, 'error': 'Неверный формат данных'})
@@ -2330,197 +5073,206 @@ def confirm_nfc_payment():
     session_id = data.get('session_id')
     pin = data.get('pin')
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-    if USE_POSTGRESQL:
-        cur.execute('''
-            SELECT ps.*,
-                   b.account_number as buyer_account, b.balance as buyer_balance,
-                   s.account_number as seller_account
-            FROM payment_sessions ps
-            JOIN users b ON ps.buyer_id = b.id
-            JOIN users s ON ps.seller_id = s.id
-            WHERE ps.session_id = %s
-        ''', (session_id,))
-    else:
-        cur.execute('''
-            SELECT ps.*,
-                   b.account_number as buyer_account, b.balance as buyer_balance,
-                   s.account_number as seller_account
-            FROM payment_sessions ps
-            JOIN users b ON ps.buyer_id = b.id
-            JOIN users s ON ps.seller_id = s.id
-            WHERE ps.session_id = ?
-        ''', (session_id,))
-    session = cur.fetchone()
-
-    if not session:
-        cur.close()
-        conn.close()
+    # Сессия захватывается в хранилище: параллельный confirm той же сессии получит отказ
+    store = get_payment_session_store()
+    payment_session = store.claim(session_id)
+    if not payment_session:
+        existing = store.get(session_id)
+        if existing and existing['status'] == 'processing':
+            return jsonify({'success': False, 'error': 'Оплата по этой сессии уже выполняется'})
+        if existing and existing['status'] == 'pending' and payment_session_expired(existing):
+            return jsonify({'success': False, 'error': 'Сессия истекла'})
         return jsonify({'success': False, 'error': 'Сессия не найдена'})
 
-    # ищем NFC-метку покупателя
-    if USE_POSTGRESQL:
-        cur.execute('SELECT n.* FROM nfc_tags n WHERE n.user_id = %s LIMIT 1', (session['buyer_id'],))
-    else:
-        cur.execute('SELECT n.* FROM nfc_tags n WHERE n.user_id = ? LIMIT 1', (session['buyer_id'],))
-    nfc_tag = cur.fetchone()
-
-    if not nfc_tag:
-        cur.close()
-        conn.close()
-        return jsonify({'success': False, 'error': 'NFC-метка не найдена'})
-
-    if not verify_pin(session['buyer_id'], nfc_tag['id'], pin):
-        cur.close()
-        conn.close()
-        return jsonify({'success': False, 'error': 'Неверный PIN-код'})
+    paid = False
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        amount = payment_session['amount']
+        if not amount:
+            return jsonify({'success': False, 'error': 'Сумма не установлена'})
+
+        # Всё подтверждение — одна транзакция на одном соединении. Строки покупателя
+        # и продавца блокируются в порядке номеров счетов, как в execute_transfer;
+        # строка продавца с разделённым балансом не блокируется — зачисление уйдёт в корзину
+        begin_write_transaction(conn)
+        if USE_POSTGRESQL:
+            cur.execute('SELECT id, balance_buckets FROM users WHERE id = %s', (payment_session['seller_id'],))
+            seller_row = cur.fetchone()
+            hot_seller = bool(seller_row and seller_row['balance_buckets'])
+            locked_ids = [payment_session['buyer_id']] if hot_seller else \
+                [payment_session['buyer_id'], payment_session['seller_id']]
+            cur.execute('''
+                SELECT id, account_number, balance, is_active, balance_buckets FROM users
+                WHERE id = ANY(%s)
+                ORDER BY account_number
+                FOR UPDATE
+            ''', (locked_ids,))
+            users = {row['id']: dict(row) for row in cur.fetchall()}
+            if hot_seller:
+                cur.execute('SELECT id, account_number, balance, is_active, balance_buckets FROM users WHERE id = %s',
+                            (payment_session['seller_id'],))
+                users[payment_session['seller_id']] = dict(cur.fetchone())
+        else:
+            cur.execute('SELECT id, account_number, balance, is_active, balance_buckets FROM users WHERE id IN (?, ?)',
+                        (payment_session['buyer_id'], payment_session['seller_id']))
+            users = {row['id']: dict(row) for row in cur.fetchall()}
+        buyer = users.get(payment_session['buyer_id'])
+        seller = users.get(payment_session['seller_id'])
+        if not buyer or not seller:
+            return jsonify({'success': False, 'error': 'Сессия не найдена'})
+
+        # ищем NFC-метку покупателя
+        nfc_tag = fetch_one(cur, 'SELECT n.id FROM nfc_tags n WHERE n.user_id = ? ORDER BY n.id LIMIT 1', (buyer['id'],))
+
+        if not nfc_tag:
+            return jsonify({'success': False, 'error': 'NFC-метка не найдена'})
+
+        if not check_pin(cur, buyer['id'], nfc_tag['id'], pin):
+            # Неудачная попытка должна сохраниться, хотя оплата не проходит
+            conn.commit()
+            return jsonify({'success': False, 'error': 'Неверный PIN-код'})
+
+        if buyer['balance_buckets']:
+            buyer['balance'] += fold_balance_buckets(cur, buyer['id'])
+        # Относительные обновления: списание не пройдёт, если баланс уже уменьшился
+        execute_prepared(cur, 'debit_balance', (amount, buyer['id'], amount))
+        if cur.rowcount != 1:
+            # Сброс счётчика попыток после верного PIN сохраняем
+            conn.commit()
+            return jsonify({'success': False, 'error': 'Недостаточно средств'})
+        if seller['balance_buckets']:
+            bucket = pick_balance_bucket(session_id, seller['balance_buckets'])
+            credit_balance_bucket(cur, seller['id'], bucket, amount)
+        else:
+            execute_prepared(cur, 'credit_balance', (amount, seller['id']))
+        new_buyer_balance = buyer['balance'] - amount
+
+        # Итог сессии, списание, зачисление и журнал — одна запись в основную БД
+        store.complete(cur, payment_session, 'paid')
+        insert_transaction(cur, 'NFC Payment', buyer['account_number'], seller['account_number'],
+                           amount, 'Успешно', f'Оплата по NFC')
+        # Оплата не проверяет блокировку, поэтому сумма активных балансов может сместиться
+        active_delta = (amount if seller['is_active'] else 0) - (amount if buyer['is_active'] else 0)
+        record_balance_change(cur, 0, active_delta)
+        paid_status = {'status': 'paid', 'amount': from_minor(amount)}
+        notify_payment_status(cur, session_id, paid_status)
+        balances_changed(cur, [buyer['account_number'], seller['account_number']])
 
-    amount = session['amount']
-    if session['buyer_balance'] < amount:
+        conn.commit()
+        paid = True
+    finally:
+        if not paid:
+            conn.rollback()
         cur.close()
         conn.close()
-        return jsonify({'success': False, 'error': 'Недостаточно средств'})
-
-    new_buyer_balance = session['buyer_balance'] - amount
-    if USE_POSTGRESQL:
-        cur.execute('SELECT balance FROM users WHERE id = %s', (session['seller_id'],))
-    else:
-        cur.execute('SELECT balance FROM users WHERE id = ?', (session['seller_id'],))
-    seller_row = cur.fetchone()
-    new_seller_balance = seller_row['balance'] + amount
-
-    if USE_POSTGRESQL:
-        cur.execute('UPDATE users SET balance = %s WHERE id = %s', (new_buyer_balance, session['buyer_id']))
-        cur.execute('UPDATE users SET balance = %s WHERE id = %s', (new_seller_balance, session['seller_id']))
-        cur.execute('UPDATE payment_sessions SET status = %s, completed_at = CURRENT_TIMESTAMP WHERE session_id = %s',
-                    ('paid', session_id))
-    else:
-        cur.execute('UPDATE users SET balance = ? WHERE id = ?', (new_buyer_balance, session['buyer_id']))
-        cur.execute('UPDATE users SET balance = ? WHERE id = ?', (new_seller_balance, session['seller_id']))
-        cur.execute('UPDATE payment_sessions SET status = ?, completed_at = CURRENT_TIMESTAMP WHERE session_id = ?',
-                    ('paid', session_id))
-
-    if USE_POSTGRESQL:
-        cur.execute('''
-            INSERT INTO transactions (type, from_account, to_account, amount, status, description)
-            VALUES (%s, %s, %s, %s, %s, %s)
-        ''', ('NFC Payment', session['buyer_account'], session['seller_account'],
-              amount, 'Успешно', f'Оплата по NFC'))
-    else:
-        cur.execute('''
-            INSERT INTO transactions (type, from_account, to_account, amount, status, description)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', ('NFC Payment', session['buyer_account'], session['seller_account'],
-              amount, 'Успешно', f'Оплата по NFC'))
-
-    conn.commit()
-    cur.close()
-    conn.close()
+        if paid:
+            store.forget(session_id)
+        else:
+            store.release(session_id)
+    payment_notifier.publish(session_id, paid_status)
 
     return jsonify({
         'success': True,
-        'message': f'Оплата {amount} руб. прошла успешно',
-        'new_balance': new_buyer_balance
+        'message': f'Оплата {format_money(amount)} руб. прошла успешно',
+        'amount': from_minor(amount),
+        'new_balance': from_minor(new_buyer_balance)
     })
 
 @app.route('/api/nfc/status/<session_id>')
 def get_payment_status(session_id):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    if USE_POSTGRESQL:
-        cur.execute('SELECT status, amount FROM payment_sessions WHERE session_id = %s', (session_id,))
-    else:
-        cur.execute('SELECT status, amount FROM payment_sessions WHERE session_id = ?', (session_id,))
-    session = cur.fetchone()
-    cur.close()
-    conn.close()
-    if session:
-        return jsonify(dict(session))
-    return jsonify({'status': 'not_found'})
+    return jsonify(fetch_payment_status(session_id))
+
+@app.route('/api/nfc/events/<session_id>')
+def payment_status_events(session_id):
+    """Поток SSE со статусом платёжной сессии: событие status при каждом изменении."""
+    if not payment_waiters.acquire(blocking=False):
+        response = jsonify({'error': 'Слишком много ожидающих терминалов'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '5'
+        return response
+    released = []
+
+    def release():
+        if not released:
+            released.append(True)
+            payment_waiters.release()
+
+    try:
+        ensure_payment_listener()
+        current = fetch_payment_status(session_id)
+    except Exception:
+        release()
+        raise
+
+    def stream(current):
+        # Генератор работает вне контекста запроса: каждая перепроверка берёт
+        # соединение из пула и сразу возвращает его, а не держит всё ожидание
+        try:
+            yield 'retry: 2000\n'
+            yield f'event: status\ndata: {json.dumps(current)}\n\n'
+            deadline = time.monotonic() + NFC_EVENTS_MAX_WAIT
+            while current.get('status') == 'pending':
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                payload = payment_notifier.wait(session_id, min(remaining, NFC_EVENTS_RECHECK))
+                if payload is None:
+                    payload = fetch_payment_status(session_id)
+                    if payload == current:
+                        yield ': keepalive\n\n'
+                        continue
+                current = payload
+                yield f'event: status\ndata: {json.dumps(current)}\n\n'
+        finally:
+            release()
+
+    response = app.response_class(stream(current), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.call_on_close(release)
+    return response
 
 # ==================== API ДЛЯ АДМИНОВ ====================
 
 @app.route('/admin/api/system_stats')
 @require_permission('view_reports')
+@cached_json
 def admin_system_stats():
     conn = get_db_connection()
     cur = conn.cursor()
-    today = datetime.now().strftime('%Y-%m-%d')
-    if USE_POSTGRESQL:
-        cur.execute('SELECT COUNT(*) as count FROM transactions WHERE DATE(date) = %s', (today,))
-    else:
-        cur.execute('SELECT COUNT(*) as count FROM transactions WHERE DATE(date) = ?', (today,))
-    today_transactions = cur.fetchone()['count']
-
-    if USE_POSTGRESQL:
-        cur.execute('SELECT AVG(balance) as avg FROM users WHERE is_active = TRUE')
-    else:
-        cur.execute('SELECT AVG(balance) as avg FROM users WHERE is_active = 1')
-    avg_result = cur.fetchone()
-    avg_balance = avg_result['avg'] if avg_result['avg'] is not None else 0
-
-    if USE_POSTGRESQL:
-        cur.execute('SELECT COALESCE(SUM(amount), 0) as total FROM transactions WHERE DATE(date) = %s AND status = %s',
-                    (today, 'Успешно'))
-    else:
-        cur.execute('SELECT COALESCE(SUM(amount), 0) as total FROM transactions WHERE DATE(date) = ? AND status = ?',
-                    (today, 'Успешно'))
-    turnover_result = cur.fetchone()
-    total_turnover = turnover_result['total'] if turnover_result['total'] is not None else 0
-
-    if USE_POSTGRESQL:
-        cur.execute('SELECT COUNT(DISTINCT user_id) as count FROM transactions WHERE DATE(date) = %s', (today,))
-    else:
-        cur.execute('SELECT COUNT(DISTINCT user_id) as count FROM transactions WHERE DATE(date) = ?', (today,))
-    active_today = cur.fetchone()['count']
-
-    if USE_POSTGRESQL:
-        cur.execute('SELECT COUNT(*) as count FROM users WHERE DATE(created_at) = %s', (today,))
-    else:
-        cur.execute('SELECT COUNT(*) as count FROM users WHERE DATE(created_at) = ?', (today,))
-    new_today = cur.fetchone()['count']
-
+    today = get_today_stats(cur)
+    totals = get_stats_totals(cur)
     cur.close()
     conn.close()
 
+    active_count = totals['active_users_count']
+    avg_balance = totals['active_balance'] / active_count if active_count else 0
+    today_transactions = today['transactions_count']
+    total_turnover = today['turnover']
+    active_today = today['active_users']
+    new_today = today['new_users']
+
     return jsonify({
         'today_transactions': today_transactions,
-        'avg_balance': round(float(avg_balance), 2),
-        'total_turnover': round(float(total_turnover), 2),
+        'avg_balance': round(float(avg_balance) / MINOR_UNITS, 2),
+        'total_turnover': from_minor(total_turnover),
         'active_today': active_today,
         'new_today': new_today
     })
 
 @app.route('/admin/api/super_stats')
 @require_permission('all_permissions')
+@cached_json
 def api_super_stats():
     conn = get_db_connection()
     cur = conn.cursor()
-    if USE_POSTGRESQL:
-        cur.execute('SELECT COUNT(*) as count FROM users')
-    else:
-        cur.execute('SELECT COUNT(*) as count FROM users')
-    total_users = cur.fetchone()['count']
-
-    if USE_POSTGRESQL:
-        cur.execute('SELECT COUNT(*) as count FROM payment_sessions WHERE status = %s', ('pending',))
-    else:
-        cur.execute('SELECT COUNT(*) as count FROM payment_sessions WHERE status = ?', ('pending',))
-    active_sessions = cur.fetchone()['count']
+    active_sessions = get_payment_session_store().count_pending()
 
-    today = datetime.now().strftime('%Y-%m-%d')
-    if USE_POSTGRESQL:
-        cur.execute('SELECT COUNT(*) as count FROM transactions WHERE DATE(date) = %s', (today,))
-    else:
-        cur.execute('SELECT COUNT(*) as count FROM transactions WHERE DATE(date) = ?', (today,))
-    today_transactions = cur.fetchone()['count']
-
-    if USE_POSTGRESQL:
-        cur.execute('SELECT SUM(balance) as total FROM users')
-    else:
-        cur.execute('SELECT SUM(balance) as total FROM users')
-    total_balance = cur.fetchone()['total'] or 0
+    totals = get_stats_totals(cur)
+    total_users = totals['users_count']
+    total_balance = totals['total_balance']
+    today_transactions = get_today_stats(cur)['transactions_count']
 
     cur.close()
     conn.close()
@@ -2529,7 +5281,7 @@ def api_super_stats():
         'total_users': total_users,
         'active_sessions': active_sessions,
         'today_transactions': today_transactions,
-        'total_balance': round(total_balance, 2)
+        'total_balance': from_minor(total_balance)
     })
 
 @app.route('/admin/api/analyze_transactions', methods=['POST'])
@@ -2540,26 +5292,22 @@ def api_analyze_transactions():
     cur = conn.cursor()
 
     query = 'SELECT * FROM transactions WHERE 1=1'
-    params = []
-    if data.get('date_from'):
-        query += ' AND DATE(date) >= %s' if USE_POSTGRESQL else ' AND DATE(date) >= ?'
-        params.append(data['date_from'])
-    if data.get('date_to'):
-        query += ' AND DATE(date) <= %s' if USE_POSTGRESQL else ' AND DATE(date) <= ?'
-        params.append(data['date_to'])
+    try:
+        date_sql, params = date_range_filter('date', data.get('date_from'), data.get('date_to'))
+    except ValueError as e:
+        cur.close()
+        conn.close()
+        return jsonify({'error': str(e)}), 400
+    query += date_sql
     if data.get('min_amount'):
-        query += ' AND amount >= %s' if USE_POSTGRESQL else ' AND amount >= ?'
-        params.append(float(data['min_amount']))
+        query += ' AND amount >= ?'
+        params.append(to_minor(data['min_amount']))
     if data.get('max_amount'):
-        query += ' AND amount <= %s' if USE_POSTGRESQL else ' AND amount <= ?'
-        params.append(float(data['max_amount']))
+        query += ' AND amount <= ?'
+        params.append(to_minor(data['max_amount']))
     query += ' ORDER BY date DESC LIMIT 100'
 
-    if USE_POSTGRESQL:
-        cur.execute(query, params)
-    else:
-        cur.execute(query, params)
-    transactions = cur.fetchall()
+    transactions = fetch_all(cur, query, params)
 
     total_amount = sum(t['amount'] for t in transactions)
     average_amount = total_amount / len(transactions) if transactions else 0
@@ -2570,45 +5318,50 @@ def api_analyze_transactions():
     return jsonify({
         'summary': {
             'count': len(transactions),
-            'total_amount': round(total_amount, 2),
-            'average_amount': round(average_amount, 2)
+            'total_amount': from_minor(total_amount),
+            'average_amount': round(average_amount / MINOR_UNITS, 2)
         },
-        'transactions': [dict(t) for t in transactions]
+        'transactions': [money_to_json(t) for t in transactions]
     })
 
 @app.route('/admin/api/recent_registrations')
 @require_permission('view_users')
+@cached_json
 def api_recent_registrations():
     conn = get_db_connection()
     cur = conn.cursor()
-    if USE_POSTGRESQL:
-        cur.execute('''
-            SELECT passport, full_name, created_at, balance
-            FROM users
-            WHERE role_id = 6
-            ORDER BY created_at DESC
-            LIMIT 20
-        ''')
-    else:
-        cur.execute('''
-            SELECT passport, full_name, created_at, balance
-            FROM users
-            WHERE role_id = 6
-            ORDER BY created_at DESC
-            LIMIT 20
-        ''')
-    users = cur.fetchall()
+    users = fetch_all(cur, '''
+        SELECT passport, full_name, created_at, balance
+        FROM users
+        WHERE role_id = 6
+        ORDER BY created_at DESC
+        LIMIT 20
+    ''')
     cur.close()
     conn.close()
-    return jsonify([dict(u) for u in users])
+    return jsonify([money_to_json(u) for u in users])
+
+@app.route('/admin/api/runtime_stats')
+@require_permission('all_permissions')
+def api_runtime_stats():
+    return jsonify({
+        'pid': os.getpid(),
+        'db_pool': get_db_pool().snapshot(),
+        'prepared_statements': prepared_statements.snapshot(),
+        'response_cache': response_cache.snapshot(),
+        'account_cache': account_cache.snapshot(),
+        'balance_cache': balance_cache.snapshot(),
+        'payment_notifier': payment_notifier.snapshot(),
+        'audit_buffer': audit_buffer.snapshot(),
+        'background_tasks': background_tasks_snapshot()
+    })
 
 @app.route('/admin/api/admin_logs')
 @require_permission('audit_logs')
 def admin_admin_logs():
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute('SELECT * FROM audit_log ORDER BY timestamp DESC LIMIT 50')
-    logs = cur.fetchall()
+    logs = fetch_audit_log(cur, 50)
     cur.close()
     conn.close()
     result = []
@@ -2632,66 +5385,35 @@ def admin_search_users():
 
     conn = get_db_connection()
     cur = conn.cursor()
-    if USE_POSTGRESQL:
-        cur.execute('''
-            SELECT id, passport, full_name, account_number, balance, is_active,
-                   CASE WHEN role_id <= 3 THEN 1 ELSE 0 END as is_admin
-            FROM users
-            WHERE passport ILIKE %s OR full_name ILIKE %s OR account_number ILIKE %s
-            LIMIT 20
-        ''', (f'%{query}%', f'%{query}%', f'%{query}%'))
-    else:
-        cur.execute('''
-            SELECT id, passport, full_name, account_number, balance, is_active,
-                   CASE WHEN role_id <= 3 THEN 1 ELSE 0 END as is_admin
-            FROM users
-            WHERE passport LIKE ? OR full_name LIKE ? OR account_number LIKE ?
-            LIMIT 20
-        ''', (f'%{query}%', f'%{query}%', f'%{query}%'))
-    users = cur.fetchall()
+    users = search_users(cur, query)
     cur.close()
     conn.close()
-    return jsonify([dict(u) for u in users])
+    return jsonify([money_to_json(u) for u in users])
 
 @app.route('/admin/api/user_transactions/<passport>')
 @require_permission('view_transactions')
 def admin_user_transactions(passport):
     conn = get_db_connection()
     cur = conn.cursor()
-    if USE_POSTGRESQL:
-        cur.execute('SELECT * FROM users WHERE passport = %s', (passport,))
-    else:
-        cur.execute('SELECT * FROM users WHERE passport = ?', (passport,))
-    user = cur.fetchone()
+    user = fetch_one(cur, 'SELECT * FROM users WHERE passport = ?', (passport,))
 
     if not user:
         cur.close()
         conn.close()
         return jsonify({'error': 'Пользователь не найден'}), 404
 
-    if USE_POSTGRESQL:
-        cur.execute('''
-            SELECT t.*, u1.full_name as from_name, u2.full_name as to_name
-            FROM transactions t
-            LEFT JOIN users u1 ON t.from_account = u1.account_number
-            LEFT JOIN users u2 ON t.to_account = u2.account_number
-            WHERE t.from_account = %s OR t.to_account = %s
-            ORDER BY t.date DESC
-            LIMIT 50
-        ''', (user['account_number'], user['account_number']))
-    else:
-        cur.execute('''
-            SELECT t.*, u1.full_name as from_name, u2.full_name as to_name
-            FROM transactions t
-            LEFT JOIN users u1 ON t.from_account = u1.account_number
-            LEFT JOIN users u2 ON t.to_account = u2.account_number
-            WHERE t.from_account = ? OR t.to_account = ?
-            ORDER BY t.date DESC
-            LIMIT 50
-        ''', (user['account_number'], user['account_number']))
-    transactions = cur.fetchall()
-
-    user_dict = dict(user)
+    limit = parse_page_limit(request.args.get('limit'), 50)
+    try:
+        query, params = account_history_query(user['account_number'], limit + 1,
+                                              request.args.get('cursor'), with_names=True)
+    except ValueError as e:
+        cur.close()
+        conn.close()
+        return jsonify({'error': str(e)}), 400
+    execute(cur, query, params)
+    transactions, next_cursor = split_history_page(cur.fetchall(), limit)
+
+    user_dict = money_to_json(user)
     transactions_list = []
     for t in transactions:
         transactions_list.append({
@@ -2700,7 +5422,7 @@ def admin_user_transactions(passport):
             'type': t['type'],
             'from_account': t['from_account'],
             'to_account': t['to_account'],
-            'amount': t['amount'],
+            'amount': from_minor(t['amount']),
             'status': t['status'],
             'description': t['description'],
             'from_name': t['from_name'],
@@ -2712,7 +5434,8 @@ def admin_user_transactions(passport):
 
     return jsonify({
         'user': user_dict,
-        'transactions': transactions_list
+        'transactions': transactions_list,
+        'next_cursor': next_cursor
     })
 
 @app.route('/admin/api/bulk_operations', methods=['POST'])
@@ -2733,28 +5456,22 @@ def admin_bulk_operations():
 
         try:
             if action == 'block':
-                placeholders = ','.join(['%s'] * len(passports)) if USE_POSTGRESQL else ','.join(['?'] * len(passports))
-                if USE_POSTGRESQL:
-                    cur.execute(f'UPDATE users SET is_active = FALSE WHERE passport IN ({placeholders})', passports)
-                else:
-                    cur.execute(f'UPDATE users SET is_active = 0 WHERE passport IN ({placeholders})', passports)
+                placeholders = ','.join(['?'] * len(passports))
+                record_activity_change(cur, passports, False)
+                execute(cur, f'UPDATE users SET is_active = FALSE WHERE passport IN ({placeholders})', passports)
+                invalidate_account_cache(cur)
                 flash_message = f'Заблокировано {len(passports)} пользователей'
             elif action == 'unblock':
-                placeholders = ','.join(['%s'] * len(passports)) if USE_POSTGRESQL else ','.join(['?'] * len(passports))
-                if USE_POSTGRESQL:
-                    cur.execute(f'UPDATE users SET is_active = TRUE WHERE passport IN ({placeholders})', passports)
-                else:
-                    cur.execute(f'UPDATE users SET is_active = 1 WHERE passport IN ({placeholders})', passports)
+                placeholders = ','.join(['?'] * len(passports))
+                record_activity_change(cur, passports, True)
+                execute(cur, f'UPDATE users SET is_active = TRUE WHERE passport IN ({placeholders})', passports)
+                invalidate_account_cache(cur)
                 flash_message = f'Разблокировано {len(passports)} пользователей'
             elif action == 'reset_passwords':
                 for passport in passports:
                     new_password = ''.join(random.choices(string.ascii_letters + string.digits, k=8))
-                    if USE_POSTGRESQL:
-                        cur.execute('UPDATE users SET password_hash = %s WHERE passport = %s',
-                                    (generate_password_hash(new_password), passport))
-                    else:
-                        cur.execute('UPDATE users SET password_hash = ? WHERE passport = ?',
-                                    (generate_password_hash(new_password), passport))
+                    execute(cur, 'UPDATE users SET password_hash = ? WHERE passport = ?',
+                                 (generate_password_hash(new_password), passport))
                 flash_message = f'Пароли сброшены для {len(passports)} пользователей'
             else:
                 cur.close()
@@ -2764,25 +5481,8 @@ def admin_bulk_operations():
             conn.commit()
 
             # Логирование
-            if USE_POSTGRESQL:
-                cur.execute('''
-                    INSERT INTO audit_log (admin_passport, admin_name, action, target_user, details)
-                    VALUES (%s, %s, %s, %s, %s)
-                ''', (session.get('passport'),
-                      session.get('user_info', {}).get('full_name', 'Администратор'),
-                      f'Групповое действие: {action}',
-                      f'{len(passports)} пользователей',
-                      f'Паспорта: {", ".join(passports[:5])}...'))
-            else:
-                cur.execute('''
-                    INSERT INTO audit_log (admin_passport, admin_name, action, target_user, details)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (session.get('passport'),
-                      session.get('user_info', {}).get('full_name', 'Администратор'),
-                      f'Групповое действие: {action}',
-                      f'{len(passports)} пользователей',
-                      f'Паспорта: {", ".join(passports[:5])}...'))
-            conn.commit()
+            audit(f'Групповое действие: {action}', f'{len(passports)} пользователей',
+                  f'Паспорта: {", ".join(passports[:5])}...')
 
             cur.close()
             conn.close()
@@ -2814,23 +5514,16 @@ def edit_role(role_id):
         role_name = request.form['role_name']
         level = int(request.form['level'])
         description = request.form['description']
-        if USE_POSTGRESQL:
-            cur.execute('UPDATE roles SET role_name = %s, level = %s, description = %s WHERE id = %s',
-                        (role_name, level, description, role_id))
-        else:
-            cur.execute('UPDATE roles SET role_name = ?, level = ?, description = ? WHERE id = ?',
-                        (role_name, level, description, role_id))
+        execute(cur, 'UPDATE roles SET role_name = ?, level = ?, description = ? WHERE id = ?',
+                     (role_name, level, description, role_id))
+        invalidate_role_table(cur)
         conn.commit()
         cur.close()
         conn.close()
         flash('Роль обновлена', 'success')
         return redirect(url_for('admin_roles'))
 
-    if USE_POSTGRESQL:
-        cur.execute('SELECT * FROM roles WHERE id = %s', (role_id,))
-    else:
-        cur.execute('SELECT * FROM roles WHERE id = ?', (role_id,))
-    role = cur.fetchone()
+    role = fetch_one(cur, 'SELECT * FROM roles WHERE id = ?', (role_id,))
     cur.close()
     conn.close()
     return render_template('edit_role.html', role=dict(role))
@@ -0,0 +1,63 @@
+"""Общая подготовка данных для нагрузочных скриптов NFC-оплат.
+
+Скрипты запускаются из корня репозитория как `python benchmarks/<скрипт>.py`,
+поэтому каталог benchmarks уже в sys.path и модуль импортируется как `_common`.
+Запросы выполняются через app.execute — тот же слой диалекта, что и в
+приложении, — поэтому пишутся один раз с плейсхолдерами '?'.
+"""
+import os
+import secrets
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_environment(db_name, pool_size):
+    """Без DATABASE_URL — SQLite во временном файле; фоновые задачи приложения выключены."""
+    if 'DATABASE_URL' not in os.environ:
+        os.environ.setdefault('SQLITE_PATH', os.path.join(tempfile.mkdtemp(), db_name))
+    os.environ['DB_POOL_SIZE'] = str(pool_size)
+    os.environ['BACKGROUND_TASKS_ENABLED'] = '0'
+    sys.path.insert(0, ROOT)
+
+
+def cleanup(app_module, prefix):
+    """Удаляет пользователей со счетами prefix* и всё, что на них ссылается."""
+    conn = app_module.get_db_connection()
+    cur = conn.cursor()
+    like = prefix + '%'
+    users = '(SELECT id FROM users WHERE account_number LIKE ?)'
+    app_module.execute(cur, 'DELETE FROM transactions WHERE from_account LIKE ?', (like,))
+    app_module.execute(cur, f'DELETE FROM payment_sessions WHERE buyer_id IN {users}', (like,))
+    app_module.execute(cur, f'DELETE FROM user_pins WHERE user_id IN {users}', (like,))
+    app_module.execute(cur, f'DELETE FROM nfc_tags WHERE user_id IN {users}', (like,))
+    app_module.execute(cur, f'DELETE FROM balance_buckets WHERE user_id IN {users}', (like,))
+    app_module.execute(cur, 'DELETE FROM users WHERE account_number LIKE ?', (like,))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def insert_returning_id(app_module, cur, query, params):
+    if app_module.USE_POSTGRESQL:
+        app_module.execute(cur, query + ' RETURNING id', params)
+        return cur.fetchone()['id']
+    app_module.execute(cur, query, params)
+    return cur.lastrowid
+
+
+def create_user(app_module, cur, prefix, suffix, balance, role_id):
+    """Пользователь со счетом prefix+suffix и балансом balance копеек. Возвращает id."""
+    return insert_returning_id(app_module, cur, '''
+        INSERT INTO users (passport, full_name, account_number, balance, role_id, password_hash)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (f'{prefix.lower()}-{suffix}', f'{prefix} {suffix}', f'{prefix}{suffix}', balance, role_id, 'bench'))
+
+
+def create_nfc_tag(app_module, cur, prefix, user_id, pin):
+    """NFC-метка пользователя с PIN (в транзакции cur). Возвращает id метки."""
+    tag_id = insert_returning_id(app_module, cur, 'INSERT INTO nfc_tags (user_id, tag_uid, tag_url) VALUES (?, ?, ?)',
+                                 (user_id, f'{prefix}-{secrets.token_hex(4)}', 'bench'))
+    app_module.create_pin_for_nfc(cur, user_id, tag_id, pin)
+    return tag_id
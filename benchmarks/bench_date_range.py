@@ -0,0 +1,135 @@
+"""Фильтр по дням: DATE(date) против полуоткрытого диапазона на синтетической таблице.
+
+Запуск из корня репозитория:
+
+    python benchmarks/bench_date_range.py                     # SQLite во временном файле, 10 млн строк
+    python benchmarks/bench_date_range.py --rows 1000000
+    DATABASE_URL=postgres://... python benchmarks/bench_date_range.py
+
+Таблица bench_transactions повторяет столбцы transactions и индекс по date;
+операции равномерно распределены по --days последним дням. Для каждого
+варианта фильтра печатается план запроса и медианное время выполнения.
+Условие с диапазоном строится тем же date_range_filter, что и в приложении.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TABLE = 'bench_transactions'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10_000_000, help='число синтетических операций')
+    parser.add_argument('--days', type=int, default=730, help='период, по которому распределены операции')
+    parser.add_argument('--repeat', type=int, default=5, help='повторов каждого запроса')
+    parser.add_argument('--keep', action='store_true', help='не удалять таблицу после прогона')
+    return parser.parse_args()
+
+
+def setup_environment():
+    if 'DATABASE_URL' not in os.environ:
+        os.environ.setdefault('SQLITE_PATH', os.path.join(tempfile.mkdtemp(), 'date_range.db'))
+    sys.path.insert(0, ROOT)
+
+
+def create_table(app_module, cur, rows, days):
+    """Наполняет таблицу средствами самой СУБД — без передачи строк через Python."""
+    cur.execute(f'DROP TABLE IF EXISTS {TABLE}')
+    seconds = days * 86400
+    if app_module.USE_POSTGRESQL:
+        cur.execute(f'''
+            CREATE TABLE {TABLE} AS
+            SELECT g AS id,
+                   'Перевод'::TEXT AS type,
+                   'ACC' || (g % 100000) AS from_account,
+                   'ACC' || ((g * 7) % 100000) AS to_account,
+                   (g % 100000)::BIGINT AS amount,
+                   'Успешно'::TEXT AS status,
+                   CURRENT_TIMESTAMP - (%s - g::BIGINT * %s / %s) * INTERVAL '1 second' AS date
+            FROM generate_series(1, %s) AS g
+        ''', (seconds, seconds, rows, rows))
+    else:
+        cur.execute(f'''
+            CREATE TABLE {TABLE} (
+                id INTEGER PRIMARY KEY, type TEXT, from_account TEXT, to_account TEXT,
+                amount BIGINT, status TEXT, date TIMESTAMP
+            )
+        ''')
+        cur.execute(f'''
+            WITH RECURSIVE g(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM g WHERE n < ?)
+            INSERT INTO {TABLE} (id, type, from_account, to_account, amount, status, date)
+            SELECT n, 'Перевод', 'ACC' || (n % 100000), 'ACC' || ((n * 7) % 100000), n % 100000, 'Успешно',
+                   datetime('now', '-' || (? - n * ? / ?) || ' seconds')
+            FROM g
+        ''', (rows, seconds, seconds, rows))
+    cur.execute(f'CREATE INDEX idx_{TABLE}_date ON {TABLE}(date)')
+    cur.execute(f'ANALYZE {TABLE}')
+
+
+def plan(app_module, cur, query, params):
+    if app_module.USE_POSTGRESQL:
+        cur.execute('EXPLAIN ' + query, params)
+        return [list(dict(row).values())[0] for row in cur.fetchall()]
+    cur.execute('EXPLAIN QUERY PLAN ' + query, params)
+    return [row['detail'] for row in cur.fetchall()]
+
+
+def timed(cur, query, params, repeat):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        cur.execute(query, params)
+        result = cur.fetchone()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings), dict(result)
+
+
+def main():
+    args = parse_args()
+    setup_environment()
+    import app as app_module
+
+    p = '%s' if app_module.USE_POSTGRESQL else '?'
+    conn = app_module.get_db_connection()
+    cur = conn.cursor()
+
+    backend = 'PostgreSQL' if app_module.USE_POSTGRESQL else 'SQLite'
+    print(f'Бэкенд: {backend}, строк: {args.rows}, период: {args.days} дн.')
+    started = time.perf_counter()
+    create_table(app_module, cur, args.rows, args.days)
+    conn.commit()
+    print(f'Таблица заполнена за {time.perf_counter() - started:.1f} с')
+
+    day_to = date.today() - timedelta(days=30)
+    cases = [('один день', day_to, day_to), ('неделя', day_to - timedelta(days=6), day_to)]
+    select = f'SELECT COUNT(*) AS cnt, COALESCE(SUM(amount), 0) AS total FROM {TABLE} WHERE 1=1'
+    for title, first, last in cases:
+        print(f'=== {title}: {first} .. {last}')
+        variants = [
+            ('DATE(date) BETWEEN', select + f' AND DATE(date) >= {p} AND DATE(date) <= {p}',
+             [first.isoformat(), last.isoformat()]),
+        ]
+        range_sql, range_params = app_module.date_range_filter('date', first.isoformat(), last.isoformat())
+        variants.append(('[start, end) по date', select + range_sql, range_params))
+        for name, query, params in variants:
+            median, result = timed(cur, query, params, args.repeat)
+            print(f'--- {name}: {median * 1000:.2f} мс, строк {result["cnt"]}, сумма {result["total"]}')
+            for line in plan(app_module, cur, query, params):
+                print('   ', line)
+
+    if not args.keep:
+        cur.execute(f'DROP TABLE IF EXISTS {TABLE}')
+        conn.commit()
+    cur.close()
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
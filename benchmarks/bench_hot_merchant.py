@@ -0,0 +1,143 @@
+"""Оплаты по NFC одному продавцу: баланс одной строкой против разделённого на корзины.
+
+Запуск из корня репозитория:
+
+    python benchmarks/bench_hot_merchant.py                   # SQLite во временном файле
+    python benchmarks/bench_hot_merchant.py --buckets 0,16 --clients 32
+    DATABASE_URL=postgres://... python benchmarks/bench_hot_merchant.py
+
+--clients покупателей одновременно платят одному продавцу через маршрут
+/api/nfc/confirm_payment в течение --duration секунд. Прогон повторяется для
+каждого значения --buckets (0 — баланс продавца одной строкой users). После
+каждого прогона корзины сворачиваются и проверяется, что продавец получил ровно
+столько, сколько списано с покупателей.
+
+В SQLite все записи идут через одну блокировку базы, поэтому разница видна
+только на PostgreSQL: там без корзин каждое подтверждение ждёт блокировку
+строки продавца.
+"""
+import argparse
+import secrets
+import sys
+import threading
+import time
+from datetime import datetime
+
+from _common import cleanup, create_nfc_tag, create_user, setup_environment
+
+PREFIX = 'BENCHHOT'
+PIN = '4321'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=16, help='число параллельных покупателей')
+    parser.add_argument('--duration', type=float, default=5.0, help='длительность прогона, секунд')
+    parser.add_argument('--buckets', default='0,8', help='число корзин продавца через запятую')
+    parser.add_argument('--amount', default='1', help='сумма одной оплаты, руб.')
+    return parser.parse_args()
+
+
+def seed(app_module, clients):
+    """Продавец и покупатели с NFC-метками и PIN; у каждого покупателя хватает денег на весь прогон."""
+    conn = app_module.get_db_connection()
+    cur = conn.cursor()
+    seller_id = create_user(app_module, cur, PREFIX, 'SELLER', 0, 7)
+    buyer_ids = []
+    for i in range(clients):
+        buyer_id = create_user(app_module, cur, PREFIX, f'BUYER{i:04d}', app_module.to_minor('1000000'), 6)
+        create_nfc_tag(app_module, cur, PREFIX, buyer_id, PIN)
+        buyer_ids.append(buyer_id)
+    conn.commit()
+    cur.close()
+    conn.close()
+    return seller_id, buyer_ids
+
+
+def set_buckets(app_module, seller_id, buckets):
+    conn = app_module.get_db_connection()
+    cur = conn.cursor()
+    app_module.begin_write_transaction(conn)
+    app_module.fold_balance_buckets(cur, seller_id)
+    app_module.execute(cur, 'UPDATE users SET balance_buckets = ? WHERE id = ?', (buckets, seller_id))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def balances(app_module, seller_id):
+    conn = app_module.get_db_connection()
+    cur = conn.cursor()
+    app_module.execute(cur, 'SELECT balance FROM users WHERE id = ?', (seller_id,))
+    seller = cur.fetchone()['balance']
+    app_module.execute(cur, 'SELECT COALESCE(SUM(balance), 0) AS total FROM users WHERE account_number LIKE ?',
+            (PREFIX + 'BUYER%',))
+    buyers = cur.fetchone()['total']
+    cur.close()
+    conn.close()
+    return seller, buyers
+
+
+def run(app_module, seller_id, buyer_ids, amount, duration):
+    store = app_module.get_payment_session_store()
+    stop_at = time.monotonic() + duration
+    counters = {'ok': 0, 'failed': 0}
+    lock = threading.Lock()
+    barrier = threading.Barrier(len(buyer_ids))
+
+    def buyer(buyer_id):
+        client = app_module.app.test_client()
+        ok = failed = 0
+        barrier.wait()
+        while time.monotonic() < stop_at:
+            # Сессию создаёт терминал продавца — здесь напрямую через хранилище
+            session_id = secrets.token_urlsafe(16)
+            store.create(session_id, buyer_id, seller_id, datetime.now() + app_module.PAYMENT_SESSION_TTL)
+            store.set_amount(session_id, amount)
+            response = client.post('/api/nfc/confirm_payment', json={'session_id': session_id, 'pin': PIN})
+            if response.get_json().get('success'):
+                ok += 1
+            else:
+                failed += 1
+        with lock:
+            counters['ok'] += ok
+            counters['failed'] += failed
+
+    threads = [threading.Thread(target=buyer, args=(buyer_id,)) for buyer_id in buyer_ids]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counters, time.monotonic() - started
+
+
+def main():
+    args = parse_args()
+    setup_environment('hot.db', args.clients + 2)
+    import app as app_module
+
+    cleanup(app_module, PREFIX)
+    amount = app_module.to_minor(args.amount)
+    seller_id, buyer_ids = seed(app_module, args.clients)
+
+    backend = 'PostgreSQL' if app_module.USE_POSTGRESQL else 'SQLite'
+    print(f'Бэкенд: {backend}, покупателей: {args.clients}, длительность: {args.duration} с')
+    print(f'{"корзин":>7} {"оплат":>8} {"оплат/с":>9} {"отказы":>7}  проверка')
+    all_passed = True
+    for buckets in [int(b) for b in args.buckets.split(',')]:
+        set_buckets(app_module, seller_id, buckets)
+        seller_before, buyers_before = balances(app_module, seller_id)
+        counters, elapsed = run(app_module, seller_id, buyer_ids, amount, args.duration)
+        app_module.compact_balance_buckets()
+        seller_after, buyers_after = balances(app_module, seller_id)
+        passed = (seller_after - seller_before == buyers_before - buyers_after == counters['ok'] * amount)
+        all_passed = all_passed and passed
+        print(f'{buckets:>7} {counters["ok"]:>8} {counters["ok"] / elapsed:>9.1f} {counters["failed"]:>7}  '
+              f'{"OK" if passed else "РАСХОЖДЕНИЕ"}')
+    cleanup(app_module, PREFIX)
+    sys.exit(0 if all_passed else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""Параллельные подтверждения NFC-оплат одного покупателя: нет потерянных обновлений.
+
+Запуск из корня репозитория:
+
+    python benchmarks/bench_nfc_confirm.py                    # SQLite во временном файле
+    DATABASE_URL=postgres://... python benchmarks/bench_nfc_confirm.py
+
+Покупателю начисляется --balance руб., затем --sessions терминалов разных
+продавцов одновременно подтверждают оплату по --amount руб. каждый (через
+маршрут /api/nfc/confirm_payment). Суммарно терминалы просят больше, чем есть
+на счету, поэтому часть оплат обязана получить «Недостаточно средств».
+Проверяется, что списано ровно столько, сколько прошло успешных оплат, баланс
+не ушёл в минус, а в журнале по одной записи на каждую успешную оплату.
+Часть терминалов сначала вводит неверный PIN — счётчик попыток не должен теряться.
+"""
+import argparse
+import secrets
+import sys
+import threading
+import time
+from datetime import datetime
+
+from _common import cleanup, create_nfc_tag, create_user, setup_environment
+
+PREFIX = 'BENCHNFC'
+PIN = '4321'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sessions', type=int, default=32, help='число параллельных терминалов')
+    parser.add_argument('--balance', default='100', help='баланс покупателя, руб.')
+    parser.add_argument('--amount', default='7', help='сумма одной оплаты, руб.')
+    parser.add_argument('--wrong-pins', type=int, default=3, help='сколько терминалов сначала ошибаются с PIN')
+    return parser.parse_args()
+
+
+def seed(app_module, sessions, balance, amount):
+    conn = app_module.get_db_connection()
+    cur = conn.cursor()
+    buyer_id = create_user(app_module, cur, PREFIX, 'BUYER', app_module.to_minor(balance), 6)
+    seller_ids = [create_user(app_module, cur, PREFIX, f'SELLER{i:04d}', 0, 7) for i in range(sessions)]
+    tag_id = create_nfc_tag(app_module, cur, PREFIX, buyer_id, PIN)
+    conn.commit()
+    cur.close()
+    conn.close()
+
+    store = app_module.get_payment_session_store()
+    session_ids = []
+    for seller_id in seller_ids:
+        session_id = secrets.token_urlsafe(16)
+        store.create(session_id, buyer_id, seller_id, datetime.now() + app_module.PAYMENT_SESSION_TTL)
+        store.set_amount(session_id, app_module.to_minor(amount))
+        session_ids.append(session_id)
+    return buyer_id, tag_id, session_ids
+
+
+def main():
+    args = parse_args()
+    setup_environment('nfc.db', args.sessions)
+    import app as app_module
+
+    cleanup(app_module, PREFIX)
+    balance = app_module.to_minor(args.balance)
+    amount = app_module.to_minor(args.amount)
+    buyer_id, tag_id, session_ids = seed(app_module, args.sessions, args.balance, args.amount)
+
+    results = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(len(session_ids))
+
+    def terminal(index, session_id):
+        client = app_module.app.test_client()
+        barrier.wait()
+        if index < args.wrong_pins:
+            client.post('/api/nfc/confirm_payment', json={'session_id': session_id, 'pin': '0000'})
+        response = client.post('/api/nfc/confirm_payment', json={'session_id': session_id, 'pin': PIN})
+        with lock:
+            results.append(response.get_json())
+
+    threads = [threading.Thread(target=terminal, args=(i, s)) for i, s in enumerate(session_ids)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    ok = sum(1 for r in results if r.get('success'))
+    errors = {}
+    for r in results:
+        if not r.get('success'):
+            errors[r.get('error')] = errors.get(r.get('error'), 0) + 1
+
+    conn = app_module.get_db_connection()
+    cur = conn.cursor()
+    app_module.execute(cur, 'SELECT balance FROM users WHERE id = ?', (buyer_id,))
+    buyer_balance = cur.fetchone()['balance']
+    app_module.execute(cur, 'SELECT COALESCE(SUM(balance), 0) AS total FROM users WHERE account_number LIKE ?',
+            (PREFIX + 'SELLER%',))
+    sellers_total = cur.fetchone()['total']
+    app_module.execute(cur, 'SELECT COUNT(*) AS count FROM transactions WHERE from_account = ?', (PREFIX + 'BUYER',))
+    ledger_rows = cur.fetchone()['count']
+    app_module.execute(cur, 'SELECT attempts, is_locked FROM user_pins WHERE user_id = ? AND nfc_tag_id = ?',
+            (buyer_id, tag_id))
+    pin_row = dict(cur.fetchone())
+    cur.close()
+    conn.close()
+
+    backend = 'PostgreSQL' if app_module.USE_POSTGRESQL else 'SQLite'
+    print(f'Бэкенд: {backend}, терминалов: {len(session_ids)}, время: {elapsed:.2f} с')
+    print(f'Успешных оплат: {ok}, отказы: {errors}')
+    print(f'Покупатель: {balance} -> {buyer_balance} коп., продавцы получили {sellers_total} коп., '
+          f'записей в журнале: {ledger_rows}, PIN: {pin_row}')
+    checks = {
+        'баланс не отрицательный': buyer_balance >= 0,
+        'списано = успешные оплаты': balance - buyer_balance == ok * amount,
+        'зачислено = списано': sellers_total == balance - buyer_balance,
+        'журнал = успешные оплаты': ledger_rows == ok,
+        'оплат не больше, чем позволяет баланс': ok == min(len(session_ids), balance // amount),
+    }
+    for name, passed in checks.items():
+        print(f'  {"OK " if passed else "FAIL"} {name}')
+    cleanup(app_module, PREFIX)
+    sys.exit(0 if all(checks.values()) else 1)
+
+
+if __name__ == '__main__':
+    main()
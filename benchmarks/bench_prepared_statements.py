@@ -0,0 +1,120 @@
+"""Время планирования горячих запросов: обычный execute против PREPARE/EXECUTE.
+
+Запуск из корня репозитория (только PostgreSQL — в SQLite PREPARE не используется):
+
+    DATABASE_URL=postgres://... python benchmarks/bench_prepared_statements.py
+    DATABASE_URL=postgres://... python benchmarks/bench_prepared_statements.py --repeat 500
+
+Для путей входа, перевода и подтверждения оплаты по NFC скрипт берёт их
+запросы из HOT_STATEMENTS и для каждого печатает медианное «Planning Time»
+из EXPLAIN (ANALYZE) — один раз для текста запроса, один раз для EXECUTE
+подготовленного запроса. Затем весь путь целиком прогоняется --repeat раз
+обоими способами и печатается медианное время пути. Записывающие запросы
+выполняются в транзакции, которая откатывается, так что данные не меняются.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PATHS = {
+    'вход': ['user_by_passport'],
+    'перевод': ['user_by_account', 'lock_transfer_accounts', 'debit_balance', 'credit_balance',
+                'insert_transaction'],
+    'оплата NFC': ['payment_session_by_id', 'lock_pin', 'debit_balance', 'credit_balance',
+                   'insert_transaction'],
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=200, help='повторов каждого запроса и пути')
+    return parser.parse_args()
+
+
+def setup_environment():
+    if 'DATABASE_URL' not in os.environ:
+        sys.exit('Нужен DATABASE_URL: подготовленные запросы используются только в PostgreSQL')
+    os.environ['BACKGROUND_TASKS_ENABLED'] = '0'
+    sys.path.insert(0, ROOT)
+
+
+def sample_params(cur):
+    """Параметры запросов — существующие строки, чтобы планы были как в работе приложения."""
+    cur.execute('SELECT id, passport, account_number FROM users ORDER BY id LIMIT 2')
+    first, second = cur.fetchall()
+    return {
+        'user_by_passport': (first['passport'],),
+        'user_by_account': (second['account_number'],),
+        'lock_transfer_accounts': (first['account_number'], second['account_number']),
+        'debit_balance': (1, first['id'], 1),
+        'credit_balance': (1, second['id']),
+        'insert_transaction': ('Перевод', first['account_number'], second['account_number'], 1, 'Успешно',
+                               'bench', first['id']),
+        'payment_session_by_id': ('bench-session',),
+        'lock_pin': (first['id'], 1),
+    }
+
+
+def planning_time(cur, statement, params):
+    cur.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + statement, params)
+    return cur.fetchone()['QUERY PLAN'][0]['Planning Time']
+
+
+def median_planning(conn, cur, statement, params, repeat):
+    timings = []
+    for _ in range(repeat):
+        timings.append(planning_time(cur, statement, params))
+        conn.rollback()
+    return statistics.median(timings)
+
+
+def median_path(conn, cur, run, names, params, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for name in names:
+            run(cur, name, params[name])
+        timings.append(time.perf_counter() - started)
+        conn.rollback()
+    return statistics.median(timings) * 1000
+
+
+def main():
+    args = parse_args()
+    setup_environment()
+    import app as app_module
+
+    app_module.ensure_schema()
+    registry = app_module.PreparedStatementRegistry(app_module.HOT_STATEMENTS, enabled=True)
+    conn = app_module.open_db_connection()
+    cur = conn.cursor()
+    params = sample_params(cur)
+
+    print(f'{"запрос":<24} {"план текста, мс":>16} {"план EXECUTE, мс":>17}')
+    for name in sorted({name for names in PATHS.values() for name in names}):
+        adhoc = median_planning(conn, cur, app_module.sql(app_module.HOT_STATEMENTS[name]), params[name],
+                                args.repeat)
+        statement = registry.prepare(cur, name)
+        conn.commit()
+        prepared = median_planning(conn, cur, statement, params[name], args.repeat)
+        print(f'{name:<24} {adhoc:>16.3f} {prepared:>17.3f}')
+
+    def run_adhoc(cur, name, values):
+        app_module.execute(cur, app_module.HOT_STATEMENTS[name], values)
+
+    print()
+    print(f'{"путь":<12} {"execute, мс":>12} {"EXECUTE, мс":>12}')
+    for path, names in PATHS.items():
+        adhoc_ms = median_path(conn, cur, run_adhoc, names, params, args.repeat)
+        prepared_ms = median_path(conn, cur, registry.execute, names, params, args.repeat)
+        print(f'{path:<12} {adhoc_ms:>12.3f} {prepared_ms:>12.3f}')
+    cur.close()
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
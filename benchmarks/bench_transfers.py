@@ -0,0 +1,148 @@
+"""Пропускная способность движка переводов (execute_transfer) при 1, 8 и 32 клиентах.
+
+Запуск из корня репозитория:
+
+    python benchmarks/bench_transfers.py                      # SQLite во временном файле
+    DATABASE_URL=postgres://... python benchmarks/bench_transfers.py
+
+Каждый клиент — отдельный поток, который в цикле переводит случайную сумму
+между случайными тестовыми счетами. После прогона проверяется, что сумма
+балансов тестовых счетов не изменилась (нет потерянных обновлений).
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ACCOUNT_PREFIX = 'BENCHTR'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', default='1,8,32', help='число параллельных клиентов через запятую')
+    parser.add_argument('--duration', type=float, default=5.0, help='длительность прогона, секунд')
+    parser.add_argument('--accounts', type=int, default=200, help='число тестовых счетов')
+    parser.add_argument('--balance', default='1000000', help='начальный баланс счёта, руб.')
+    return parser.parse_args()
+
+
+def setup_environment(max_clients):
+    if 'DATABASE_URL' not in os.environ:
+        os.environ.setdefault('SQLITE_PATH', os.path.join(tempfile.mkdtemp(), 'bench.db'))
+    os.environ['DB_POOL_SIZE'] = str(max_clients)
+    sys.path.insert(0, ROOT)
+
+
+def cleanup(app_module):
+    conn = app_module.get_db_connection()
+    cur = conn.cursor()
+    like = ACCOUNT_PREFIX + '%'
+    if app_module.USE_POSTGRESQL:
+        cur.execute('DELETE FROM transactions WHERE from_account LIKE %s', (like,))
+        cur.execute('DELETE FROM users WHERE account_number LIKE %s', (like,))
+    else:
+        cur.execute('DELETE FROM transactions WHERE from_account LIKE ?', (like,))
+        cur.execute('DELETE FROM users WHERE account_number LIKE ?', (like,))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def seed_accounts(app_module, count, balance):
+    accounts = [f'{ACCOUNT_PREFIX}{i:06d}' for i in range(count)]
+    conn = app_module.get_db_connection()
+    cur = conn.cursor()
+    balance = app_module.to_minor(balance)
+    rows = [(f'bench-tr-{i}', f'Bench {i}', account, balance, 6, 'bench') for i, account in enumerate(accounts)]
+    if app_module.USE_POSTGRESQL:
+        cur.executemany('''
+            INSERT INTO users (passport, full_name, account_number, balance, role_id, password_hash)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        ''', rows)
+    else:
+        cur.executemany('''
+            INSERT INTO users (passport, full_name, account_number, balance, role_id, password_hash)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', rows)
+    conn.commit()
+    cur.close()
+    conn.close()
+    return accounts
+
+
+def total_balance(app_module):
+    conn = app_module.get_db_connection()
+    cur = conn.cursor()
+    if app_module.USE_POSTGRESQL:
+        cur.execute('SELECT SUM(balance) AS total FROM users WHERE account_number LIKE %s', (ACCOUNT_PREFIX + '%',))
+    else:
+        cur.execute('SELECT SUM(balance) AS total FROM users WHERE account_number LIKE ?', (ACCOUNT_PREFIX + '%',))
+    total = cur.fetchone()['total']
+    cur.close()
+    conn.close()
+    return total
+
+
+def run(app_module, accounts, clients, duration):
+    stop_at = time.monotonic() + duration
+    counters = {'ok': 0, 'rejected': 0, 'errors': 0}
+    lock = threading.Lock()
+
+    def client():
+        ok = rejected = errors = 0
+        rnd = random.Random()
+        while time.monotonic() < stop_at:
+            from_account, to_account = rnd.sample(accounts, 2)
+            try:
+                app_module.execute_transfer(from_account, to_account, rnd.randint(1, 10000), 'bench')
+                ok += 1
+            except app_module.TransferError:
+                rejected += 1
+            except Exception:
+                errors += 1
+        with lock:
+            counters['ok'] += ok
+            counters['rejected'] += rejected
+            counters['errors'] += errors
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    return counters, elapsed
+
+
+def main():
+    args = parse_args()
+    client_counts = [int(c) for c in args.clients.split(',')]
+    setup_environment(max(client_counts))
+    import app as app_module
+
+    cleanup(app_module)
+    accounts = seed_accounts(app_module, args.accounts, args.balance)
+    expected_total = total_balance(app_module)
+
+    backend = 'PostgreSQL' if app_module.USE_POSTGRESQL else 'SQLite'
+    print(f'Бэкенд: {backend}, счетов: {len(accounts)}, длительность: {args.duration} с')
+    print(f'{"клиенты":>8} {"переводов":>10} {"перевод/с":>10} {"отказы":>8} {"ошибки":>8}')
+    for clients in client_counts:
+        counters, elapsed = run(app_module, accounts, clients, args.duration)
+        print(f'{clients:>8} {counters["ok"]:>10} {counters["ok"] / elapsed:>10.1f} '
+              f'{counters["rejected"]:>8} {counters["errors"]:>8}')
+
+    actual_total = total_balance(app_module)
+    print(f'Сумма балансов: до {expected_total}, после {actual_total} — '
+          f'{"OK" if actual_total == expected_total else "РАСХОЖДЕНИЕ"}')
+    print('Пул соединений:', app_module.get_db_pool().snapshot())
+    cleanup(app_module)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""Поиск пользователей для автодополнения: LIKE '%...%' против поискового индекса.
+
+Запуск из корня репозитория:
+
+    python benchmarks/bench_user_search.py                    # SQLite во временном файле, 1 млн пользователей
+    python benchmarks/bench_user_search.py --users 100000
+    DATABASE_URL=postgres://... python benchmarks/bench_user_search.py
+
+Скрипт добавляет --users синтетических пользователей со случайными русскими
+ФИО, затем для набора запросов (начало фамилии, имя с фамилией, «ё», часть
+номера счета) печатает медианное время прежнего запроса с LIKE и
+search_users — в PostgreSQL по GIN-индексу pg_trgm, в SQLite по FTS5.
+Цель — не больше 20 мс на запрос автодополнения.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PREFIX = 'BENCHUS'
+BATCH = 10000
+
+FIRST_NAMES = ['Александр', 'Алексей', 'Анна', 'Артём', 'Дарья', 'Дмитрий', 'Екатерина', 'Елена', 'Иван',
+               'Ирина', 'Кирилл', 'Мария', 'Михаил', 'Наталья', 'Никита', 'Ольга', 'Пётр', 'Семён', 'Сергей',
+               'Татьяна', 'Фёдор', 'Юлия']
+LAST_NAMES = ['Иванов', 'Петров', 'Сидоров', 'Смирнов', 'Кузнецов', 'Попов', 'Васильев', 'Соколов', 'Михайлов',
+              'Новиков', 'Фёдоров', 'Морозов', 'Волков', 'Алексеев', 'Лебедев', 'Семёнов', 'Егоров', 'Павлов',
+              'Козлов', 'Степанов', 'Николаев', 'Орлов', 'Андреев', 'Макаров', 'Никитин', 'Захаров']
+SUFFIXES = ['', 'ский', 'енко', 'ин', 'цев', 'ович']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1_000_000, help='число синтетических пользователей')
+    parser.add_argument('--repeat', type=int, default=20, help='повторов каждого запроса')
+    parser.add_argument('--keep', action='store_true', help='не удалять пользователей после прогона')
+    return parser.parse_args()
+
+
+def setup_environment():
+    if 'DATABASE_URL' not in os.environ:
+        os.environ.setdefault('SQLITE_PATH', os.path.join(tempfile.mkdtemp(), 'search.db'))
+    os.environ['BACKGROUND_TASKS_ENABLED'] = '0'
+    sys.path.insert(0, ROOT)
+
+
+def cleanup(app_module):
+    conn = app_module.get_db_connection()
+    cur = conn.cursor()
+    if app_module.USE_POSTGRESQL:
+        cur.execute('DELETE FROM users WHERE passport LIKE %s', (PREFIX + '%',))
+    else:
+        cur.execute('DELETE FROM users WHERE passport LIKE ?', (PREFIX + '%',))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def seed_users(app_module, count):
+    rnd = random.Random(42)
+    conn = app_module.get_db_connection()
+    cur = conn.cursor()
+    p = '%s' if app_module.USE_POSTGRESQL else '?'
+    sql = f'INSERT INTO users (passport, full_name, account_number, password_hash) VALUES ({p}, {p}, {p}, {p})'
+    for offset in range(0, count, BATCH):
+        rows = []
+        for i in range(offset, min(offset + BATCH, count)):
+            name = f'{rnd.choice(LAST_NAMES)}{rnd.choice(SUFFIXES)} {rnd.choice(FIRST_NAMES)}'
+            rows.append((f'{PREFIX}{i:08d}', name, f'ACC{i * 7919 % 10 ** 9:09d}', 'bench'))
+        cur.executemany(sql, rows)
+        conn.commit()
+    cur.execute('ANALYZE')
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def like_search(app_module, cur, query):
+    pattern = f'%{query}%'
+    if app_module.USE_POSTGRESQL:
+        cur.execute('''
+            SELECT id, passport, full_name, account_number FROM users
+            WHERE passport ILIKE %s OR full_name ILIKE %s OR account_number ILIKE %s
+            LIMIT 20
+        ''', (pattern, pattern, pattern))
+    else:
+        cur.execute('''
+            SELECT id, passport, full_name, account_number FROM users
+            WHERE passport LIKE ? OR full_name LIKE ? OR account_number LIKE ?
+            LIMIT 20
+        ''', (pattern, pattern, pattern))
+    return cur.fetchall()
+
+
+def timed(func, repeat):
+    timings = []
+    result = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000, result
+
+
+def main():
+    args = parse_args()
+    setup_environment()
+    import app as app_module
+
+    cleanup(app_module)
+    backend = 'PostgreSQL' if app_module.USE_POSTGRESQL else 'SQLite'
+    started = time.perf_counter()
+    seed_users(app_module, args.users)
+    print(f'Бэкенд: {backend}, пользователей: {args.users}, заполнено за {time.perf_counter() - started:.1f} с')
+
+    conn = app_module.get_db_connection()
+    cur = conn.cursor()
+    queries = ['Пе', 'Петр', 'Семенов Ан', 'Фёдоров', 'ковенко', 'ACC12345']
+    print(f'{"запрос":<14} {"LIKE, мс":>10} {"найдено":>8} {"индекс, мс":>11} {"найдено":>8}  первый результат')
+    for query in queries:
+        like_ms, like_rows = timed(lambda: like_search(app_module, cur, query), args.repeat)
+        index_ms, index_rows = timed(lambda: app_module.search_users(cur, query), args.repeat)
+        first = index_rows[0]['full_name'] if index_rows else '—'
+        print(f'{query:<14} {like_ms:>10.2f} {len(like_rows):>8} {index_ms:>11.2f} {len(index_rows):>8}  {first}')
+    cur.close()
+    conn.close()
+
+    if not args.keep:
+        cleanup(app_module)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""Планы запросов истории счета: старое условие с OR против UNION ALL по сторонам.
+
+Запуск из корня репозитория:
+
+    python benchmarks/explain_history.py                      # SQLite во временном файле
+    DATABASE_URL=postgres://... python benchmarks/explain_history.py
+
+Скрипт наполняет transactions синтетическими операциями (--rows), обновляет
+статистику планировщика и печатает план каждого запроса вместе со временем
+выполнения. В плане UNION ALL обе ветки должны идти по индексам
+idx_transactions_from_date / idx_transactions_to_date, без полного просмотра
+таблицы transactions.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ACCOUNT_PREFIX = 'BENCHHI'
+BATCH = 5000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=200000, help='число синтетических операций')
+    parser.add_argument('--accounts', type=int, default=2000, help='число синтетических счетов')
+    parser.add_argument('--limit', type=int, default=50, help='размер страницы истории')
+    return parser.parse_args()
+
+
+def setup_environment():
+    if 'DATABASE_URL' not in os.environ:
+        os.environ.setdefault('SQLITE_PATH', os.path.join(tempfile.mkdtemp(), 'explain.db'))
+    sys.path.insert(0, ROOT)
+
+
+def cleanup(app_module):
+    conn = app_module.get_db_connection()
+    cur = conn.cursor()
+    if app_module.USE_POSTGRESQL:
+        cur.execute('DELETE FROM transactions WHERE from_account LIKE %s', (ACCOUNT_PREFIX + '%',))
+    else:
+        cur.execute('DELETE FROM transactions WHERE from_account LIKE ?', (ACCOUNT_PREFIX + '%',))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def seed_transactions(app_module, rows, accounts):
+    names = [f'{ACCOUNT_PREFIX}{i:06d}' for i in range(accounts)]
+    rnd = random.Random(42)
+    start = datetime.now() - timedelta(days=365)
+    conn = app_module.get_db_connection()
+    cur = conn.cursor()
+    placeholders = ', '.join(['%s' if app_module.USE_POSTGRESQL else '?'] * 6)
+    sql = f'''
+        INSERT INTO transactions (type, from_account, to_account, amount, status, date)
+        VALUES ({placeholders})
+    '''
+    for offset in range(0, rows, BATCH):
+        batch = []
+        for i in range(offset, min(offset + BATCH, rows)):
+            from_account, to_account = rnd.sample(names, 2)
+            date = start + timedelta(seconds=i * 365 * 86400 // rows)
+            batch.append(('Перевод', from_account, to_account, rnd.randint(100, 100000), 'Завершено',
+                          date.strftime('%Y-%m-%d %H:%M:%S')))
+        cur.executemany(sql, batch)
+    conn.commit()
+    cur.execute('ANALYZE')
+    conn.commit()
+    cur.close()
+    conn.close()
+    return names
+
+
+def explain(app_module, cur, title, query, params):
+    print(f'--- {title}')
+    if app_module.USE_POSTGRESQL:
+        cur.execute('EXPLAIN (ANALYZE, BUFFERS) ' + query, params)
+        for row in cur.fetchall():
+            print('   ', list(dict(row).values())[0])
+    else:
+        cur.execute('EXPLAIN QUERY PLAN ' + query, params)
+        for row in cur.fetchall():
+            print('   ', row['detail'])
+    started = time.perf_counter()
+    cur.execute(query, params)
+    count = len(cur.fetchall())
+    print(f'    строк: {count}, время: {(time.perf_counter() - started) * 1000:.2f} мс')
+
+
+def main():
+    args = parse_args()
+    setup_environment()
+    import app as app_module
+
+    cleanup(app_module)
+    accounts = seed_transactions(app_module, args.rows, args.accounts)
+    account = accounts[len(accounts) // 2]
+    p = '%s' if app_module.USE_POSTGRESQL else '?'
+
+    backend = 'PostgreSQL' if app_module.USE_POSTGRESQL else 'SQLite'
+    print(f'Бэкенд: {backend}, операций: {args.rows}, счет: {account}')
+
+    conn = app_module.get_db_connection()
+    cur = conn.cursor()
+    explain(app_module, cur, 'OR по двум колонкам (старый вариант)',
+            f'SELECT * FROM transactions WHERE from_account = {p} OR to_account = {p} '
+            f'ORDER BY date DESC LIMIT {p}',
+            (account, account, args.limit))
+
+    query, params = app_module.account_history_query(account, args.limit)
+    explain(app_module, cur, 'UNION ALL по сторонам', query, params)
+
+    query, params = app_module.account_history_query(account, args.limit, with_names=True)
+    explain(app_module, cur, 'UNION ALL по сторонам с именами', query, params)
+
+    cur.execute(query, params)
+    last = cur.fetchall()[-1]
+    query, params = app_module.account_history_query(
+        account, args.limit, app_module.encode_history_cursor(last))
+    explain(app_module, cur, 'UNION ALL, следующая страница по курсору', query, params)
+    cur.close()
+    conn.close()
+
+    cleanup(app_module)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Локальный SMTP-сервер-заглушка для проверки очереди писем.
+
+Запуск из корня репозитория:
+
+    python benchmarks/smtp_sink.py --port 8025 --delay 2       # каждое письмо «доставляется» 2 с
+    python benchmarks/smtp_sink.py --port 8025 --fail-rate 0.3  # 30% писем получают временный отказ 451
+
+Приложение направляется на него переменными окружения:
+
+    SMTP_HOST=127.0.0.1 SMTP_PORT=8025 SMTP_STARTTLS=0 flask run
+
+Одобрение заявки возвращается сразу, а письмо появляется в выводе заглушки
+после очередного прохода задачи deliver_emails (или `flask deliver-emails`).
+Сервер понимает минимальный набор команд (EHLO/HELO, MAIL, RCPT, DATA, RSET,
+NOOP, QUIT), печатает получателя и тему каждого письма и считает соединения —
+по счётчику видно, что отправка переиспользует SMTP-соединение.
+"""
+import argparse
+import email
+import random
+import socketserver
+import threading
+import time
+from email.header import decode_header, make_header
+
+
+class SinkStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.messages = []
+        self.rejected = 0
+
+    def snapshot(self):
+        with self.lock:
+            return {'connections': self.connections, 'messages': len(self.messages), 'rejected': self.rejected}
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode())
+
+    def handle(self):
+        server = self.server
+        with server.stats.lock:
+            server.stats.connections += 1
+        self.reply('220 smtp-sink ready')
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors='replace').strip()
+            verb = command[:4].upper()
+            if verb in ('EHLO', 'HELO'):
+                self.reply('250-smtp-sink\r\n250 8BITMIME' if verb == 'EHLO' else '250 smtp-sink')
+            elif verb == 'MAIL':
+                recipients = []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                recipients.append(command.split(':', 1)[-1].strip(' <>'))
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                while True:
+                    chunk = self.rfile.readline()
+                    if not chunk or chunk in (b'.\r\n', b'.\n'):
+                        break
+                    data.append(chunk[1:] if chunk.startswith(b'..') else chunk)
+                time.sleep(server.delay)
+                if random.random() < server.fail_rate:
+                    with server.stats.lock:
+                        server.stats.rejected += 1
+                    self.reply('451 Temporary failure, try again later')
+                    continue
+                message = email.message_from_bytes(b''.join(data))
+                subject = str(make_header(decode_header(message.get('Subject', ''))))
+                with server.stats.lock:
+                    server.stats.messages.append((recipients, subject))
+                if not server.quiet:
+                    print(f'📨 {", ".join(recipients)}: {subject}', flush=True)
+                self.reply('250 OK: queued')
+            elif verb in ('RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=8025, delay=0.0, fail_rate=0.0, quiet=False):
+        super().__init__((host, port), SMTPHandler)
+        self.delay = delay
+        self.fail_rate = fail_rate
+        self.quiet = quiet
+        self.stats = SinkStats()
+
+    def start(self):
+        """Запускает сервер в фоновом потоке (для использования из других скриптов)."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8025)
+    parser.add_argument('--delay', type=float, default=0.0, help='задержка приёма каждого письма, секунд')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='доля писем с временным отказом 451')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    server = SMTPSink(args.host, args.port, args.delay, args.fail_rate)
+    print(f'SMTP-заглушка на {args.host}:{args.port}, задержка {args.delay} с, отказы {args.fail_rate:.0%}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('Итого:', server.stats.snapshot())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""Диалект SQL: один текст запроса для PostgreSQL и SQLite.
+
+Запросы пишутся один раз с плейсхолдерами '?' и выполняются через execute()
+и fetch_*(). Для PostgreSQL текст переписывается под psycopg2: '?' -> '%s',
+литеральный '%' -> '%%'. Перевод кэшируется по тексту запроса, так что
+стоимость — один поиск в словаре на вызов. Отдельные ветки USE_POSTGRESQL
+остаются только там, где SQL действительно разный (FOR UPDATE, RETURNING,
+ILIKE, execute_values, lastrowid и т.п.). Знак '?' в строковых литералах
+запросов не используется.
+"""
+import os
+from functools import lru_cache
+
+# Определяем тип БД: если есть DATABASE_URL – используем PostgreSQL, иначе SQLite
+USE_POSTGRESQL = 'DATABASE_URL' in os.environ
+
+
+@lru_cache(maxsize=1024)
+def sql(query):
+    """Текст запроса в синтаксисе плейсхолдеров текущей БД."""
+    if not USE_POSTGRESQL:
+        return query
+    return query.replace('%', '%%').replace('?', '%s')
+
+
+def execute(cur, query, params=()):
+    cur.execute(sql(query), tuple(params))
+    return cur
+
+
+def execute_many(cur, query, rows):
+    cur.executemany(sql(query), rows)
+    return cur
+
+
+def fetch_one(cur, query, params=()):
+    return execute(cur, query, params).fetchone()
+
+
+def fetch_all(cur, query, params=()):
+    return execute(cur, query, params).fetchall()
@@ -1,4 +1,6 @@
 bind = "0.0.0.0:10000"
 workers = 2
 threads = 4
-timeout = 120
\ No newline at end of file
+timeout = 120
+# Приложение (и проверка схемы БД) импортируется один раз в мастере до fork воркеров
+preload_app = True
\ No newline at end of file